@@ -12,6 +12,7 @@ import math
 import random
 import helics
 from collections import deque
+from pem_requests import PopulationField
 
 class HVAC:
     """This agent manages thermostat
@@ -57,6 +58,18 @@ class HVAC:
         bid_price (float): the current bid price in $/kwh
         cleared_price (float): the cleared market price in $/kwh
     """
+    # state attributes that become views on a PEM_REQUEST_KERNEL once the HVAC is bound
+    air_temp = PopulationField('air_temp')
+    hvac_kw = PopulationField('hvac_kw')
+    hvac_kw_last = PopulationField('hvac_kw_last')
+    basepoint = PopulationField('basepoint')
+    offset = PopulationField('offset')
+    setpoint = PopulationField('setpoint')
+    MTTR_now = PopulationField('MTTR_now')
+    probability = PopulationField('probability')
+    packet_delivered = PopulationField('packet_delivered')
+    exit_mode = PopulationField('exit_mode')
+
     def __init__(self,name,dict,aucObj):
         """Initializes the class
         """
@@ -122,6 +135,8 @@ class HVAC:
         self.MTTR_upper = self.MTTR_base*10  # upper bound for dynamic MTTR
 
         self.packet_delivered = True  # True if the latest packer has been delivered, False if the packet is on delivery
+        self.packet_id = 0 # number of the latest packet, an expiry of an earlier packet is ignored
+        self.packet_timer = None # TIMER_WHEEL of the coordinator that ends the packets, None to count the packet length in monitor_packet_length
         self.probability = 0   # current request probability
         self.response_strategy = "no"  # "setpoint" means price response by adjusting the setpoint according to the cleared price
                                        # "mttr" means price response by adjusting the mean time to request (MTTR)
@@ -150,9 +165,7 @@ class HVAC:
         # get hvac state (no work here)
         str = helics.helicsInputGetString (self.subs['subState'])
 
-        # update request probability
-        self.probability = self.get_request_probability()
-
+        # the request probability is computed when the loads request, see PEM_REQUEST_KERNEL.request_probability
         if self.has_exit_mode:
             self.exit_mode_operation()
         else:
@@ -209,16 +222,21 @@ class HVAC:
 
         request = {}
         if self.packet_delivered and not self.exit_mode:
-            if random.random() < self.probability:
-                request['name'] = self.name
-                request['house-name'] = self.houseName
-                request['load-type'] = self.loadType
-                request['power'] = self.hvac_kw_last
-                request['on'] = self.hvac_on
-                request['hvac_kw'] = self.hvac_kw
-                request['packet-length'] = self.energy_packet_length
-                request['response'] = None
-                return request
+            if random.random() < self.get_request_probability():
+                return self.make_request()
+        return request
+
+    def make_request(self):
+        # the request message to the coordinator, PEM_REQUEST_KERNEL decides whether the HVAC requests
+        request = {}
+        request['name'] = self.name
+        request['house-name'] = self.houseName
+        request['load-type'] = self.loadType
+        request['power'] = self.hvac_kw_last
+        request['on'] = self.hvac_on
+        request['hvac_kw'] = self.hvac_kw
+        request['packet-length'] = self.energy_packet_length
+        request['response'] = None
         return request
 
     def receive_response(self, response):
@@ -227,6 +245,9 @@ class HVAC:
             self.turn_ON()                   # once the request is accepted, turn on the device
             self.packet_delivered = False
             self.energy_packet_length_now = 0
+            self.packet_id += 1
+            if self.packet_timer is not None: # the packet ends after as many update ticks as monitor_packet_length counts
+                self.packet_timer.schedule(math.ceil(self.energy_packet_length/self.update_period), (self, self.packet_id))
         else:
             self.turn_OFF()
             self.energy_packet_length_now = 0
@@ -248,6 +269,13 @@ class HVAC:
                 self.turn_OFF()
                 self.packet_delivered = True
 
+    def end_packet(self, packet_id):
+        # the packet timer expired, the packet ends unless the exit mode has ended it already
+        if packet_id == self.packet_id and not self.packet_delivered and self.hvac_on and not self.exit_mode:
+            self.energy_packet_length_now = math.ceil(self.energy_packet_length/self.update_period)*self.update_period
+            self.turn_OFF()
+            self.packet_delivered = True
+
 
     def update_energyMarket(self):
         dEnergy = self.hvac_kw*self.update_period/3600
@@ -9,78 +9,113 @@ mechanism.
 import math
 import my_tesp_support_api.helpers as helpers
 import math
-import random
 import helics
+import numpy as np
 from collections import deque
+from timer_wheel import TIMER_WHEEL
 
 
 class PEM_Coordinator:
-    def __init__(self, name, enable = True):
+    def __init__(self, name, enable = True, seed = None):
 
         self.name = name
         self.enable = enable
+        self.rng = np.random.default_rng(seed) # random arrival order of the requests, seed may be a shared np.random.Generator
 
         self.num_loads = 0
 
         self.vpp_load = 0 # kVA
         self.balance_signal = 200 # kVA
 
-        self.request_list = []
-        self.response_list = []
+        # requests of the current request period as arrays, see receive_requests
+        self.request_idx = np.zeros(0, dtype=np.intp)
+        self.request_power = np.zeros(0)
+        self.request_running = np.zeros(0, dtype=bool)
+        self.request_urgency = None
+        self.accepted = np.zeros(0, dtype=np.intp) # load indices of the accepted requests of the last aggregation
+        self.rejected = np.zeros(0, dtype=np.intp) # load indices of the rejected requests
         self.request_ratio  = 0
         self.accepted_ratio  = 0
 
+        self.packet_wheel = TIMER_WHEEL() # expiry of the energy packets of the accepted requests, one tick per state update
+
         self.subs = {}
         self.pubs = {}
 
 
-    def receive_request(self, request):
-        # request is a list [name, load type, power, length]
-        if len(request) > 0:
-            self.request_list.append(request)
+    def receive_requests(self, load_idx, power, hvac_kw, urgency = None):
+        """ Receives the requests of a request period as arrays
+
+        Args:
+            load_idx (np.ndarray): index of each requesting load
+            power (np.ndarray): packet power of each request in kW
+            hvac_kw (np.ndarray): current HVAC load of each requesting load in kW, a running HVAC adds no load
+            urgency (np.ndarray): requests with a higher urgency are admitted first, None for random order only
+        """
+        self.request_idx = np.asarray(load_idx, dtype=np.intp)
+        self.request_power = np.asarray(power, dtype=np.float64)
+        self.request_running = np.asarray(hvac_kw) >= 0.1 # actually, it should be "hvac_on"
+        self.request_urgency = urgency
+
+    def admit(self, load_idx, power, running = None, urgency = None):
+        """ Admits requests in random arrival order while the VPP load stays within the balance signal
+
+        The requests are put in a random order (by descending urgency first, if given). The load
+        estimate grows by the power of every request of an HVAC that is not running yet, the
+        requests are accepted up to the first one that would bring the estimate above the balance
+        signal, that one and all after it are rejected.
+
+        Args:
+            load_idx (np.ndarray): index of each requesting load
+            power (np.ndarray): packet power of each request in kW
+            running (np.ndarray): True for requests of running HVACs, None for none
+            urgency (np.ndarray): admission priority of each request, None for random order only
+
+        Returns:
+            (np.ndarray, np.ndarray): load indices of the accepted and of the rejected requests
+        """
+        num_requests = len(load_idx)
+        if urgency is None:
+            order = self.rng.permutation(num_requests) # randomize the arrive time
+        else:
+            order = np.lexsort((self.rng.random(num_requests), -np.asarray(urgency)))
+        added = np.where(running, 0.0, power) if running is not None else np.asarray(power, dtype=np.float64)
+        load_est = self.vpp_load + np.cumsum(added[order])
+        num_accepted = np.searchsorted(load_est, self.balance_signal, side='right') # load_est never decreases
+        return load_idx[order[:num_accepted]], load_idx[order[num_accepted:]]
 
     def aggregate_requests(self):
 
         self.get_vpp_load()
-        num_requests = len(self.request_list)
-        num_accepted = 0
+        num_requests = len(self.request_idx)
         self.request_ratio = num_requests/self.num_loads
-        self.response_list.clear()
-        self.response_list = self.request_list.copy() # copy messages
-
-
-        if len(self.response_list) > 0:
-            if not self.enable: # if VPP coordinator is not enable, all requests will be accepted
-                for i in range(len(self.response_list)):
-                    self.response_list[i]['response'] = 'YES'
-                    num_accepted += 1
-            else:
-                arrive_idx_list = list(range(len(self.response_list)))
-                random.shuffle(arrive_idx_list) # randomize the arrive time
-                load_est = self.vpp_load
-
-                for idx in arrive_idx_list:
-                    response = self.response_list[idx]
-                    key = response['name']
-                    load = response['power']
-                    length = response['packet-length']
-                    hvac_on = response['on']
-                    hvac_kw = response['hvac_kw']
-                    if hvac_kw < 0.1:     #actually, it should be "if not hvac_on"
-                        load_est += load
-                    if (self.balance_signal - load_est) >= 0:
-                        self.response_list[idx]['response'] = 'YES'
-                        num_accepted += 1
-                    else:
-                        self.response_list[idx]['response'] = 'NO'
-                        load_est -= load
+
+        if not self.enable: # if VPP coordinator is not enable, all requests will be accepted
+            self.accepted, self.rejected = self.request_idx, np.zeros(0, dtype=np.intp)
+        else:
+            self.accepted, self.rejected = self.admit(self.request_idx, self.request_power, self.request_running, self.request_urgency)
 
         if num_requests>0:
-            self.accepted_ratio = num_accepted/num_requests
+            self.accepted_ratio = len(self.accepted)/num_requests
         else:
             self.accepted_ratio = 1
 
-        self.request_list.clear()
+        self.request_idx = np.zeros(0, dtype=np.intp)
+        self.request_power = np.zeros(0)
+        self.request_running = np.zeros(0, dtype=bool)
+        self.request_urgency = None
+
+
+    def manage_packets(self, hvac):
+        # the packets of this HVAC end through the packet wheel of the coordinator
+        hvac.packet_timer = self.packet_wheel
+
+    def expire_packets(self):
+        """ Ends the energy packets expiring at this state update, returns how many ended"""
+        expired = self.packet_wheel.advance()
+        for hvac, packet_id in expired:
+            hvac.end_packet(packet_id)
+        return len(expired)
 
 
     def get_vpp_load(self):
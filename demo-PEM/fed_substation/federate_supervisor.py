@@ -0,0 +1,238 @@
+# file: federate_supervisor.py
+"""Asyncio supervisor of the co-simulation processes.
+
+Replaces the Popen(..., shell=True) launches and the busy-waiting of
+kill_processes. The federates are started concurrently from an event loop
+in a background thread (the substation federate keeps its own synchronous
+loop), each one writes to its own log file. For every federate the
+supervisor tracks:
+    readiness   the ready_pattern appears in the log (or the log is not empty when there is no pattern)
+    progress    the log keeps growing, idle_timeout seconds without new output counts as hung
+    wall time   wall_timeout seconds after the launch the federate is stopped
+    exit code   a non-zero exit, a timeout or a hang is a failure
+On the first failure all processes are torn down (SIGTERM to the process
+group, SIGKILL after grace_period) and on_failure is called, so a broken
+co-simulation does not hold its slot until somebody notices it.
+"""
+import os
+import time
+import signal
+import asyncio
+import threading
+import concurrent.futures
+
+
+class FEDERATE_SPEC:
+    """How to launch and watch one federate (or the broker)
+
+    Args:
+        name (str): name used in the report
+        args ([str]): command line, executed without a shell
+        cwd (str): working directory
+        log_file (str): stdout and stderr go to this file, relative to cwd
+        env (dict): extra environment variables
+        ready_pattern (str): text in the log that shows the federate is up, None for any output
+        wall_timeout (float): seconds after the launch the federate is stopped, None for no limit
+        idle_timeout (float): seconds without new log output that count as hung, None for no limit
+    """
+    def __init__(self, name, args, cwd, log_file, env = None, ready_pattern = None, wall_timeout = None, idle_timeout = None):
+        self.name = name
+        self.args = [str(arg) for arg in args]
+        self.cwd = cwd
+        self.log_file = log_file
+        self.env = env or {}
+        self.ready_pattern = ready_pattern
+        self.wall_timeout = wall_timeout
+        self.idle_timeout = idle_timeout
+
+
+class SUPERVISED_FEDERATE:
+    """Run-time state of one launched federate
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.proc = None
+        self.task = None
+        self.status = 'starting' # running, ready, exited, failed, timeout, hung, killed
+        self.launch_time = None
+        self.ready_time = None
+        self.exit_time = None
+        self.returncode = None
+        self.log_path = os.path.join(spec.cwd, spec.log_file)
+        self.log_offset = 0
+        self.log_tail = ''
+        self.last_progress = None
+
+
+class FEDERATE_SUPERVISOR:
+    """Launches, watches and tears down the federate processes
+
+    Args:
+        poll_period (float): seconds between two checks of the logs and timeouts
+        grace_period (float): seconds between SIGTERM and SIGKILL at teardown
+        on_failure (function): called as on_failure(federate) from the supervisor thread after the teardown
+
+    Attributes:
+        federates (dict): SUPERVISED_FEDERATE objects keyed by name, in launch order
+    """
+    def __init__(self, poll_period = 1.0, grace_period = 10.0, on_failure = None):
+        self.poll_period = poll_period
+        self.grace_period = grace_period
+        self.on_failure = on_failure
+        self.federates = {}
+        self.stopping = False
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='federate-supervisor', daemon=True)
+        self.thread.start()
+
+    def _call(self, coro, timeout = None):
+        # run a coroutine on the supervisor loop and wait for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def launch(self, *specs):
+        """Starts the given federates concurrently, returns once all processes exist
+        """
+        self._call(self._launch_all(specs))
+
+    def wait(self, timeout = None):
+        """Blocks until every launched federate exited, been stopped or timeout seconds passed
+
+        Returns:
+            bool: True if all federates are done
+        """
+        try:
+            self._call(self._wait_all(), timeout)
+            return True
+        except concurrent.futures.TimeoutError:
+            return False
+
+    def shutdown(self):
+        """Stops every federate still running and the supervisor loop
+        """
+        if not self.loop.is_running():
+            return
+        self._call(self._teardown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def _launch_all(self, specs):
+        await asyncio.gather(*[self._launch(spec) for spec in specs])
+
+    async def _launch(self, spec):
+        fed = SUPERVISED_FEDERATE(spec)
+        self.federates[spec.name] = fed
+        env = dict(os.environ)
+        env.update(spec.env)
+        env.setdefault('PYTHONUNBUFFERED', '1') # python federates write their log as they go
+        with open(fed.log_path, 'wb') as log:
+            fed.proc = await asyncio.create_subprocess_exec(*spec.args, cwd=spec.cwd, env=env, stdout=log,
+                                                            stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+        fed.launch_time = time.monotonic()
+        fed.last_progress = fed.launch_time
+        fed.status = 'running'
+        fed.task = self.loop.create_task(self._watch(fed))
+
+    async def _watch(self, fed):
+        spec = fed.spec
+        while True:
+            try:
+                await asyncio.wait_for(fed.proc.wait(), self.poll_period)
+                break
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            self._read_log(fed, now)
+            if spec.wall_timeout is not None and now - fed.launch_time > spec.wall_timeout:
+                await self._fail(fed, 'timeout')
+                return
+            if spec.idle_timeout is not None and now - fed.last_progress > spec.idle_timeout:
+                await self._fail(fed, 'hung')
+                return
+        self._read_log(fed, time.monotonic())
+        fed.exit_time = time.monotonic()
+        fed.returncode = fed.proc.returncode
+        if self.stopping:
+            fed.status = 'killed'
+        elif fed.returncode == 0:
+            fed.status = 'exited'
+        else:
+            await self._fail(fed, 'failed')
+
+    def _read_log(self, fed, now):
+        # new log output counts as progress, the first match of ready_pattern marks the federate ready
+        try:
+            size = os.path.getsize(fed.log_path)
+        except OSError:
+            return
+        if size <= fed.log_offset:
+            return
+        fed.last_progress = now
+        if fed.ready_time is None:
+            if fed.spec.ready_pattern is None:
+                fed.ready_time = now
+            else:
+                with open(fed.log_path, 'rb') as f:
+                    f.seek(fed.log_offset)
+                    text = fed.log_tail + f.read(size - fed.log_offset).decode('utf-8', errors='replace')
+                if fed.spec.ready_pattern in text:
+                    fed.ready_time = now
+                fed.log_tail = text[-len(fed.spec.ready_pattern):]
+            if fed.ready_time is not None and fed.status == 'running':
+                fed.status = 'ready'
+        fed.log_offset = size
+
+    async def _fail(self, fed, status):
+        fed.status = status
+        if self.stopping:
+            return
+        print('Federate {} {} (return code {}), stopping the co-simulation'.format(fed.spec.name, status, fed.proc.returncode), flush=True)
+        await self._teardown()
+        fed.status = status # the teardown marks every process it stops as killed
+        if self.on_failure is not None:
+            self.on_failure(fed)
+
+    async def _teardown(self):
+        self.stopping = True
+        running = [fed for fed in self.federates.values() if fed.proc is not None and fed.proc.returncode is None]
+        for fed in running:
+            self._signal(fed, signal.SIGTERM)
+        if len(running) > 0:
+            await asyncio.wait([self.loop.create_task(fed.proc.wait()) for fed in running], timeout=self.grace_period)
+            for fed in running:
+                if fed.proc.returncode is None:
+                    self._signal(fed, signal.SIGKILL)
+            await asyncio.gather(*[fed.proc.wait() for fed in running])
+        for fed in running:
+            fed.status = 'killed'
+            fed.returncode = fed.proc.returncode
+            fed.exit_time = time.monotonic()
+
+    def _signal(self, fed, sig):
+        try:
+            os.killpg(fed.proc.pid, sig) # the federate and anything it started
+        except ProcessLookupError:
+            pass
+
+    async def _wait_all(self):
+        tasks = [fed.task for fed in self.federates.values() if fed.task is not None]
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+
+    def report(self):
+        """Returns one dict per federate: status, return code, start latency and wall time in seconds
+        """
+        now = time.monotonic()
+        rows = []
+        for name, fed in self.federates.items():
+            rows.append({'name': name, 'pid': fed.proc.pid if fed.proc else None, 'status': fed.status,
+                         'returncode': fed.returncode,
+                         'start_latency': None if fed.ready_time is None else fed.ready_time - fed.launch_time,
+                         'wall_time': None if fed.launch_time is None else (fed.exit_time or now) - fed.launch_time})
+        return rows
+
+    def show_report(self):
+        print('Federates:')
+        for row in self.report():
+            latency = '-' if row['start_latency'] is None else '{:.2f} s'.format(row['start_latency'])
+            print('  {:<20} {:<8} return code = {:<5} start latency = {:<9} wall time = {:.1f} s'.format(
+                  row['name'], row['status'], str(row['returncode']), latency, row['wall_time'] or 0.0))
@@ -15,15 +15,20 @@ import os
 import json
 import helics
 import random
+import numpy as np
 import psutil
 import subprocess
 from PEM_Controller import PEM_Controller      # import user-defined my_hvac class for hvac controllers
 from PEM_Coordinator import PEM_Coordinator
+from pem_requests import PEM_REQUEST_KERNEL
+from scheduler import SubstationScheduler
+from phase_timer import PHASE_TIMER
 from datetime import datetime
 from datetime import timedelta
 from my_auction import AUCTION  # import user-defined my_auction class for market
 import matplotlib.pyplot as plt
 import my_tesp_support_api.helpers as helpers
+import my_tesp_support_api.grant_trace as grant_trace
 from federate_helper import FEDERATE_HELPER, CURVES_TO_PLOT
 
 
@@ -39,17 +44,20 @@ hour_stop = 24
 hasMarket = False # have market or not
 vppEnable = True # have Vpp coordinator or not
 drawFigure = True # draw figures during the simulation
+request_seed = 1 # seed of the random draws and the arrival order of the PEM requests, None for a different run every time
+rng = np.random.default_rng(request_seed) # shared by the request kernel and the VPP
 fh = FEDERATE_HELPER(configfile, helicsConfig, metrics_root, hour_stop) # initialize the federate helper
 
 
 """=============================Start The Co-simulation==================================="""
 fh.cosimulation_start() # launch the broker; launch other federates; the substation federate enters executing mode
+fh.start_resource_sampler(data_path) # CPU, memory, open files and I/O of every federate, sampled during the run
 
 
 """============================Substation Initialization=================================="""
 # initialize a user-defined PEM coordinator object (VPP object)
 vpp_name = fh.vpp_name_list[0] # select the first VPP, it is possible to initialize multiple VPP
-vpp = PEM_Coordinator(vpp_name,vppEnable)
+vpp = PEM_Coordinator(vpp_name,vppEnable,rng)
 vpp.get_helics_subspubs(fh.get_agent_pubssubs(vpp.name, 'VPP'))
 
 # initialize a user-defined auction object
@@ -69,8 +77,11 @@ for meter, info in fh.houseMeters_dict.items():
   houses[key].get_cleared_price(auction.clearing_price)
   houses[key].hvac.get_helics_subspubs(fh.get_agent_pubssubs(hvac_name, 'HVAC'))
   houses[key].hvac.turn_OFF()  # at the beginning of the simulation, turn off all HVACs
+  vpp.manage_packets(houses[key].hvac) # the VPP ends the energy packets of the accepted requests
 last_house_name = key
 vpp.num_loads = len(houses)
+hvac_list = [house.hvac for house in houses.values()]
+request_kernel = PEM_REQUEST_KERNEL(hvac_list, rng) # binds the HVAC request state to arrays, probabilities and draws of all HVACs at once
 
 
 # initialize HVAC controller objects
@@ -104,115 +115,125 @@ request_period = houses[last_house_name].hvac.request_period   # local controlle
 market_period = auction.period # market period (300 seconds)
 adjust_period = market_period # demand response period (300 seconds)
 fig_update_period = 60 # figure update time period
-tnext_update = dt             # the next time to update the state
-tnext_request = dt            # the next time to request
-tnext_lmp = market_period - 2 * dt  # the next time PYPOWER executes OPF and publishes LMP (no action here)
-tnext_bid = market_period - 2 * dt  # the next time controllers calculate their final bids
-tnext_agg = market_period - 2 * dt  # the next time auction calculates and publishes aggregate bid
-tnext_clear = market_period         # the next time clear the market
-tnext_adjust = market_period        # the next time controllers adjust control parameters/setpoints based on their bid and clearing price
-tnext_fig_update = fig_update_period    # the next time to update figures
+
+# per-phase timing of the loop, histograms per market period are written to data_path/timing.json
+timer = PHASE_TIMER(market_period)
+tracer = grant_trace.GRANT_TRACER(fh.fedName) # writes the time grants when PET_GRANT_TRACE is set
 
 time_granted = 0
 time_last = 0
+hour_of_day = 0
+day_of_week = dt_now.weekday()
+
+
+"""============================Substation Phases=================================="""
+
+def update_phase(time_granted):
+  """ PEM controllers update schedule and state, the VPP ends the expired energy packets"""
+  for key, house in houses.items():
+    house.update_state()
+    house.hvac.change_basepoint (hour_of_day, day_of_week) # update schedule
+  vpp.expire_packets() # end the energy packets whose length is delivered, only those expiring now are touched
+
+
+def request_phase(time_granted):
+  """ houses generate/send request, VPP receives requests and dispatch YES/NO """
+  vpp.update_balance_signal(auction.lmp)
+  rows = request_kernel.draw_requests() # loads generate/send their requests
+  vpp.receive_requests(rows, *request_kernel.request_loads(rows)) # vpp receives the requests
+  timer.begin('dispatch')
+  vpp.aggregate_requests()    # vpp aggregate requests and generate responses
+  timer.end()
+  for i in vpp.accepted:
+    hvac_list[i].receive_response('YES')
+  for i in vpp.rejected:
+    hvac_list[i].receive_response('NO')
+  curves.record_data(time_granted, houses, auction, vpp)
+
+
+def lmp_phase(time_granted):
+  """ market gets the local marginal price (LMP) from the bulk power grid"""
+  auction.get_lmp () # get local marginal price (LMP) from the bulk power grid
+  auction.get_refload() # get distribution load from gridlabd
+
+
+def adjust_phase(time_granted):
+  """ prosumer demand response (adjust control parameters/setpoints) """
+  for key, house in houses.items():
+    house.demand_response(auction.lmp)
+
+
+def fig_phase(time_granted):
+  """ visualize some results during the simulation"""
+  curves.update_curves(time_granted, houses, auction, vpp)
+  ax1.cla()
+  ax1.set_ylabel("VPP Load (kW/kVar)")
+  ax1.plot(curves.curve_time_hour, curves.curve_vpp_load_p)
+  ax1.plot(curves.curve_time_hour, curves.curve_balancing_signal)
+  ax1.legend(['active', 'balancing_signal'])
+
+  ax2.cla()
+  ax2.set_ylabel("House Load (kW)")
+  ax2.plot(curves.curve_time_hour, curves.curve_house_load_max)
+  ax2.plot(curves.curve_time_hour, curves.curve_house_load_mean)
+  ax2.plot(curves.curve_time_hour, curves.curve_house_load_min)
+  ax2.legend(['max', 'mean', 'min'])
+
+  ax3.cla()
+  ax3.set_ylabel("Temperature (degF)")
+  ax3.plot(curves.curve_time_hour, curves.curve_temp_max)
+  ax3.plot(curves.curve_time_hour, curves.curve_temp_mean)
+  ax3.plot(curves.curve_time_hour, curves.curve_temp_min)
+  ax3.plot(curves.curve_time_hour, curves.curve_temp_basepoint_mean)
+  ax3.legend(['max', 'mean', 'min', 'schedule'])
+
+  ax4.cla()
+  ax4.set_ylabel("LMP ($)")
+  ax4.plot(curves.curve_time_hour, curves.curve_lmp)
+
+  ax5.cla()
+  ax5.set_xlabel("Time (h)")
+  ax5.set_ylabel("Percentage")
+  ax5.plot(curves.curve_time_hour, curves.curve_on_ratio)
+  ax5.plot(curves.curve_time_hour, curves.curve_probability_mean)
+  ax5.plot(curves.curve_time_hour, curves.curve_request_ratio)
+  ax5.plot(curves.curve_time_hour, curves.curve_accepted_ratio)
+  ax5.legend(['on-ratio','probability', 'request', 'accepted'])
+
+
+  plt.pause(0.01)
+  print("Time = ", time_granted, ', Accepted ratio: ', curves.curve_request_ratio[-1])
+
+
+# register the phases, tasks due at the same time run in ascending priority
+scheduler = SubstationScheduler(StopTime, timer)
+scheduler.add_periodic('update', update_phase, update_period, dt, priority=1)
+scheduler.add_periodic('request', request_phase, request_period, dt, priority=2)
+scheduler.add_periodic('lmp', lmp_phase, market_period, market_period - 2 * dt, priority=3)  # PYPOWER executes OPF and publishes LMP
+scheduler.add_periodic('adjust', adjust_phase, adjust_period, market_period, priority=4)  # controllers adjust setpoints based on the LMP
+if drawFigure:
+  scheduler.add_periodic('fig', fig_phase, fig_update_period, fig_update_period, priority=5)
+
 
 """============================Substation Loop=================================="""
 print("Co-Simulation Start!")
 
 while (time_granted < StopTime):
 
-  """ 1. step the co-simulation time """
-  nextHELICSTime = int(min ([tnext_update,tnext_request,tnext_lmp, tnext_bid, tnext_agg, tnext_clear, tnext_adjust, StopTime]))
-  time_granted = int (helics.helicsFederateRequestTime(fh.hFed, nextHELICSTime))
+  """ 1. step the co-simulation time to the next due task """
+  nextHELICSTime = int(scheduler.next_time())
+  wait_start = time.perf_counter_ns()
+  time_granted = int (tracer.request_time(fh.hFed, nextHELICSTime))
+  timer.set_time(time_granted)
+  timer.add('helics_wait', time.perf_counter_ns() - wait_start) # time blocked until HELICS grants, not computing
   time_delta = time_granted - time_last
   time_last = time_granted
-  hour_of_day = 24.0 * ((float(time_granted) / 86400.0) % 1.0)
   dt_now = dt_now + timedelta(seconds=time_delta) # this is the actual time
   day_of_week = dt_now.weekday() # get the day of week
   hour_of_day = dt_now.hour # get the hour of the day
 
-
-
-  """ 2. PEM controllers update schedule, state, monitor energy packet length"""
-  if time_granted >= tnext_update:
-    for key, house in houses.items():
-      house.update_state()
-      house.hvac.change_basepoint (hour_of_day, day_of_week) # update schedule
-      house.hvac.monitor_packet_length() # if the power delivery is on going, update the length of the packet
-    tnext_update += update_period
-
-
-
-  """ 3. houses generate/send request, VPP receives requests and dispatch YES/NO """
-  if time_granted >= tnext_request:
-    vpp.update_balance_signal(auction.lmp)
-    for key, house in houses.items():
-      request = house.hvac.send_request() # load generate/send its request
-      vpp.receive_request(request) # vpp receives this request
-    vpp.aggregate_requests()    # vpp aggregate requests and generate responses
-    for response in vpp.response_list:
-      houses[response['house-name']].hvac.receive_response(response['response'])
-    curves.record_data(time_granted, houses, auction, vpp)
-    tnext_request += request_period
-
-
-  """ 4. market gets the local marginal price (LMP) from the bulk power grid"""
-  if time_granted >= tnext_lmp:
-    auction.get_lmp () # get local marginal price (LMP) from the bulk power grid
-    auction.get_refload() # get distribution load from gridlabd
-    tnext_lmp += market_period
-
-
-
-  """ 5. prosumer demand response (adjust control parameters/setpoints) """
-  if time_granted >= tnext_adjust:
-    for key, house in houses.items():
-      house.demand_response(auction.lmp)
-    tnext_adjust += market_period
-
-
-  """ 9. visualize some results during the simulation"""
-  if drawFigure and time_granted >= tnext_fig_update:
-    curves.update_curves(time_granted, houses, auction, vpp)
-    ax1.cla()
-    ax1.set_ylabel("VPP Load (kW/kVar)")
-    ax1.plot(curves.curve_time_hour, curves.curve_vpp_load_p)
-    ax1.plot(curves.curve_time_hour, curves.curve_balancing_signal)
-    ax1.legend(['active', 'balancing_signal'])
-
-    ax2.cla()
-    ax2.set_ylabel("House Load (kW)")
-    ax2.plot(curves.curve_time_hour, curves.curve_house_load_max)
-    ax2.plot(curves.curve_time_hour, curves.curve_house_load_mean)
-    ax2.plot(curves.curve_time_hour, curves.curve_house_load_min)
-    ax2.legend(['max', 'mean', 'min'])
-
-    ax3.cla()
-    ax3.set_ylabel("Temperature (degF)")
-    ax3.plot(curves.curve_time_hour, curves.curve_temp_max)
-    ax3.plot(curves.curve_time_hour, curves.curve_temp_mean)
-    ax3.plot(curves.curve_time_hour, curves.curve_temp_min)
-    ax3.plot(curves.curve_time_hour, curves.curve_temp_basepoint_mean)
-    ax3.legend(['max', 'mean', 'min', 'schedule'])
-
-    ax4.cla()
-    ax4.set_ylabel("LMP ($)")
-    ax4.plot(curves.curve_time_hour, curves.curve_lmp)
-
-    ax5.cla()
-    ax5.set_xlabel("Time (h)")
-    ax5.set_ylabel("Percentage")
-    ax5.plot(curves.curve_time_hour, curves.curve_on_ratio)
-    ax5.plot(curves.curve_time_hour, curves.curve_probability_mean)
-    ax5.plot(curves.curve_time_hour, curves.curve_request_ratio)
-    ax5.plot(curves.curve_time_hour, curves.curve_accepted_ratio)
-    ax5.legend(['on-ratio','probability', 'request', 'accepted'])
-
-
-    plt.pause(0.01)
-    print("Time = ", time_granted, ', Accepted ratio: ', curves.curve_request_ratio[-1])
-
-    tnext_fig_update += fig_update_period
+  """ 2. run all phases due at the granted time """
+  scheduler.run_due(time_granted)
 
 
 """============================ Finalize the metrics output ============================"""
@@ -225,7 +246,11 @@ print (json.dumps(fh.prosumer_metrics), file=house_op)
 auction_op.close()
 house_op.close()
 fh.destroy_federate()  # destroy the federate
+fh.wait_federates(600) # let the other federates write their metrics, stop them if they do not end
+fh.stop_resource_sampler()
 fh.show_resource_consumption() # after simulation, print the resource consumption
+timer.save(data_path)
+timer.show_statistics() # where the wall time of the loop went
 plt.show()
 # fh.kill_processes(True) # it is not suggested here because some other federates may not end their simulations, it will affect their output metrics
 
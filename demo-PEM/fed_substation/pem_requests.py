@@ -0,0 +1,124 @@
+# file: pem_requests.py
+"""Population-level request generation of the PEM loads.
+
+Every request period each HVAC whose last packet is delivered (and that is
+not in exit mode) asks for a new energy packet with the probability
+
+    1 - exp(-mu * request_period),  mu = (T - T_low)/(T_up - T) * (T_up - T_set)/(T_set - T_low) / MTTR
+
+as in HVAC.get_request_probability and HVAC.send_request. Here the
+probabilities of all HVACs are one NumPy expression and the draws come from
+one seeded numpy Generator, the result is the array of requesting rows.
+
+The HVAC state the requests depend on lives in the kernel columns. After
+binding, the HVAC objects keep working as before, but these attributes become
+thin views on the columns, so HVAC.update_state writes straight into them.
+"""
+import numpy as np
+
+
+class PopulationField:
+    """Attribute descriptor that stores its value in a PEM_REQUEST_KERNEL column
+
+    Before the owner object is bound to a kernel, the value lives in the
+    instance dictionary like a normal attribute. After binding, reads and writes
+    go to element [idx] of the named kernel column.
+
+    Args:
+        column (str): name of the PEM_REQUEST_KERNEL column backing this attribute
+    """
+    def __init__(self, column):
+        self.column = column
+        self.name = column
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        population = obj.__dict__.get('_population')
+        if population is None:
+            return obj.__dict__[self.name]
+        return getattr(population, self.column)[obj.__dict__['_population_idx']].item()
+
+    def __set__(self, obj, value):
+        population = obj.__dict__.get('_population')
+        if population is None:
+            obj.__dict__[self.name] = value
+        else:
+            getattr(population, self.column)[obj.__dict__['_population_idx']] = value
+
+
+def bind_to_population(obj, population, idx):
+    """Turns the PopulationField attributes of obj into views on the population row idx
+    """
+    obj.__dict__['_population'] = population
+    obj.__dict__['_population_idx'] = idx
+
+
+class PEM_REQUEST_KERNEL:
+    """Request state, probabilities and draws of a population of PEM HVACs
+
+    Args:
+        hvacs ([HVAC]): the HVAC controllers, in row order; they are bound to the kernel columns
+        seed (int): seed of the random generator, None for a fresh seed, or a np.random.Generator to share
+
+    Attributes:
+        rng (np.random.Generator): generator of the request draws
+        air_temp (np.ndarray): air temperature of the houses in deg F
+        hvac_kw (np.ndarray): current HVAC load in kW
+        hvac_kw_last (np.ndarray): last non-zero HVAC load in kW, the packet power
+        probability (np.ndarray): request probability of each row at the last draw
+        packet_delivered (np.ndarray): True if the last packet of the HVAC is delivered
+        exit_mode (np.ndarray): True if the HVAC is in exit mode
+    """
+    # state columns, initialized from the bound HVACs
+    float_columns = ['air_temp', 'hvac_kw', 'hvac_kw_last', 'basepoint', 'offset', 'setpoint', 'MTTR_now', 'probability']
+    bool_columns = ['packet_delivered', 'exit_mode']
+
+    def __init__(self, hvacs, seed = None):
+        self.hvacs = list(hvacs)
+        self.num_loads = len(self.hvacs)
+        self.rng = np.random.default_rng(seed)
+        # static parameters
+        self.deadband = np.array([hvac.deadband for hvac in self.hvacs], dtype=np.float64)
+        self.request_period = np.array([hvac.request_period for hvac in self.hvacs], dtype=np.float64)
+        # initialize the columns from the current object state, then bind the objects
+        for column in self.float_columns:
+            setattr(self, column, np.array([getattr(hvac, column) for hvac in self.hvacs], dtype=np.float64))
+        for column in self.bool_columns:
+            setattr(self, column, np.array([getattr(hvac, column) for hvac in self.hvacs], dtype=bool))
+        for i, hvac in enumerate(self.hvacs):
+            bind_to_population(hvac, self, i)
+
+    def request_probability(self):
+        """Population version of HVAC.get_request_probability
+
+        Returns:
+            np.ndarray: request probability of each row
+        """
+        self.setpoint[:] = self.basepoint + self.offset
+        up_bound = self.setpoint + 1/2*self.deadband
+        lower_bound = self.setpoint - 1/2*self.deadband
+
+        mr = 1/self.MTTR_now
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mu = mr * (self.air_temp-lower_bound)/(up_bound-self.air_temp)*(up_bound-self.setpoint)/(self.setpoint-lower_bound)
+        mu = np.where(self.air_temp >= up_bound, np.inf, np.where(self.air_temp <= lower_bound, 0.0, mu))
+        self.probability[:] = 1 - np.exp(-mu*self.request_period)
+        return self.probability
+
+    def draw_requests(self):
+        """Population version of HVAC.send_request
+
+        Returns:
+            np.ndarray: rows (indices into hvacs) of the HVACs that request a packet, ascending
+        """
+        self.request_probability()
+        draws = self.rng.random(self.num_loads)
+        return np.flatnonzero(self.packet_delivered & ~self.exit_mode & (draws < self.probability))
+
+    def request_loads(self, rows):
+        """The packet power and the current HVAC load of the requesting rows, in kW"""
+        return self.hvac_kw_last[rows], self.hvac_kw[rows]
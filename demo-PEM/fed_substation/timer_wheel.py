@@ -0,0 +1,58 @@
+# file: timer_wheel.py
+"""Hashed timer wheel for the energy packets of the PEM loads.
+
+An accepted request starts an energy packet that ends after a fixed number
+of update ticks. Instead of counting the packet length of every HVAC on
+every tick, the expiry tick of a packet is put into slot expiry % num_slots
+of the wheel when the packet starts, and a tick only looks at the packets
+of its own slot. The work per tick follows the number of packets that end,
+not the number of loads.
+"""
+
+
+class TIMER_WHEEL:
+    """Hashed timer wheel counting in ticks
+
+    Args:
+        num_slots (int): slots of the wheel; a timer longer than num_slots ticks waits in its slot
+            for the extra rotations, so num_slots should cover the usual timer length
+
+    Attributes:
+        tick_count (int): ticks advanced so far
+        slots ([list]): (expiry tick, item) entries of each slot
+        num_pending (int): entries in the wheel, including cancelled timers not reached yet
+    """
+    def __init__(self, num_slots = 64):
+        self.num_slots = num_slots
+        self.slots = [[] for _ in range(num_slots)]
+        self.tick_count = 0
+        self.num_pending = 0
+
+    def schedule(self, ticks, item):
+        """Puts item into the wheel, advance returns it after ticks more ticks (at least one)
+
+        Returns:
+            int: the expiry tick
+        """
+        expiry = self.tick_count + max(1, ticks)
+        self.slots[expiry % self.num_slots].append((expiry, item))
+        self.num_pending += 1
+        return expiry
+
+    def advance(self):
+        """Advances the wheel by one tick
+
+        Returns:
+            list: the items expiring at this tick, in scheduling order
+        """
+        self.tick_count += 1
+        slot = self.slots[self.tick_count % self.num_slots]
+        if len(slot) == 0:
+            return []
+        due = [item for expiry, item in slot if expiry == self.tick_count]
+        if len(due) == len(slot):
+            slot.clear()
+        else: # timers of a later rotation stay in the slot
+            slot[:] = [entry for entry in slot if entry[0] != self.tick_count]
+        self.num_pending -= len(due)
+        return due
@@ -24,6 +24,7 @@ import math
 import re
 from copy import deepcopy
 import my_tesp_support_api.helpers as helpers
+import my_tesp_support_api.grant_trace as grant_trace
 #import cProfile
 #import pstats
 if sys.platform != 'win32':
@@ -258,6 +259,7 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
   if helicsConfig is not None:
     hFed = helics.helicsCreateValueFederateFromConfig(helicsConfig)
     fedName = helics.helicsFederateGetName(hFed)
+    tracer = grant_trace.GRANT_TRACER(fedName) # writes the time grants when PET_GRANT_TRACE is set
     pubCount = helics.helicsFederateGetPublicationCount(hFed)
     subCount = helics.helicsFederateGetInputCount(hFed)
     for i in range(pubCount):
@@ -542,7 +544,7 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
       break
     tRequest = min(ts + dt, tmax)
     if hFed is not None:
-      ts = int (helics.helicsFederateRequestTime(hFed, tRequest))
+      ts = int (tracer.request_time(hFed, tRequest))
     else:
       ts = fncs.time_request(tRequest)
 
@@ -23,6 +23,7 @@ except:
 import my_tesp_support_api.simple_auction as auction
 import my_tesp_support_api.hvac as hvac
 import my_tesp_support_api.helpers as helpers
+import my_tesp_support_api.grant_trace as grant_trace
 import json
 import math
 from datetime import datetime
@@ -89,6 +90,7 @@ def helics_substation_loop (configfile, metrics_root, hour_stop, flag, helicsCon
 #   print ('== Available HELICS subscription key', i, key, 'target', target)
   gldName = dict['GridLABD']
   fedName = helics.helicsFederateGetName(hFed)
+  tracer = grant_trace.GRANT_TRACER(fedName) # writes the time grants when PET_GRANT_TRACE is set
   bulkName = 'pypower'
 
   subFeeder = helics.helicsFederateGetSubscription (hFed, gldName + '/distribution_load')
@@ -140,7 +142,7 @@ def helics_substation_loop (configfile, metrics_root, hour_stop, flag, helicsCon
   while (time_granted < time_stop):
     nextHELICSTime = int(min ([tnext_bid, tnext_agg, tnext_clear, tnext_adjust, time_stop]))
 #    fncs.update_time_delta (nextFNCSTime-time_granted)
-    time_granted = int (helics.helicsFederateRequestTime(hFed, nextHELICSTime))
+    time_granted = int (tracer.request_time(hFed, nextHELICSTime))
     time_delta = time_granted - time_last
     time_last = time_granted
     hour_of_day = 24.0 * ((float(time_granted) / 86400.0) % 1.0)
@@ -0,0 +1,117 @@
+# file: benchmark_brokers.py
+"""
+Function:
+        measure the time grant latency of the flat and the hierarchical HELICS broker layouts (broker_topology.py)
+        N small value federates in a ring (each subscribes to the value of the one before it) run the same number
+        of steps under one broker, then under a root broker with a sub-broker per group of federates; the grants
+        are recorded by GRANT_TRACER, the latency of a step is the wall time from its time request to its grant
+usage:  python benchmark_brokers.py [--sizes 4 8 16 32] [--group 4] [--steps 200] [--port 25000]
+        the results are written to benchmark_brokers/results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+CASE_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(CASE_ROOT) # the federates run from their own folder
+sys.path.append(os.path.join(CASE_ROOT, 'fed_substation'))
+from federate_supervisor import FEDERATE_SUPERVISOR, FEDERATE_SPEC
+from broker_topology import BROKER_TOPOLOGY, LAYOUTS
+from my_tesp_support_api.grant_trace import GRANT_TRACER, read_grant_trace, TRACE_SUFFIX
+
+WORK_PATH = 'benchmark_brokers'
+PERIOD = 1 # seconds of simulation time per step
+
+
+def run_federate(config, steps, trace_dir):
+  """ one federate of the ring: publishes its step, reads the step of its neighbour"""
+  import helics
+  hFed = helics.helicsCreateValueFederateFromConfig(config)
+  pub = helics.helicsFederateGetPublicationByIndex(hFed, 0)
+  sub = helics.helicsFederateGetInputByIndex(hFed, 0)
+  tracer = GRANT_TRACER(helics.helicsFederateGetName(hFed), trace_dir)
+  helics.helicsFederateEnterExecutingMode(hFed)
+  granted = 0
+  for step in range(1, steps + 1):
+    helics.helicsPublicationPublishDouble(pub, float(step))
+    granted = tracer.request_time(hFed, step * PERIOD)
+    helics.helicsInputGetDouble(sub)
+  tracer.close()
+  helics.helicsFederateFinalize(hFed)
+  helics.helicsFederateFree(hFed)
+  print('federate done at', granted, flush=True)
+
+
+def write_ring(folder, size):
+  """ the HELICS configs of a ring of size federates, returns their paths"""
+  paths = []
+  for i in range(size):
+    config = {'name': 'fed{}'.format(i), 'period': PERIOD, 'log_level': 'warning',
+              'publications': [{'global': False, 'key': 'value', 'type': 'double'}],
+              'subscriptions': [{'key': 'fed{}/value'.format((i - 1) % size), 'type': 'double'}]}
+    paths.append(os.path.join(folder, 'fed{}.json'.format(i)))
+    with open(paths[-1], 'w', encoding='utf-8') as f:
+      json.dump(config, f, indent=2)
+  return paths
+
+
+def measure(size, layout, group, steps, port):
+  folder = os.path.abspath(os.path.join(WORK_PATH, '{}_{}'.format(layout, size)))
+  trace_dir = os.path.join(folder, 'traces')
+  os.makedirs(trace_dir, exist_ok=True)
+  configs = write_ring(folder, size)
+  topology = BROKER_TOPOLOGY(layout, 'benchbroker', port, folder)
+  members = [('fed{}'.format(i), 'group{}'.format(i // group), config) for i, config in enumerate(configs)]
+  specs = topology.broker_specs(members, loglevel=0)
+  specs += [FEDERATE_SPEC(name, [sys.executable, os.path.abspath(__file__), '--federate', config, str(steps), trace_dir],
+                          folder, name + '.log') for name, grp, config in members]
+
+  supervisor = FEDERATE_SUPERVISOR()
+  start = time.perf_counter()
+  try:
+    supervisor.launch(*specs)
+    supervisor.wait()
+  finally:
+    supervisor.shutdown()
+  wall_time = time.perf_counter() - start
+
+  latencies = []
+  for name, grp, config in members:
+    path = os.path.join(trace_dir, name + TRACE_SUFFIX)
+    if os.path.exists(path):
+      latencies += [(record['grant_us'] - record['request_us']) / 1000.0 for record in read_grant_trace(path)]
+  if len(latencies) < size * steps:
+    return {'size': size, 'layout': layout, 'error': 'only {} of {} grants recorded, see {}'.format(len(latencies), size * steps, folder)}
+  latencies.sort()
+  return {'size': size, 'layout': layout, 'brokers': len(specs) - size, 'median_ms': statistics.median(latencies),
+          'p95_ms': latencies[int(0.95 * (len(latencies) - 1))], 'wall_ms_per_step': 1000.0 * wall_time / steps}
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1 and sys.argv[1] == '--federate':
+    run_federate(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    sys.exit(0)
+
+  parser = argparse.ArgumentParser(description='compare the grant latency of the flat and the hierarchical broker layouts')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 16, 32], help='numbers of federates')
+  parser.add_argument('--group', type=int, default=4, help='federates per sub-broker in the hierarchical layout')
+  parser.add_argument('--steps', type=int, default=200, help='time steps of every federate')
+  parser.add_argument('--port', type=int, default=25000, help='port of the (root) broker')
+  args = parser.parse_args()
+  os.chdir(CASE_ROOT)
+
+  results = []
+  for size in args.sizes:
+    for layout in LAYOUTS:
+      result = measure(size, layout, args.group, args.steps, args.port)
+      results.append(result)
+      if 'error' in result:
+        print('{:>4} federates {:<12} failed: {}'.format(size, layout, result['error']), flush=True)
+      else:
+        print('{:>4} federates {:<12} {:>2} brokers  grant median {:8.3f} ms  p95 {:8.3f} ms  wall {:8.3f} ms/step'.format(
+              size, layout, result['brokers'], result['median_ms'], result['p95_ms'], result['wall_ms_per_step']), flush=True)
+  with open(os.path.join(WORK_PATH, 'results.json'), 'w', encoding='utf-8') as f:
+    json.dump(results, f, indent=1)
@@ -0,0 +1,116 @@
+# file: check_clearing.py
+"""
+Function:
+        checks the clearing engines of my_auction.AUCTION against a golden corpus
+        every case of the corpus is a set of house bids (as collect_bid receives them), the LMP and the substation
+        capacity; its expected outputs were recorded with the 'loop' engine. Each case is collected, aggregated,
+        cleared and its surplus calculated with every engine, and the clearing price, quantity and type, the
+        marginal quantity and fraction, the responsive/unresponsive quantities and the surpluses must be exactly
+        the recorded ones.
+usage:  python check_clearing.py [--corpus clearing_golden.json] [--engines loop vectorized]
+        exits with 1 if an engine differs from the corpus
+        python check_clearing.py --record [--cases 300] [--seed 0]
+        writes a new corpus from random bid sets, the expected outputs are taken from the 'loop' engine
+"""
+
+import os
+import io
+import sys
+import json
+import random
+import argparse
+import contextlib
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fed_substation'))
+from my_auction import AUCTION
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clearing_golden.json')
+MARKET_ROW = {'init_stdev': 0.01, 'init_price': 0.02, 'period': 300, 'statistic_mode': 1, 'stat_mode': 'ClearingPrice',
+              'stat_interval': 86400, 'stat_type': 'mean', 'stat_value': 0.02}
+# outputs of clear_market and surplusCalculation compared for every case
+OUTPUTS = ['clearing_price', 'clearing_quantity', 'clearing_type', 'marginal_quantity', 'marginal_frac',
+           'unresponsive_buy', 'responsive_buy', 'unresponsive_sell', 'responsive_sell',
+           'consumerSurplus', 'averageConsumerSurplus', 'supplierSurplus', 'unrespSupplierSurplus']
+
+
+def clear_case(case, engine):
+  """ runs one case through collect_bid, aggregate_bids, clear_market and surplusCalculation, returns the outputs"""
+  row = dict(MARKET_ROW, max_capacity_reference_bid_quantity=case['capacity'])
+  auction = AUCTION(row, 'golden', engine)
+  auction.lmp = case['lmp']
+  try:
+    with contextlib.redirect_stdout(io.StringIO()): # the auction logs every step
+      auction.clear_bids()
+      for bid in case['bids']:
+        auction.collect_bid(bid)
+      auction.aggregate_bids()
+      auction.clear_market()
+      auction.surplusCalculation()
+  except Exception as e: # recorded as well, every engine has to fail the same way
+    return {'error': type(e).__name__}
+  outputs = {}
+  for name in OUTPUTS:
+    value = getattr(auction, name)
+    outputs[name] = int(value) if name == 'clearing_type' else float(value)
+  return outputs
+
+
+def random_case(r):
+  """ a random set of house bids, prices and quantities are drawn from small sets so ties are common"""
+  prices = [0.01, 0.02, 0.025, 0.03, 0.05, 1.0]
+  bids = []
+  for i in range(r.choice([0, 1, 2, 3, 5, 10, 20, 40])):
+    role = r.choice(['buyer', 'buyer', 'seller', 'none-participant'])
+    price = r.choice(prices + [round(r.random()*0.1, 6), 0.0])
+    quantity = r.choice([3.0, 6.0, 9.0, round(r.random()*6, 3)])
+    if role == 'none-participant':
+      price, quantity = 0, 0
+    bids.append([price, quantity, r.random() < 0.7, role, round(r.random()*2, 3), 'F0_house_A{}'.format(i), r.random() < 0.3])
+  return {'lmp': r.choice([0.02, 0.025, 0.03, round(r.random()*0.06, 6)]),
+          'capacity': r.choice([0.0, 3.0, 10.0, 100.0, round(r.random()*200, 3)]), 'bids': bids}
+
+
+def same(a, b):
+  return a == b or (a != a and b != b) # NaN equals NaN here
+
+
+def check(corpus, engines):
+  """ returns the list of (case index, engine, output, expected, got) that differ"""
+  failures = []
+  for k, case in enumerate(corpus['cases']):
+    for engine in engines:
+      got = clear_case(case, engine)
+      for name, expected in case['expected'].items():
+        if name not in got or not same(expected, got[name]):
+          failures.append((k, engine, name, expected, got.get(name)))
+      for name in got.keys() - case['expected'].keys():
+        failures.append((k, engine, name, None, got[name]))
+  return failures
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='checks the clearing engines against a golden corpus')
+  parser.add_argument('--corpus', default=CORPUS_PATH)
+  parser.add_argument('--engines', nargs='+', default=['loop', 'vectorized'])
+  parser.add_argument('--record', action='store_true', help='write a new corpus with the loop engine outputs')
+  parser.add_argument('--cases', type=int, default=300)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  if args.record:
+    r = random.Random(args.seed)
+    cases = [random_case(r) for i in range(args.cases)]
+    for case in cases:
+      case['expected'] = clear_case(case, 'loop')
+    with open(args.corpus, 'w', encoding='utf-8') as f:
+      json.dump({'seed': args.seed, 'engine': 'loop', 'outputs': OUTPUTS, 'cases': cases}, f)
+    print('recorded', len(cases), 'cases to', args.corpus)
+    sys.exit(0)
+
+  with open(args.corpus, encoding='utf-8') as f:
+    corpus = json.load(f)
+  failures = check(corpus, args.engines)
+  for k, engine, name, expected, got in failures[:20]:
+    print('case {} engine {}: {} expected {} got {}'.format(k, engine, name, expected, got))
+  print(len(corpus['cases']), 'cases,', len(failures), 'differences,', ', '.join(args.engines))
+  sys.exit(1 if failures else 0)
@@ -0,0 +1,83 @@
+# file: compare_lookahead.py
+"""
+Function:
+        checks that a run with lookahead (output/input delay of the substation) is equivalent to a lockstep run
+        for every series of the experiment store, the lag (in state updates) that best aligns the two runs is
+        searched; the lag must not exceed the delay of the run and the aligned series must agree within the
+        tolerance. Market series and bids are compared interval by interval.
+usage:  python compare_lookahead.py <lockstep data path> <lookahead data path> --delay SECONDS [--rtol 0.05]
+        exits with 1 if a series is not equivalent, so it can be used as a test on two scenario folders of
+        run_scenarios.py (for example a grid {"lookahead": [0, 1]})
+"""
+
+import os
+import sys
+import math
+import argparse
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fed_substation'))
+from experiment_store import EXPERIMENT
+
+
+def best_lag(base, other, max_lag):
+  """ lag k (0..max_lag) minimizing the RMS difference of other[k:] and base[:-k], and that difference"""
+  best = (0, math.inf)
+  for k in range(0, max_lag + 1):
+    n = min(len(base), len(other) - k)
+    if n <= 0:
+      break
+    rms = float(np.sqrt(np.nanmean((other[k:k+n] - base[:n])**2)))
+    if rms < best[1]:
+      best = (k, rms)
+  return best
+
+
+def compare_runs(base_path, other_path, delay, rtol = 0.05, search = 10):
+  """ compares the stores of two runs, returns one row per series and whether all are equivalent"""
+  base, other = EXPERIMENT(base_path), EXPERIMENT(other_path)
+  hours = base.time('system')
+  sample_seconds = float(np.median(np.diff(hours))) * 3600 if len(hours) > 1 else 1.0
+  allowed_lag = int(math.ceil(delay / sample_seconds)) # the controls lag the measurements by the delay at most
+  rows = []
+  for name in base.series_names():
+    if name not in other.manifest['series']:
+      continue
+    index = base.manifest['series'][name]['index']
+    a = np.asarray(base.series(name)[1], dtype=np.float64)
+    b = np.asarray(other.series(name)[1], dtype=np.float64)
+    scale = max(float(np.nanmax(np.abs(a))) if len(a) > 0 else 0.0, 1e-9)
+    if index == 'system':
+      lag, rms = best_lag(a, b, allowed_lag + search)
+    else: # market intervals are aligned by the clearing time, no lag
+      n = min(len(a), len(b))
+      lag, rms = 0, float(np.sqrt(np.nanmean((a[:n] - b[:n])**2))) if n > 0 else 0.0
+    ok = lag <= allowed_lag and rms <= rtol * scale
+    rows.append({'series': name, 'index': index, 'lag': lag, 'allowed_lag': allowed_lag if index == 'system' else 0,
+                 'rms': rms, 'relative_rms': rms / scale, 'ok': ok})
+
+  # roles of the bids, the fraction of house intervals where the two runs agree
+  bids_a = base.bids(fields=['role'])[:, :, 0]
+  bids_b = other.bids(fields=['role'])[:, :, 0]
+  n = min(bids_a.shape[1], bids_b.shape[1])
+  if n > 0:
+    agreement = float(np.mean(bids_a[:, :n] == bids_b[:, :n]))
+    rows.append({'series': 'bid_role', 'index': 'auction', 'lag': 0, 'allowed_lag': 0, 'rms': 1 - agreement,
+                 'relative_rms': 1 - agreement, 'ok': 1 - agreement <= rtol})
+  return rows, all(row['ok'] for row in rows)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='compare a lookahead run with a lockstep run of the same case')
+  parser.add_argument('base', help='data path of the lockstep run')
+  parser.add_argument('other', help='data path of the run with lookahead')
+  parser.add_argument('--delay', type=float, required=True, help='output plus input delay of the lookahead run in seconds')
+  parser.add_argument('--rtol', type=float, default=0.05, help='largest RMS difference relative to the series magnitude')
+  args = parser.parse_args()
+
+  rows, equivalent = compare_runs(args.base, args.other, args.delay, args.rtol)
+  print('{:<25} {:<8} {:>4} {:>8} {:>12} {:>6}'.format('series', 'index', 'lag', 'allowed', 'relative rms', ''))
+  for row in rows:
+    print('{:<25} {:<8} {:>4} {:>8} {:>12.4f} {:>6}'.format(row['series'], row['index'], row['lag'], row['allowed_lag'],
+                                                          row['relative_rms'], 'ok' if row['ok'] else 'FAIL'))
+  print('equivalent' if equivalent else 'NOT equivalent')
+  sys.exit(0 if equivalent else 1)
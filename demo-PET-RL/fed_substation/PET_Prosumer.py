@@ -11,7 +11,26 @@ import my_tesp_support_api.helpers as helpers
 import math
 import random
 import helics
+import numpy as np
 from collections import deque
+from house_population import PopulationField
+from basepoint_schedule import schedule_of, minute_of_day
+
+
+def publish_double(publisher, pub, value):
+    # publish through the publication cache if the device has one, otherwise directly
+    if publisher is None:
+        helics.helicsPublicationPublishDouble(pub, value)
+    else:
+        publisher.publish_double(pub, value)
+
+
+def publish_string(publisher, pub, value):
+    if publisher is None:
+        helics.helicsPublicationPublishString(pub, value)
+    else:
+        publisher.publish_string(pub, value)
+
 
 class HVAC:
     """This agent manages thermostat setpoint and bidding for a house
@@ -57,6 +76,21 @@ class HVAC:
         bid_price (float): the current bid price in $/kwh
         cleared_price (float): the cleared market price in $/kwh
     """
+    # state attributes that become views on a HousePopulation once the house is bound
+    air_temp = PopulationField('air_temp')
+    hvac_kw = PopulationField('hvac_kw')
+    hvac_on = PopulationField('hvac_on')
+    power_needed = PopulationField('power_needed')
+    basepoint = PopulationField('basepoint')
+    fix_basepoint = PopulationField('fix_basepoint')
+    setpoint = PopulationField('setpoint')
+    offset = PopulationField('offset')
+    probability = PopulationField('probability')
+    MTTR_now = PopulationField('MTTR_now')
+    energyMarket = PopulationField('energyMarket')
+    energy_cumulated = PopulationField('energy_cumulated')
+    last_update_time = PopulationField('last_update_time')
+
     def __init__(self,name,dict,aucObj):
         """Initializes the class
         """
@@ -78,6 +112,8 @@ class HVAC:
         self.weekend_day_set = float(dict['weekend_day_set'])
         self.weekend_night_start = float(dict['weekend_night_start'])
         self.weekend_night_set = float(dict['weekend_night_set'])
+        # the schedule above compiled into a [day_of_week, minute_of_day] period table, shared by the HVACs with the same start hours
+        self.schedule_periods, self.schedule_sets = schedule_of(self)
         self.deadband = float(dict['deadband'])
         self.offset_limit = float(dict['offset_limit'])
         self.ramp = float(dict['ramp'])
@@ -108,6 +144,7 @@ class HVAC:
 
         # PEM related
         self.update_period = 1 # the time interval that the energy meter measures its load, update state
+        self.last_update_time = 0 # time of the previous state update (unit: s)
         self.market_period = aucObj.period
         self.energyMarket = 0    # energy consumed within market period
         self.energy_cumulated = 0           # energy consumed in the co-simulation
@@ -129,6 +166,7 @@ class HVAC:
         # publications and subscriptions
         self.subs = None
         self.pubs = None
+        self.publisher = None # PUBLICATION_CACHE shared by the house, None means publish every call
 
 
     def get_helics_subspubs(self,input):
@@ -224,12 +262,12 @@ class HVAC:
 
 
     def turn_ON(self):
-        helics.helicsPublicationPublishString(self.pubs['pubThermostatState'], "COOL")
+        publish_string(self.publisher, self.pubs['pubThermostatState'], "COOL")
         self.hvac_on = True
 
 
     def turn_OFF(self):
-        helics.helicsPublicationPublishString(self.pubs['pubThermostatState'], "OFF")
+        publish_string(self.publisher, self.pubs['pubThermostatState'], "OFF")
         self.hvac_on = False
 
     def monitor_packet_length(self):
@@ -239,8 +277,10 @@ class HVAC:
                 self.packet_delivered = True
                 self.turn_OFF()
 
-    def update_energyMarket(self):
-        dEnergy = self.hvac_kw*self.update_period/3600
+    def update_energyMarket(self, time_now):
+        # the load of the previous update ran until now, more than update_period when the substation only wakes on input
+        dEnergy = self.hvac_kw*(time_now - self.last_update_time)/3600
+        self.last_update_time = time_now
         self.energyMarket += dEnergy
         self.energy_cumulated += dEnergy
 
@@ -317,18 +357,7 @@ class HVAC:
             Boolean: True if the setting changed, Falso if not
         """
         if not self.fix_basepoint:
-            if dow > 4: # a weekend
-                val = self.weekend_night_set
-                if hod >= self.weekend_day_start and hod < self.weekend_night_start:
-                    val = self.weekend_day_set
-            else: # a weekday
-                val = self.night_set
-                if hod >= self.wakeup_start and hod < self.daylight_start:
-                    val = self.wakeup_set
-                elif hod >= self.daylight_start and hod < self.evening_start:
-                    val = self.daylight_set
-                elif hod >= self.evening_start and hod < self.night_start:
-                    val = self.evening_set
+            val = self.schedule_sets[self.schedule_periods[dow, minute_of_day(hod)]]
             if abs(self.basepoint - val) > 0.1:
                 self.basepoint = val
 
@@ -336,6 +365,9 @@ class HVAC:
 
 
 class PV:
+    solar_kw = PopulationField('solar_kw')
+    solarDC_Vout = PopulationField('solarDC_Vout')
+    solarDC_Iout = PopulationField('solarDC_Iout')
 
     def __init__(self,name,dict,aucObj):
         self.name = name
@@ -349,6 +381,7 @@ class PV:
 
         self.pubs = None
         self.subs = None
+        self.publisher = None
 
     def get_state(self,solar_kw, solarDC_Vout, solarDC_Iout):
         self.solar_kw = solar_kw
@@ -356,13 +389,17 @@ class PV:
         self.solarDC_Iout = solarDC_Iout
 
     def PQ_control(self, P, Q):
-        helics.helicsPublicationPublishDouble (self.pubs['pubPVPout'], P*1000)
-        helics.helicsPublicationPublishDouble (self.pubs['pubPVQout'], Q*1000)
+        publish_double(self.publisher, self.pubs['pubPVPout'], P*1000)
+        publish_double(self.publisher, self.pubs['pubPVQout'], Q*1000)
 
 
 
 
 class BATTERY:
+    battery_kw = PopulationField('battery_kw')
+    battery_SoC = PopulationField('battery_SoC')
+    unres_kw = PopulationField('unres_kw')
+
     def __init__(self,name,dict,aucObj):
 
         self.name = name
@@ -384,6 +421,7 @@ class BATTERY:
 
         self.pubs = None
         self.subs = None
+        self.publisher = None
 
     def get_state(self, battery_kw, battery_SoC, unres_kw):
         self.battery_kw = battery_kw
@@ -398,16 +436,33 @@ class BATTERY:
         self.discharge_on_threshold = self.unres_kw*1000 + self.discharge_on_threshold_offset
         self.discharge_off_threshold = self.unres_kw*1000 + self.discharge_off_threshold_offset
 
-        helics.helicsPublicationPublishDouble (self.pubs['pubCharge_on_threshold'], self.charge_on_threshold)
-        helics.helicsPublicationPublishDouble (self.pubs['pubCharge_off_threshold'], self.charge_off_threshold)
-        helics.helicsPublicationPublishDouble (self.pubs['pubDischarge_on_threshold'], self.discharge_on_threshold)
-        helics.helicsPublicationPublishDouble (self.pubs['pubDischarge_off_threshold'], self.discharge_off_threshold)
+        publish_double(self.publisher, self.pubs['pubCharge_on_threshold'], self.charge_on_threshold)
+        publish_double(self.publisher, self.pubs['pubCharge_off_threshold'], self.charge_off_threshold)
+        publish_double(self.publisher, self.pubs['pubDischarge_on_threshold'], self.discharge_on_threshold)
+        publish_double(self.publisher, self.pubs['pubDischarge_off_threshold'], self.discharge_off_threshold)
 
 
 class HOUSE:
     """ HOME class
 
     """
+    # measurements and predictions that become views on a HousePopulation once the house is bound
+    mtr_voltage = PopulationField('mtr_voltage')
+    mtr_power = PopulationField('mtr_power')
+    house_kw = PopulationField('house_kw')
+    solar_kw = PopulationField('solar_kw')
+    battery_kw = PopulationField('battery_kw')
+    unres_kw = PopulationField('unres_kw')
+    hvac_kw = PopulationField('hvac_kw')
+    hvac_on = PopulationField('hvac_on')
+    air_temp = PopulationField('air_temp')
+    solarDC_Vout = PopulationField('solarDC_Vout')
+    solarDC_Iout = PopulationField('solarDC_Iout')
+    battery_SoC = PopulationField('battery_SoC')
+    time_now = PopulationField('time_now')
+    house_load_predict = PopulationField('house_load_predict')
+    solar_power_predict = PopulationField('solar_power_predict')
+
     def __init__(self, name, info, agents_dict, aucObj, seed):
 
         # house related
@@ -472,24 +527,37 @@ class HOUSE:
         self.rl_agent_buyer = None
         self.current_rl_agent_role = 'rl-ntcp' # 'rl-ntcp', 'rl-seller' , 'rl-buyer'
         self.self_info = {}
+        self.timer = None # PHASE_TIMER of the substation, times the RL learning separately from the bid formulation
 
         self.pubs = None
         self.subs = None
+        self.publisher = None
 
-    def get_helics_subspubs(self,input):
+    def get_helics_subspubs(self,input, publisher = None):
+        """ Gets the subscriptions and publications of the house
+
+        Args:
+            input (tuple): (subs, pubs) dicts from FEDERATE_HELPER.get_agent_pubssubs
+            publisher (PUBLICATION_CACHE): publication cache that suppresses unchanged values,
+                if None, every call publishes to HELICS
+        """
         self.subs = input[0]
         self.pubs = input[1]
+        self.publisher = publisher
 
         # share the pubs and subs to all devices
         self.hvac.subs = input[0]
         self.hvac.pubs = input[1]
+        self.hvac.publisher = publisher
         if self.hasBatt:
             self.battery.subs = input[0]
             self.battery.pubs = input[1]
+            self.battery.publisher = publisher
 
         if self.hasPV:
             self.pv.subs = input[0]
             self.pv.pubs = input[1]
+            self.pv.publisher = publisher
 
     def set_meter_mode(self):
         helics.helicsPublicationPublishString (self.pubs['pubMtrMode'], 'HOURLY')
@@ -532,8 +600,8 @@ class HOUSE:
         # str = helics.helicsInputGetString (self.subs['subState'])
         self.hvac_on = self.hvac.hvac_on
 
+        self.hvac.update_energyMarket(self.time_now) # measured the energy consumed during the market period
         self.hvac.get_state(self.air_temp, self.hvac_kw) # state update for control
-        self.hvac.update_energyMarket() # measured the energy consumed during the market period
 
 
         # for unresponsive load ==================
@@ -599,7 +667,7 @@ class HOUSE:
         self.cleared_price_window.append(self.cleared_price)
 
     def publish_meter_price(self):
-        helics.helicsPublicationPublishDouble (self.pubs['pubMtrPrice'], self.cleared_price)
+        publish_double(self.publisher, self.pubs['pubMtrPrice'], self.cleared_price)
 
 
     def getSelfInformation(self): # used to generate the observation for RL agent
@@ -627,12 +695,16 @@ class HOUSE:
         if self.rl_env:
             self.rl_env.getObservation(self.auction_info, self.getSelfInformation())
             last_rl_agent_role = self.current_rl_agent_role
+            if self.timer is not None:
+                self.timer.begin('rl_learning')
             if last_rl_agent_role == 'rl-seller' and self.rl_env.transition_seller:
                 self.rl_agent_seller.save_transition(self.rl_env.transition_seller)
                 self.rl_agent_seller.learn()
             if last_rl_agent_role == 'rl-buyer' and self.rl_env.transition_buyer:
                 self.rl_agent_buyer.save_transition(self.rl_env.transition_buyer)
                 self.rl_agent_buyer.learn()
+            if self.timer is not None:
+                self.timer.end()
 
         self.bid.clear()
         diff = self.solar_power_predict - self.house_load_predict # estimated the surplus solar generation
@@ -775,10 +847,11 @@ class HOUSE:
 
 
 class VPP:
-    def __init__(self, name, enable = True):
+    def __init__(self, name, enable = True, seed = None):
 
         self.name = name
         self.enable = enable
+        self.rng = np.random.default_rng(seed) # random arrival order of the requests
 
         self.vpp_load_p = 0 # kVA
         self.balance_signal = 220 # kVA
@@ -807,22 +880,37 @@ class VPP:
                 for i in range(len(self.response_list)):
                     self.response_list[i]['response'] = 'YES'
             else:
-                arrive_idx_list = list(range(len(self.response_list)))
-                random.shuffle(arrive_idx_list) # randomize the arrive time
-                load_est = self.vpp_load_p
-
-                for idx in arrive_idx_list:
-                    response = self.response_list[idx]
-                    key = response['name']
-                    load = response['power']
-                    length = response['packet-length']
-                    load_est += load
-                    if (self.balance_signal - load_est) >= 0:
-                        self.response_list[idx]['response'] = 'YES'
-                    else:
-                        self.response_list[idx]['response'] = 'NO'
+                power = np.array([response['power'] for response in self.response_list], dtype=np.float64)
+                accepted, rejected = self.admit(np.arange(len(power)), power)
+                for idx in accepted:
+                    self.response_list[idx]['response'] = 'YES'
+                for idx in rejected:
+                    self.response_list[idx]['response'] = 'NO'
         self.request_list.clear()
 
+    def admit(self, house_idx, power, urgency = None):
+        """ Admits requests in random arrival order while the VPP load stays within the balance signal
+
+        Every request adds its power to the load estimate, so the accepted requests are the longest
+        prefix of the arrival order whose cumulative load fits the balance signal.
+
+        Args:
+            house_idx (np.ndarray): index of each requesting house
+            power (np.ndarray): packet power of each request in kW
+            urgency (np.ndarray): requests with a higher urgency arrive first, None for random order only
+
+        Returns:
+            (np.ndarray, np.ndarray): house indices of the accepted and of the rejected requests
+        """
+        num_requests = len(house_idx)
+        if urgency is None:
+            order = self.rng.permutation(num_requests) # randomize the arrive time
+        else:
+            order = np.lexsort((self.rng.random(num_requests), -np.asarray(urgency)))
+        load_est = self.vpp_load_p + np.cumsum(np.asarray(power, dtype=np.float64)[order])
+        num_accepted = np.searchsorted(load_est, self.balance_signal, side='right')
+        return house_idx[order[:num_accepted]], house_idx[order[num_accepted:]]
+
 
     def get_vpp_load(self):
 
@@ -0,0 +1,129 @@
+# file: broker_topology.py
+"""Layout of the HELICS brokers of a co-simulation.
+
+In the flat layout every federate connects to one helics_broker, which then
+routes all messages and time requests. In the hierarchical layout a root
+broker only connects sub-brokers, one per group of co-located federates
+(e.g. a feeder: GridLAB-D, its substation and the shard workers), so the
+traffic inside a group stays in its sub-broker and the root only sees the
+traffic between groups.
+
+The federates find their broker through the coreinit of their HELICS config
+(--brokerport=<port>, as written by run_scenarios.py), the configs are
+rewritten for the chosen layout before the federates are launched.
+"""
+import json
+import socket
+from federate_supervisor import FEDERATE_SPEC
+
+DEFAULT_BROKER_PORT = 23404 # HELICS default port of the zmq broker
+LAYOUTS = ['flat', 'hierarchical']
+
+
+def port_pair_free(port):
+    # the zmq broker listens on port and port + 1
+    for p in [port, port + 1]:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            try:
+                s.bind(('127.0.0.1', p))
+            except OSError:
+                return False
+    return True
+
+
+def point_to_broker(config_path, port):
+    """Sets the broker port in the coreinit of a HELICS config, None for the default broker
+    """
+    with open(config_path, encoding='utf-8') as f:
+        config = json.load(f)
+    coreinit = config.get('coreinit', '')
+    if port is None:
+        if not coreinit.startswith('--brokerport='):
+            return
+        config.pop('coreinit')
+    else:
+        if coreinit == '--brokerport={}'.format(port):
+            return
+        config['coreinit'] = '--brokerport={}'.format(port)
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+
+
+class BROKER_TOPOLOGY:
+    """The brokers of one co-simulation and the broker of every federate
+
+    Args:
+        layout (str): 'flat' or 'hierarchical'
+        broker_name (str): name of the (root) broker, the sub-brokers are named <broker_name>_<group>
+        broker_port (int): port of the (root) broker, None for the HELICS default
+        cwd (str): working directory of the broker processes, their logs are written there
+        port_limit (int): the sub-brokers use ports below port_limit only, None for no limit; run_scenarios.py
+            gives every scenario a block of ports [broker_port, port_limit) sized for its layout
+
+    Attributes:
+        groups (dict): names of the federates of every group, in the hierarchical layout
+        ports (dict): broker port of every group
+    """
+    def __init__(self, layout = 'flat', broker_name = 'mainbroker', broker_port = None, cwd = '.', port_limit = None):
+        if layout not in LAYOUTS:
+            raise ValueError('unknown broker layout {}, expected one of {}'.format(layout, LAYOUTS))
+        self.layout = layout
+        self.broker_name = broker_name
+        self.broker_port = broker_port
+        self.cwd = cwd
+        self.port_limit = port_limit
+        self.groups = {}
+        self.ports = {}
+
+    def broker_specs(self, members, loglevel = 1):
+        """Assigns the federates to brokers, points their HELICS configs to them and returns the broker processes
+
+        Args:
+            members ([(str, str, str)]): name, group and HELICS config path of every federate of the
+                co-simulation. Federates without a config (None) or a group (None) connect to the root broker.
+
+        Returns:
+            [FEDERATE_SPEC]: the brokers to launch, the root broker first
+        """
+        root_args = ['helics_broker', '-f', str(len(members)), '--loglevel={}'.format(loglevel), '--name={}'.format(self.broker_name)]
+        if self.broker_port is not None:
+            root_args.append('--port={}'.format(self.broker_port))
+        if self.layout == 'flat':
+            for name, group, config in members:
+                if config is not None:
+                    point_to_broker(config, self.broker_port)
+            return [FEDERATE_SPEC('helics_broker', root_args, self.cwd, 'helics_broker.log')]
+
+        self.groups = {}
+        for name, group, config in members:
+            if group is not None and config is not None:
+                self.groups.setdefault(group, []).append((name, config))
+        root_args.append('--minbrokers={}'.format(len(self.groups)))
+        specs = [FEDERATE_SPEC('helics_broker', root_args, self.cwd, 'helics_broker.log')]
+        root_port = self.broker_port or DEFAULT_BROKER_PORT
+        port = root_port + 2
+        for group, federates in self.groups.items():
+            while not port_pair_free(port):
+                port += 2
+            if self.port_limit is not None and port + 1 >= self.port_limit:
+                raise ValueError('no free port pair below {} for the sub-broker of {}, the port block is used up'.format(self.port_limit, group))
+            self.ports[group] = port
+            specs.append(FEDERATE_SPEC('broker_' + group, ['helics_broker', '-f', str(len(federates)), '--loglevel={}'.format(loglevel),
+                                       '--name={}_{}'.format(self.broker_name, group), '--port={}'.format(port),
+                                       '--broker_address=tcp://127.0.0.1', '--brokerport={}'.format(root_port)],
+                                       self.cwd, 'helics_broker_{}.log'.format(group)))
+            for name, config in federates:
+                point_to_broker(config, port)
+            port += 2
+        for name, group, config in members:
+            if group is None and config is not None: # ungrouped federates connect to the root broker
+                point_to_broker(config, self.broker_port)
+        return specs
+
+    def show(self):
+        if self.layout == 'flat':
+            print('HELICS broker: flat, port {}'.format(self.broker_port or DEFAULT_BROKER_PORT))
+            return
+        print('HELICS brokers: root port {}, {} sub-brokers'.format(self.broker_port or DEFAULT_BROKER_PORT, len(self.groups)))
+        for group, federates in self.groups.items():
+            print('  {:<12} port {:<6} {}'.format(group, self.ports[group], ', '.join(name for name, config in federates)))
@@ -0,0 +1,171 @@
+# file: checkpoint.py
+"""Checkpoints of the substation-side state of a co-simulation.
+
+A checkpoint holds the state of the HOUSE (with its HVAC, PV, BATTERY,
+BIDING_ENV and DDPG agents), AUCTION, VPP and CURVES_TO_PLOT objects, the
+house population, the scheduler, the phase timer, the random number
+generators (random, numpy and torch) and the offsets of the streamed output
+files. The objects are walked attribute by attribute:
+    - the HELICS wiring (subs, pubs, publisher, timer, ...) is not saved, it comes from the new run
+    - attributes stored in the house population columns are saved with the population
+    - torch modules and optimizers are saved with their state_dict, the replay buffers as they are
+    - objects with checkpoint_state/restore_checkpoint methods save themselves
+Resuming builds the case as usual and then restores the saved state into the
+new objects, so a checkpoint only works with the case it was written for.
+
+A checkpoint is written to a temporary file, fsynced and renamed, a crash
+while writing leaves the previous checkpoint intact.
+"""
+import os
+import sys
+import glob
+import pickle
+import random
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+# attributes that connect the objects to HELICS or to the run, they are set up again on resume
+WIRING = {'subs', 'pubs', 'publisher', 'timer', '_population', '_population_idx'}
+
+
+def capture_state(obj):
+    """Returns the saved state of obj, a dict of attribute values
+    """
+    if hasattr(obj, 'checkpoint_state'):
+        return {'__checkpoint__': obj.checkpoint_state()}
+    state = {}
+    owner = type(obj)
+    for key, value in vars(obj).items():
+        if key in WIRING or hasattr(getattr(owner, key, None), '__set__'): # the population columns are saved by the population
+            continue
+        if hasattr(value, 'state_dict') and hasattr(value, 'load_state_dict'): # torch module or optimizer
+            state[key] = ('state_dict', value.state_dict())
+        elif hasattr(value, '__dict__') and not callable(value):
+            state[key] = ('object', capture_state(value))
+        else:
+            state[key] = ('value', value)
+    return state
+
+
+def restore_state(obj, state):
+    """Writes a state returned by capture_state back into obj
+    """
+    if '__checkpoint__' in state:
+        obj.restore_checkpoint(state['__checkpoint__'])
+        return
+    for key, (kind, value) in state.items():
+        if kind == 'value':
+            setattr(obj, key, value)
+            continue
+        target = getattr(obj, key, None)
+        if target is None:
+            raise ValueError('checkpoint has {} of {} which this run does not create'.format(key, type(obj).__name__))
+        if kind == 'state_dict':
+            target.load_state_dict(value)
+        else:
+            restore_state(target, value)
+
+
+def rng_state():
+    state = {'random': random.getstate(), 'numpy': np.random.get_state()}
+    torch = sys.modules.get('torch') # only if the RL agents are used
+    if torch is not None:
+        state['torch'] = torch.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch = sys.modules.get('torch')
+    if torch is not None and 'torch' in state:
+        torch.set_rng_state(state['torch'])
+
+
+class SUBSTATION_CHECKPOINT:
+    """Writes and reads the checkpoints of the substation federate
+
+    Args:
+        path (str): folder of the checkpoint files
+        keep (int): number of checkpoints kept, the older ones are removed
+
+    Attributes:
+        num_saved (int): number of checkpoints written by this run
+    """
+    def __init__(self, path, keep = 2):
+        self.path = path
+        self.keep = keep
+        self.num_saved = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def file_name(self, time_granted):
+        return os.path.join(self.path, 'checkpoint_{:010d}.pkl'.format(int(time_granted)))
+
+    def save(self, time_granted, objects, loop = None):
+        """Writes one checkpoint
+
+        Args:
+            time_granted (int): simulation time of the checkpoint in seconds, all phases due until then have run
+            objects (dict): the objects to save, keyed by the name used on restore
+            loop (dict): other values of the substation loop, returned as they are by load
+
+        Returns:
+            str: path of the checkpoint file
+        """
+        state = {'version': CHECKPOINT_VERSION, 'time': int(time_granted), 'rng': rng_state(), 'loop': loop or {},
+                 'objects': {name: capture_state(obj) for name, obj in objects.items()}}
+        path = self.file_name(time_granted)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path) # atomic, the file is either the old or the complete new checkpoint
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY) # make the rename itself durable
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.num_saved += 1
+        for old in self.files()[:-self.keep]:
+            os.remove(old)
+        return path
+
+    def files(self):
+        # complete checkpoint files, oldest first
+        return sorted(glob.glob(os.path.join(self.path, 'checkpoint_*.pkl')))
+
+    def latest(self):
+        files = self.files()
+        return files[-1] if len(files) > 0 else None
+
+    def load(self, path = None):
+        """Reads a checkpoint, the latest one if path is None
+
+        Returns:
+            dict: 'time', 'loop', 'rng' and 'objects' of the checkpoint, None if there is none
+        """
+        path = path or self.latest()
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError('checkpoint {} has version {}, expected {}'.format(path, state.get('version'), CHECKPOINT_VERSION))
+        return state
+
+    def restore(self, state, objects):
+        """Restores the objects and the random number generators from a loaded checkpoint
+
+        Args:
+            state (dict): checkpoint returned by load
+            objects (dict): the objects of the new run, with the same names as when saved
+        """
+        missing = set(state['objects'].keys()) - set(objects.keys())
+        if len(missing) > 0:
+            raise ValueError('checkpoint has objects {} which this run does not create'.format(sorted(missing)))
+        for name, obj_state in state['objects'].items():
+            restore_state(objects[name], obj_state)
+        set_rng_state(state['rng'])
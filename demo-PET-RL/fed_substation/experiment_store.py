@@ -0,0 +1,234 @@
+# file: experiment_store.py
+"""Columnar results store for one experiment directory.
+
+Every series recorded by CURVES_TO_PLOT is saved as one typed .npy array,
+tagged with the time index it belongs to ('system' for the state updates,
+'auction' for the market intervals). The house bids are one array shaped
+[house, interval, field], written interval by interval into a memory-mapped
+file during the simulation. A manifest.json describes all arrays, and the
+reader memory-maps them, so a series, a house or a time window can be
+selected without loading the rest.
+
+Layout of <data_path>/store/:
+    manifest.json
+    time_system.npy, time_auction.npy   time indexes in hours
+    <series>.npy                        one array per series
+    bids.npy                            [house, interval, field] float64
+
+Experiment directories written before the store existed (data.pkl and the
+metrics json files only) are converted by convert_legacy.
+"""
+import os
+import json
+import pickle
+import numpy as np
+
+BID_FIELDS = ['price', 'quantity', 'hvac_needed', 'role']
+ROLE_CODES = {'buyer': 1, 'seller': -1} # any other role (none-participant) is 0
+# series recorded once per market interval, the others are recorded at every state update
+AUCTION_SERIES = ['buyer_ratio', 'seller_ratio', 'nontcp_ratio', 'cleared_price', 'LMP']
+
+
+class EXPERIMENT_STORE:
+    """Writes the columnar store of an experiment
+
+    Args:
+        data_path (str): experiment directory, ending with '/'
+        house_names ([str]): names of the houses, row order of the bid array
+        num_intervals (int): number of market intervals of the simulation
+        market_period (int): market period in seconds
+        resume (bool): keep the bids already written to the store, used when resuming from a checkpoint
+
+    Attributes:
+        path (str): folder of the store
+        bids (np.memmap): the [house, interval, field] bid array on disk
+        manifest (dict): description of all arrays, written by close()
+    """
+    def __init__(self, data_path, house_names, num_intervals, market_period, resume = False):
+        self.path = os.path.join(data_path, 'store')
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.house_names = list(house_names)
+        self.house_index = {name: i for i, name in enumerate(self.house_names)}
+        self.market_period = market_period
+        self.num_intervals_recorded = 0
+
+        shape = (len(self.house_names), num_intervals, len(BID_FIELDS))
+        bids_path = os.path.join(self.path, 'bids.npy')
+        if resume and os.path.exists(bids_path):
+            self.bids = np.lib.format.open_memmap(bids_path, mode='r+')
+            if self.bids.shape != shape:
+                raise ValueError('bids.npy has shape {}, the resumed case needs {}'.format(self.bids.shape, shape))
+        else:
+            self.bids = np.lib.format.open_memmap(bids_path, mode='w+', dtype=np.float64, shape=shape)
+            self.bids[:] = np.nan # intervals that never ran stay NaN
+        self.manifest = {'version': 1, 'series': {}, 'time_index': {},
+                         'bids': {'file': 'bids.npy', 'houses': self.house_names, 'fields': BID_FIELDS,
+                                  'roles': ROLE_CODES, 'market_period': market_period}}
+
+    def record_bids(self, tclear, records):
+        """Writes the bids of one market interval
+
+        Args:
+            tclear (int): clearing time of the interval in seconds
+            records (dict): [bid_price, quantity, hvac_needed, role] keyed by house name
+        """
+        k = int(tclear // self.market_period) - 1
+        if k < 0 or k >= self.bids.shape[1]:
+            return
+        rows = np.empty((len(self.house_names), len(BID_FIELDS)))
+        rows[:] = np.nan
+        for name, bid in records.items():
+            rows[self.house_index[name]] = [bid[0], bid[1], float(bid[2]), ROLE_CODES.get(bid[3], 0)]
+        self.bids[:, k, :] = rows
+        self.num_intervals_recorded = max(self.num_intervals_recorded, k + 1)
+
+    def checkpoint_state(self):
+        self.bids.flush() # the bids written so far are on disk when the checkpoint is
+        return {'num_intervals_recorded': self.num_intervals_recorded}
+
+    def restore_checkpoint(self, state):
+        self.num_intervals_recorded = state['num_intervals_recorded']
+
+    def save_time_index(self, index, hours):
+        file = 'time_' + index + '.npy'
+        np.save(os.path.join(self.path, file), np.asarray(hours, dtype=np.float64))
+        self.manifest['time_index'][index] = {'file': file, 'length': len(hours)}
+
+    def save_series(self, name, values, index, dtype = np.float64):
+        """Saves one series on the given time index
+
+        Args:
+            name (str): name of the series, as the key in data.pkl
+            values (list): the values, one per entry of the time index
+            index (str): 'system' or 'auction'
+            dtype (np.dtype): type of the saved array
+        """
+        file = name + '.npy'
+        values = np.asarray(values, dtype=dtype)
+        np.save(os.path.join(self.path, file), values)
+        self.manifest['series'][name] = {'file': file, 'index': index, 'dtype': values.dtype.str, 'length': len(values)}
+
+    def close(self):
+        self.bids.flush()
+        self.manifest['bids']['shape'] = list(self.bids.shape)
+        self.manifest['bids']['intervals_recorded'] = self.num_intervals_recorded
+        del self.bids
+        with open(os.path.join(self.path, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=1)
+
+
+class EXPERIMENT:
+    """Memory-mapped reader of the columnar store of an experiment
+
+    Args:
+        data_path (str): experiment directory, ending with '/'
+
+    Attributes:
+        manifest (dict): the store manifest
+        house_names ([str]): row order of the bid array
+    """
+    def __init__(self, data_path):
+        self.path = os.path.join(data_path, 'store')
+        with open(os.path.join(self.path, 'manifest.json'), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self.house_names = self.manifest['bids']['houses']
+        self.house_index = {name: i for i, name in enumerate(self.house_names)}
+        self._arrays = {}
+
+    def _load(self, file):
+        if file not in self._arrays:
+            self._arrays[file] = np.load(os.path.join(self.path, file), mmap_mode='r')
+        return self._arrays[file]
+
+    def series_names(self):
+        return list(self.manifest['series'].keys())
+
+    def time(self, index):
+        # time index in hours, 'system' or 'auction'
+        return self._load(self.manifest['time_index'][index]['file'])
+
+    def _window(self, index, t0, t1):
+        # slice of the entries whose time (in hours) is in [t0, t1)
+        hours = self.time(index)
+        start = 0 if t0 is None else int(np.searchsorted(hours, t0, side='left'))
+        stop = len(hours) if t1 is None else int(np.searchsorted(hours, t1, side='left'))
+        return slice(start, stop)
+
+    def series(self, name, t0 = None, t1 = None):
+        """Returns a series, optionally only the entries with time in [t0, t1) hours
+
+        Returns:
+            (np.ndarray, np.ndarray): time in hours and the values, both memory-mapped
+        """
+        info = self.manifest['series'][name]
+        window = self._window(info['index'], t0, t1)
+        return self.time(info['index'])[window], self._load(info['file'])[window]
+
+    def bids(self, houses = None, fields = None, t0 = None, t1 = None):
+        """Returns the bids as an array shaped [house, interval, field]
+
+        Args:
+            houses ([str]): house names, all houses if None
+            fields ([str]): fields from BID_FIELDS, all fields if None
+            t0 (float): start of the window in hours, from the beginning if None
+            t1 (float): end of the window in hours (exclusive), to the end if None
+        """
+        bids = self._load(self.manifest['bids']['file'])
+        n = self.manifest['bids'].get('intervals_recorded', bids.shape[1])
+        clear_hours = (np.arange(n) + 1)*self.manifest['bids']['market_period']/3600 # interval k clears at (k+1) market periods
+        k0 = 0 if t0 is None else int(np.searchsorted(clear_hours, t0, side='left'))
+        k1 = n if t1 is None else int(np.searchsorted(clear_hours, t1, side='left'))
+        bids = bids[:, k0:k1, :]
+        if houses is not None:
+            bids = bids[[self.house_index[h] for h in houses]]
+        if fields is not None:
+            bids = bids[:, :, [BID_FIELDS.index(f) for f in fields]]
+        return bids
+
+
+def convert_legacy(data_path, market_period = 300, metrics_root = 'TE_ChallengeH'):
+    """Writes the columnar store of an experiment recorded before the store existed
+
+    The bids are taken from house_<root>_metrics.json. The series are taken from
+    data.pkl if the directory has one; otherwise only the auction series that the
+    metrics json files hold are saved (the cleared price and the buyer, seller and
+    none-participant ratios).
+
+    Args:
+        data_path (str): experiment directory, ending with '/'
+        market_period (int): market period in seconds the experiment ran with
+        metrics_root (str): root name of the metrics json files
+
+    Returns:
+        EXPERIMENT: reader of the new store
+    """
+    with open(os.path.join(data_path, 'house_' + metrics_root + '_metrics.json'), encoding='utf-8') as f:
+        house_metrics = json.load(f)
+    times = sorted(int(key) for key in house_metrics if key not in ('Metadata', 'StartTime'))
+    house_names = list(house_metrics[str(times[0])].keys()) if times else []
+    store = EXPERIMENT_STORE(data_path, house_names, int(times[-1] // market_period) if times else 0, market_period)
+    for t in times:
+        store.record_bids(t, house_metrics[str(t)])
+
+    pkl_path = os.path.join(data_path, 'data.pkl')
+    if os.path.exists(pkl_path):
+        with open(pkl_path, 'rb') as f:
+            data_dict = pickle.load(f)
+    else:
+        with open(os.path.join(data_path, 'auction_' + metrics_root + '_metrics.json'), encoding='utf-8') as f:
+            auction_metrics = json.load(f)
+        roles = np.array([[ROLE_CODES.get(house_metrics[str(t)][name][3], 0) for name in house_names] for t in times])
+        data_dict = {'time_hour_auction': [t/3600 for t in times], 'time_hour_system': [],
+                     'buyer_ratio': np.mean(roles == 1, axis=1), 'seller_ratio': np.mean(roles == -1, axis=1),
+                     'nontcp_ratio': np.mean(roles == 0, axis=1),
+                     'cleared_price': [list(auction_metrics[str(t)].values())[0][0] for t in times]}
+
+    store.save_time_index('system', data_dict['time_hour_system'])
+    store.save_time_index('auction', data_dict['time_hour_auction'])
+    for name, values in data_dict.items():
+        if name.startswith('time_hour_'):
+            continue
+        store.save_series(name, values, 'auction' if name in AUCTION_SERIES else 'system')
+    store.close()
+    return EXPERIMENT(data_path)
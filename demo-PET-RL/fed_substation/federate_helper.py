@@ -5,15 +5,27 @@ import sys
 import json
 import pickle
 import psutil
+import numpy as np
 from collections import deque
-import subprocess
+import signal
+from federate_supervisor import FEDERATE_SUPERVISOR, FEDERATE_SPEC
+from broker_topology import BROKER_TOPOLOGY
+from resource_sampler import RESOURCE_SAMPLER
+from experiment_store import AUCTION_SERIES
 if sys.platform != 'win32':
   import resource
 
 
 
 class FEDERATE_HELPER:
-    def __init__(self, configfile, helicsConfig, metrics_root, hour_stop):
+    # wake-on-input mode: an input only counts as updated (and interrupts the time request)
+    # when it moves by more than this, per INPUT_SNAPSHOT kind, 'feeder' and 'vpp' are the grid meters
+    WAKE_TOLERANCES = {'volt': 1.0, 'mtr_power': 100.0, 'house_power': 100.0, 'temp': 0.1, 'hvac_load': 0.1,
+                       'solar_power': 100.0, 'solar_vout': 1.0, 'solar_iout': 0.1, 'batt_power': 100.0,
+                       'batt_soc': 0.01, 'feeder': 1000.0, 'vpp': 1000.0}
+
+    def __init__(self, configfile, helicsConfig, metrics_root, hour_stop, wake_on_input = False,
+                 broker_port = None, broker_name = 'mainbroker'):
 
         self.configfile = configfile
         self.helicsConfig = helicsConfig
@@ -30,11 +42,25 @@ class FEDERATE_HELPER:
         self.duration = int(self.agents_dict['duration'])
         self.gldName = self.agents_dict['GridLABD']
         self.bulkName = 'pypower'
+        # LMP of the bus of this feeder, PyPower publishes one per DSO bus (see generate_feeders.py)
+        self.lmp_key = next((sub['key'] for sub in self.helics_config.get('subscriptions', []) if sub['key'].startswith(self.bulkName + '/LMP_')),
+                            self.bulkName + '/LMP_B7')
         self.hFed = None # the helics period is 15 seconds
         self.fedName = self.helics_config['name']
         self.is_destroyed = True
         self.pubCount = 0
         self.subCount = 0
+        self.wake_on_input = wake_on_input # the federate is granted early when a subscribed input changes
+        self.broker_port = broker_port # None for the HELICS default port
+        self.broker_name = broker_name
+        self.broker_layout = 'flat' # 'hierarchical' for a sub-broker per feeder, see broker_topology.py
+        self.broker_port_limit = None # the sub-brokers use ports below this one, None for no limit
+        self.broker_topology = None # BROKER_TOPOLOGY of the co-simulation, created by create_broker
+        self.case_root = os.path.abspath('..') # only federate processes started from this case folder are killed
+        # the federates of this case run in these folders, the scenarios of run_scenarios.py run under case_root/scenarios
+        self.case_folders = [os.path.join(self.case_root, folder) for folder in
+                             ('fed_substation', 'fed_gridlabd', 'fed_weather', 'fed_pypower', 'fed_energyplus', 'feeders')]
+        self.wake_tolerances = self.WAKE_TOLERANCES.copy()
 
         self.vpp_name_list = list(self.agents_dict['VPPs'].keys())
         self.house_name_list = list(self.agents_dict['houses'].keys())
@@ -121,33 +147,126 @@ class FEDERATE_HELPER:
         StartTime = '2013-07-01 00:00:00 -0800'
         self.auction_meta = {'clearing_price':{'units':'USD','index':0},'clearing_type':{'units':'[0..5]=[Null,Fail,Price,Exact,Seller,Buyer]','index':1},'consumer_surplus':{'units':'USD','index':2},'average_consumer_surplus':{'units':'USD','index':3},'supplier_surplus':{'units':'USD','index':4}}
         self.prosumer_meta = {'bid_price':{'units':'USD','index':0},'bid_quantity':{'units':unit,'index':1}, 'hvac_needed':{'units':unit,'index':2}, 'role':{'units':unit,'index':3}}
-        self.auction_metrics = {'Metadata':self.auction_meta,'StartTime':StartTime}
-        self.prosumer_metrics = {'Metadata':self.prosumer_meta,'StartTime':StartTime}
-
-        self.processes_list = []
-
-    def create_broker(self):
-        cmd0 = "helics_broker -f 6 --loglevel=1 --name=mainbroker >helics_broker.log 2>&1"
-        self.processes_list.append(subprocess.Popen(cmd0, stdout=subprocess.PIPE, shell=True))
+        self.metrics_root = metrics_root
+        self.start_time = StartTime
+        self.auction_sink = None # METRICS_SINK for the auction metrics, created by open_metrics
+        self.prosumer_sink = None # METRICS_SINK for the prosumer (house bid) metrics
+
+        self.supervisor = None # FEDERATE_SUPERVISOR of the broker and the other federates, created by create_broker
+        self.federate_wall_timeout = None # seconds, a federate running longer is stopped (None for no limit)
+        self.federate_idle_timeout = None # seconds, a federate writing nothing to its log for longer counts as hung
+        self.finishing = False
+        self.resource_sampler = None # RESOURCE_SAMPLER of all co-simulation processes, see start_resource_sampler
+        self.lookahead = 0 # seconds, output delay of the substation publications, see set_time_delays
+        self.input_delay = 0 # seconds, input delay of the substation subscriptions
+        self.extra_federates = [] # FEDERATE_SPEC of federates started with the others, e.g. the house shard workers
+
+        # houses whose HELICS interfaces this federate holds, the shard workers hold only their own houses
+        # and the coordinator of the shards none, see house_shards.py
+        self.local_house_names = list(self.house_name_list)
+        self.topic_root = self.fedName # publications of the houses are named <topic_root>/<object>/<property>
+        self.owns_grid = True # holds the market, grid and VPP interfaces
+
+        # publications of the house devices go through this cache, unchanged values are not sent again
+        self.pub_cache = PUBLICATION_CACHE()
+
+    def open_metrics(self, data_path, batch_size = 16, fsync_interval = 60.0, resume = None):
+        """Opens the streaming sinks for the auction and prosumer metrics
+
+        Records are appended to auction_<root>_metrics.jsonl and house_<root>_metrics.jsonl
+        in data_path while the simulation runs, finalize_metrics writes the legacy json files.
+
+        Args:
+            data_path (str): output folder, ending with '/'
+            batch_size (int): number of market intervals buffered before writing to the file
+            fsync_interval (float): minimum wall-clock seconds between two fsync calls
+            resume (dict): file offsets returned by metrics_offsets, the sinks continue from there
+        """
+        resume = resume or {}
+        self.auction_sink = METRICS_SINK(data_path + 'auction_' + self.metrics_root + '_metrics',
+                                         self.auction_meta, self.start_time, batch_size, fsync_interval,
+                                         resume.get('auction'))
+        self.prosumer_sink = METRICS_SINK(data_path + 'house_' + self.metrics_root + '_metrics',
+                                          self.prosumer_meta, self.start_time, batch_size, fsync_interval,
+                                          resume.get('prosumer'))
+
+    def metrics_offsets(self):
+        # writes out the buffered metrics records, returns where the sinks continue after a resume
+        return {'auction': self.auction_sink.sync_offset(), 'prosumer': self.prosumer_sink.sync_offset()}
+
+    def finalize_metrics(self):
+        # close the sinks and convert the streamed records into the single-object json files
+        for sink in [self.auction_sink, self.prosumer_sink]:
+            if sink is not None:
+                sink.finalize()
+
+    def create_broker(self, specs = ()):
+        """Launches the broker(s) of the co-simulation and points the HELICS configs of the federates to them
+
+        Args:
+            specs ([FEDERATE_SPEC]): the other federates of the co-simulation, their broker_group and helics_config
+                place them in the broker topology
+        """
+        self.supervisor = FEDERATE_SUPERVISOR(on_failure=self.on_federate_failure)
+        # several co-simulations can run on one host, each with its own broker port
+        self.broker_topology = BROKER_TOPOLOGY(self.broker_layout, self.broker_name, self.broker_port, os.getcwd(),
+                                               self.broker_port_limit)
+        members = [(self.fedName, 'feeder1', self.helicsConfig)] + [(spec.name, spec.broker_group, spec.helics_config) for spec in specs]
+        self.supervisor.launch(*self.broker_topology.broker_specs(members))
+        self.broker_topology.show()
         print("HELICS broker created!")
 
     def create_federate(self):
         self.hFed = helics.helicsCreateValueFederateFromConfig(self.helicsConfig) # the helics period is 15 seconds
+        if self.lookahead > 0 or self.input_delay > 0:
+            self.set_time_delays(self.lookahead, self.input_delay)
+
+    def set_shard(self, house_names, topic_root):
+        """Makes this helper the one of a house shard worker
+
+        Args:
+            house_names ([str]): the houses of the shard, the federate holds only their interfaces
+            topic_root (str): name of the substation federate, the shard publishes under this name
+        """
+        self.local_house_names = list(house_names)
+        self.topic_root = topic_root
+        self.owns_grid = False
+
+    def set_time_delays(self, lookahead, input_delay = 0):
+        """Lets the substation and the other federates compute at the same time
+
+        Without delays the substation and GridLAB-D alternate: each one waits while the other computes.
+        With an output delay (lookahead) the values published by the substation at t take effect at
+        t + lookahead, so HELICS grants GridLAB-D up to t + lookahead while the substation still computes
+        at t. With an input delay the substation reads the measurements of t - input_delay, so it can be
+        granted t before GridLAB-D finished t. Either way the controls lag the measurements by the delay,
+        compare_lookahead.py bounds that lag against a run without delays.
+
+        Args:
+            lookahead (float): output delay of the publications in seconds
+            input_delay (float): input delay of the subscriptions in seconds
+        """
+        if lookahead > 0:
+            helics.helicsFederateSetTimeProperty(self.hFed, helics.helics_property_time_output_delay, lookahead)
+        if input_delay > 0:
+            helics.helicsFederateSetTimeProperty(self.hFed, helics.helics_property_time_input_delay, input_delay)
 
     def register_pubssubs(self):
         self.pubCount = helics.helicsFederateGetPublicationCount(self.hFed)
         self.subCount = helics.helicsFederateGetInputCount(self.hFed)
 
-        self.subFeeder = helics.helicsFederateGetSubscription (self.hFed, self.gldName + '/distribution_load')
-        self.subLMP = helics.helicsFederateGetSubscription (self.hFed, self.bulkName + '/LMP_B7')
-        self.pubC1 = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/responsive_c1')
-        self.pubC2 = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/responsive_c2')
-        self.pubDeg = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/responsive_deg')
-        self.pubMax = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/responsive_max_mw')
-        self.pubUnresp = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/unresponsive_mw')
-        self.pubAucPrice = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/clear_price')
-
-        for house_name, val in self.housesInfo_dict.items():
+        if self.owns_grid:
+            self.subFeeder = helics.helicsFederateGetSubscription (self.hFed, self.gldName + '/distribution_load')
+            self.subLMP = helics.helicsFederateGetSubscription (self.hFed, self.lmp_key)
+            self.pubC1 = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/responsive_c1')
+            self.pubC2 = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/responsive_c2')
+            self.pubDeg = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/responsive_deg')
+            self.pubMax = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/responsive_max_mw')
+            self.pubUnresp = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/unresponsive_mw')
+            self.pubAucPrice = helics.helicsFederateGetPublication (self.hFed, self.fedName + '/clear_price')
+
+        for house_name in self.local_house_names:
+            val = self.housesInfo_dict[house_name]
             hvac_name = val['HVAC']
             meter_name = val['meter']
             house_meter_name = self.agents_dict['houses'][house_name]['parent']
@@ -155,8 +274,8 @@ class FEDERATE_HELPER:
             houseSubTopic = self.gldName + '/' + house_name  # subs from gridlabd
             billMeterSubTopic = self.gldName + '/' + meter_name  # subs from meter
             houseMeterSubTopic = self.gldName + '/' + house_meter_name
-            billMeterPubTopic = self.fedName + '/' + meter_name  # publication for meter
-            hvacPubTopic = self.fedName + '/' + hvac_name   # publication for HVAC controller
+            billMeterPubTopic = self.topic_root + '/' + meter_name  # publication for meter
+            hvacPubTopic = self.topic_root + '/' + hvac_name   # publication for HVAC controller
 
             self.pubsMtrMode[house_name] = helics.helicsFederateGetPublication (self.hFed, billMeterPubTopic + '/bill_mode')
             self.pubsMtrPrice[house_name] = helics.helicsFederateGetPublication (self.hFed, billMeterPubTopic + '/price')
@@ -185,7 +304,7 @@ class FEDERATE_HELPER:
                 self.subsSolarIout[house_name] =  helics.helicsFederateGetSubscription (self.hFed, pvArraySubTopic + '#I_Out')
 
                 solar_inv_name = val['PV']
-                pvCtlSubTopic = self.fedName + '/' + solar_inv_name
+                pvCtlSubTopic = self.topic_root + '/' + solar_inv_name
                 self.pubsPVPout[house_name] = helics.helicsFederateGetPublication (self.hFed, pvCtlSubTopic + '/P_Out')
                 self.pubsPVQout[house_name] = helics.helicsFederateGetPublication (self.hFed, pvCtlSubTopic + '/Q_Out')
 
@@ -198,18 +317,51 @@ class FEDERATE_HELPER:
                 self.subsBattSoC[house_name] =  helics.helicsFederateGetSubscription (self.hFed, battSubTopic + '#state_of_charge')
 
                 battery_inv_name = val['battery']
-                battCtlPubTopic = self.fedName + '/' + battery_inv_name
+                battCtlPubTopic = self.topic_root + '/' + battery_inv_name
                 self.pubsCharge_on_threshold[house_name] =  helics.helicsFederateGetPublication (self.hFed, battCtlPubTopic + '/charge_on_threshold')
                 self.pubsCharge_off_threshold[house_name] =  helics.helicsFederateGetPublication (self.hFed, battCtlPubTopic + '/charge_off_threshold')
                 self.pubsDischarge_on_threshold[house_name] =  helics.helicsFederateGetPublication (self.hFed, battCtlPubTopic + '/discharge_on_threshold')
                 self.pubsDischarge_off_threshold[house_name] =  helics.helicsFederateGetPublication (self.hFed, battCtlPubTopic + '/discharge_off_threshold')
 
 
-        for i, vpp_name in enumerate(self.vpp_name_list):
+        for i, vpp_name in enumerate(self.vpp_name_list if self.owns_grid else []):
             vpp_meter_name =  self.agents_dict['VPPs'][vpp_name]['VPP_meter']
             vppSubTopic = self.gldName + '/' + vpp_meter_name
             self.subsVPPMtrPower[vpp_name] = helics.helicsFederateGetSubscription (self.hFed, vppSubTopic + '#measured_power')
 
+        # flat snapshot table of all house measurements, refreshed once per grant
+        self.input_snapshot = INPUT_SNAPSHOT(self.local_house_names)
+        self.input_snapshot.register('volt', self.subsVolt, is_complex=True, keep_imag=True)
+        self.input_snapshot.register('mtr_power', self.subsMtrPower, is_complex=True)
+        self.input_snapshot.register('house_power', self.subsHousePower, is_complex=True)
+        self.input_snapshot.register('temp', self.subsTemp)
+        self.input_snapshot.register('hvac_load', self.subsHVACLoad)
+        self.input_snapshot.register('solar_power', self.subsSolarPower, is_complex=True)
+        self.input_snapshot.register('solar_vout', self.subsSolarVout, is_complex=True)
+        self.input_snapshot.register('solar_iout', self.subsSolarIout, is_complex=True)
+        self.input_snapshot.register('batt_power', self.subsBattPower, is_complex=True)
+        self.input_snapshot.register('batt_soc', self.subsBattSoC)
+
+        if self.wake_on_input:
+            self.set_wake_on_input()
+
+    def set_wake_on_input(self):
+        """Lets HELICS interrupt a time request when a subscribed input changes significantly
+
+        The federate is made interruptible and every input is set to only update on change,
+        with the minimum change from wake_tolerances, so a value republished unchanged (or
+        moving by less than the tolerance) neither interrupts nor shows up in INPUT_SNAPSHOT.
+        """
+        helics.helicsFederateSetFlagOption(self.hFed, helics.helics_flag_uninterruptible, False)
+        handles = dict(self.input_snapshot.kind_handles)
+        handles['feeder'] = [self.subFeeder] if self.subFeeder is not None else []
+        handles['vpp'] = list(self.subsVPPMtrPower.values())
+        for kind, subs in handles.items():
+            tolerance = self.wake_tolerances.get(kind, 0.0)
+            for sub in subs:
+                helics.helicsInputSetOption(sub, helics.helics_handle_option_only_update_on_change, True)
+                if tolerance > 0:
+                    helics.helicsInputSetMinimumChange(sub, tolerance)
 
     def get_agent_pubssubs(self,key, category, info = None):
         # get publications and subscriptions for a specific agent
@@ -285,8 +437,9 @@ class FEDERATE_HELPER:
 
         # 1. kill processes of all federates and broker
         self.kill_processes(True)
-        # 2. create a global broker
-        self.create_broker()
+        # 2. create the global broker, or the root broker and the sub-brokers
+        specs = self.other_federate_specs() + self.extra_federates
+        self.create_broker(specs)
         # 3. create the main federate
         while not self.is_destroyed:
             self.destroy_federate()
@@ -294,40 +447,95 @@ class FEDERATE_HELPER:
         self.register_pubssubs()
         self.is_destroyed = False
         # 4. execute other federates
-        self.run_other_federates()
+        self.run_other_federates(specs)
         # 5. execute the main federate (it should be in the final)
         self.FederateEnterExecutingMode()
 
-    def run_other_federates(self):
+    def join_cosimulation(self):
+        # a member feeder of a multi-feeder case, the broker and the other federates are launched by the first feeder
+        self.create_federate()
+        self.register_pubssubs()
+        self.is_destroyed = False
+        self.FederateEnterExecutingMode()
+
+    def gridlabd_args(self):
+        SCHED_PATH = os.environ['TESP_INSTALL'] + '/share/support/schedules'
+        return ['gridlabd', '-D', 'SCHED_PATH={}'.format(SCHED_PATH), '-D', 'USE_HELICS', '-D', 'METRICS_FILE=TE_ChallengeH_metrics.json', 'TE_Challenge.glm']
+
+    def add_feeders(self, feeders, scenario, data_path):
+        """Launches the GridLAB-D and substation federates of more feeders with the other federates
+
+        The feeders are made by generate_feeders.py, each has a fed_gridlabd and a fed_substation folder
+        with its own HELICS configs. The substation of a feeder runs launch_substation.py as a member: it
+        joins the co-simulation of this broker and runs the market of its feeder.
+
+        Args:
+            feeders ([dict]): entries of feeders/feeders.json
+            scenario (dict): settings of this substation, the members run with the same settings
+            data_path (str): the results of a member are written to data_path/<feeder name>
+        """
+        timeouts = {'wall_timeout': self.federate_wall_timeout, 'idle_timeout': self.federate_idle_timeout}
+        for feeder in feeders:
+            feeder_root = os.path.join(self.case_root, feeder['path'])
+            member = dict(scenario, feeder_member=True, num_feeders=1, num_shards=0, liveMonitor=False, drawFigure=False,
+                          data_path=os.path.join(os.path.abspath(data_path), feeder['name'], ''))
+            with open(os.path.join(feeder_root, 'fed_substation', 'scenario.json'), 'w', encoding='utf-8') as f:
+                json.dump(member, f, indent=1)
+            # the feeder is a group of its own in the hierarchical broker layout
+            self.extra_federates.append(FEDERATE_SPEC(feeder['gld'], self.gridlabd_args(), os.path.join(feeder_root, 'fed_gridlabd'),
+                                                      'gridlabd.log', helics_config=os.path.join(feeder_root, 'fed_gridlabd', 'TE_Challenge_HELICS_gld_msg.json'),
+                                                      broker_group=feeder['name'], **timeouts))
+            self.extra_federates.append(FEDERATE_SPEC(feeder['substation'], [sys.executable, os.path.abspath('launch_substation.py')],
+                                                      os.path.join(feeder_root, 'fed_substation'), 'substation.log',
+                                                      env={'PYTHONPATH': self.case_root}, ready_pattern='Substation federate launched',
+                                                      helics_config=os.path.join(feeder_root, 'fed_substation', 'TE_Challenge_HELICS_substation.json'),
+                                                      broker_group=feeder['name'], **timeouts))
+
+    def other_federate_specs(self):
+        """The GridLAB-D, weather, PyPower and EnergyPlus federates, grouped by the broker they use in the hierarchical layout"""
         TESP_INSTALL = os.environ['TESP_INSTALL']
         TESP_SUPPORT = TESP_INSTALL+'/share/support'
-        SCHED_PATH = TESP_SUPPORT+'/schedules'
         EPW = TESP_SUPPORT+'/energyplus/USA_AZ_Tucson.Intl.AP.722740_TMY3.epw'
         duration = str(self.duration)
 
-        # command to launch gridlabd federate
-        cmd1 = "cd ../fed_gridlabd/ && gridlabd -D SCHED_PATH={} -D USE_HELICS -D METRICS_FILE=TE_ChallengeH_metrics.json TE_Challenge.glm >gridlabd.log 2>&1".format(SCHED_PATH)
-        # command to launch weather federate
-        cmd2 = "cd ../fed_weather/ && python3 launch_weather.py >weather.log 2>&1"
-        # command to launch pypower federate
-        cmd3 = "cd ../fed_pypower/ && python3 launch_pypower.py >pypower.log 2>&1"
-        # command to launch energyplus federate
-        cmd4 = "cd ../fed_energyplus/ && export HELICS_CONFIG_FILE=helics_eplus.json && exec energyplus -w {} -d output -r MergedH.idf >eplus.log 2>&1".format(EPW)
-        # command to launch energyplus agent (it is also a federate)
-        cmd5 = "cd ../fed_energyplus/ && eplus_agent_helics {} 300s SchoolDualController eplus_TE_ChallengeH_metrics.json  0.02 25 4 4 helics_eplus_agent.json >eplus_agent.log 2>&1".format(duration)
-
-        self.processes_list.append(subprocess.Popen(cmd1, stdout=subprocess.PIPE, shell=True))
-        self.processes_list.append(subprocess.Popen(cmd2, stdout=subprocess.PIPE, shell=True))
-        self.processes_list.append(subprocess.Popen(cmd3, stdout=subprocess.PIPE, shell=True))
-        self.processes_list.append(subprocess.Popen(cmd4, stdout=subprocess.PIPE, shell=True))
-        self.processes_list.append(subprocess.Popen(cmd5, stdout=subprocess.PIPE, shell=True))
+        case_root = os.path.abspath('..')
+        timeouts = {'wall_timeout': self.federate_wall_timeout, 'idle_timeout': self.federate_idle_timeout}
+        eplus_root = os.path.join(case_root, 'fed_energyplus')
+        # the weather agent takes its broker from its own config (not a HELICS config), it stays on the root broker
+        return [
+            FEDERATE_SPEC('gridlabd', self.gridlabd_args(), os.path.join(case_root, 'fed_gridlabd'), 'gridlabd.log',
+                          helics_config=os.path.join(case_root, 'fed_gridlabd', 'TE_Challenge_HELICS_gld_msg.json'), broker_group='feeder1', **timeouts),
+            FEDERATE_SPEC('weather', [sys.executable, 'launch_weather.py'], os.path.join(case_root, 'fed_weather'), 'weather.log',
+                          ready_pattern='HELICS initialized', **timeouts),
+            FEDERATE_SPEC('pypower', [sys.executable, 'launch_pypower.py'], os.path.join(case_root, 'fed_pypower'), 'pypower.log',
+                          ready_pattern='HELICS subscription key', helics_config=os.path.join(case_root, 'fed_pypower', 'pypowerConfig.json'),
+                          broker_group='bulk', **timeouts),
+            FEDERATE_SPEC('energyplus', ['energyplus', '-w', EPW, '-d', 'output', '-r', 'MergedH.idf'], eplus_root, 'eplus.log',
+                          env={'HELICS_CONFIG_FILE': 'helics_eplus.json'}, helics_config=os.path.join(eplus_root, 'helics_eplus.json'),
+                          broker_group='eplus', **timeouts),
+            FEDERATE_SPEC('eplus_agent', ['eplus_agent_helics', duration, '300s', 'SchoolDualController', 'eplus_TE_ChallengeH_metrics.json', '0.02', '25', '4', '4', 'helics_eplus_agent.json'],
+                          eplus_root, 'eplus_agent.log', helics_config=os.path.join(eplus_root, 'helics_eplus_agent.json'),
+                          broker_group='eplus', **timeouts)]
+
+    def run_other_federates(self, specs = None):
+        if specs is None:
+            specs = self.other_federate_specs() + self.extra_federates
+        self.supervisor.launch(*specs) # launched concurrently
         print("Gridlabd, Weather, Pypower, EnergyPlus, EnergyPlus Agent, launched!")
+        if len(specs) > 5:
+            print("{} more federates launched: {}".format(len(specs) - 5, ', '.join(spec.name for spec in specs[5:])))
 
 
 
     def kill_processes(self, kill_subprocess = False):
         killed_list = []
         for proc in psutil.process_iter():
+            try: # processes of other co-simulations on this host run in other case or scenario folders
+                cwd = proc.cwd()
+                if not any(in_folder(cwd, folder) for folder in self.case_folders):
+                    continue
+            except (psutil.AccessDenied, psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue
             if proc.name() == "helics_broker":
                 os.system("kill -9 {}".format(proc.pid))
                 killed_list.append("helics_broker")
@@ -336,14 +544,23 @@ class FEDERATE_HELPER:
                 os.system("kill -9 {}".format(proc.pid))
                 killed_list.append("gridlabd")
                 continue
-            if proc.name() == "python3" and "launch_weather.py" in proc.cmdline():
+            if proc.name().startswith("python") and "launch_weather.py" in proc.cmdline():
                 os.system("kill -9 {}".format(proc.pid))
                 killed_list.append("launch_weather.py")
                 continue
-            if proc.name() == "python3" and "launch_pypower.py" in proc.cmdline():
+            if proc.name().startswith("python") and "launch_pypower.py" in proc.cmdline():
                 os.system("kill -9 {}".format(proc.pid))
                 killed_list.append("launch_pypower.py")
                 continue
+            if proc.name().startswith("python") and proc.pid != os.getpid() and any(arg.endswith("launch_substation.py") for arg in proc.cmdline()) \
+                    and in_folder(cwd, os.path.join(self.case_root, 'feeders')): # substations of the other feeders
+                os.system("kill -9 {}".format(proc.pid))
+                killed_list.append("launch_substation.py")
+                continue
+            if proc.name().startswith("python") and "shard_worker.py" in proc.cmdline():
+                os.system("kill -9 {}".format(proc.pid))
+                killed_list.append("shard_worker.py")
+                continue
             if proc.name() == "energyplus" and "energyplus" in proc.cmdline():
                 os.system("kill -9 {}".format(proc.pid))
                 killed_list.append("energyplus")
@@ -353,19 +570,54 @@ class FEDERATE_HELPER:
                 killed_list.append("eplus_agent_helics")
                 continue
 
-        if kill_subprocess : # kill subprocesses
-            if len(self.processes_list)>0:
-                for process in self.processes_list:
-                    while(str(process.poll())=="None"):
-                        pass
-                for process in self.processes_list:
-                    process.kill()
-                num_processes = len(self.processes_list)
-                for i in range(num_processes): # maybe it can free the memory for all processes
-                    del self.processes_list[0]
+        if kill_subprocess and self.supervisor is not None: # stop the processes launched by this helper
+            self.supervisor.shutdown()
+            self.supervisor = None
         if len(killed_list) > 0:
             print("Processes: ", killed_list, " has been killed successfully!")
 
+    def on_federate_failure(self, federate):
+        # a federate crashed, hung or timed out and the others were stopped, the substation federate
+        # is blocked in helicsFederateRequestTime and can not finish, so end this process as well
+        self.supervisor.show_report()
+        if not self.finishing:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def wait_federates(self, timeout = None):
+        """Waits (without polling) until the other federates finished, stops them after timeout seconds
+        """
+        if self.supervisor is None:
+            return
+        self.finishing = True # the substation is done, a failing federate no longer ends this process
+        if not self.supervisor.wait(timeout):
+            print("Federates still running after {} s, stopping them".format(timeout), flush=True)
+        self.supervisor.shutdown()
+        self.supervisor.show_report() # start latency and wall time of every federate
+
+    def federate_pids(self):
+        # processes to sample: the federates of the supervisor, then this substation federate
+        pids = {}
+        if self.supervisor is not None:
+            for name, federate in list(self.supervisor.federates.items()): # called from the sampler thread
+                if federate.proc is not None and federate.proc.returncode is None:
+                    pids[name] = federate.proc.pid
+        pids[self.fedName] = os.getpid()
+        return pids
+
+    def start_resource_sampler(self, data_path, interval = 5.0):
+        """Samples CPU, RSS, open files and I/O of every co-simulation process every interval seconds
+
+        The time series is written to data_path/resources.bin (see resource_sampler.py).
+        """
+        self.resource_sampler = RESOURCE_SAMPLER(data_path, self.federate_pids, interval)
+        self.resource_sampler.start()
+
+    def stop_resource_sampler(self):
+        if self.resource_sampler is not None:
+            self.resource_sampler.stop()
+            print("{} resource samples written".format(self.resource_sampler.num_samples))
+            self.resource_sampler = None
+
     def show_resource_consumption (self):
       if sys.platform != 'win32':
         usage = resource.getrusage(resource.RUSAGE_SELF)
@@ -383,7 +635,241 @@ class FEDERATE_HELPER:
           print('  {:<25} ({:<10}) = {}'.format(desc, name, getattr(usage, name)))
 
 
+class METRICS_SINK:
+    """Appends metrics records to a JSON-lines file while the simulation runs
+
+    The first line holds the Metadata and StartTime, every following line is one
+    {time_key: record} object. Records are buffered and written in batches, the file
+    is fsynced at most every fsync_interval seconds, so a crash loses at most the
+    records of the last batch. finalize() streams the lines into the legacy json file
+    ({"Metadata": ..., "StartTime": ..., time_key: record, ...}) read by plotFig.py
+    and process_agents.py, without loading the whole file into memory.
+
+    Args:
+        path_root (str): path of the output files without extension, .jsonl and .json are added
+        metadata (dict): the Metadata entry of the metrics
+        start_time (str): the StartTime entry of the metrics
+        batch_size (int): number of records buffered before they are written
+        fsync_interval (float): minimum wall-clock seconds between two fsync calls
+        resume_offset (int): continue the existing file from this offset (returned by sync_offset), None for a new file
+
+    Attributes:
+        num_records (int): number of records written so far
+    """
+    def __init__(self, path_root, metadata, start_time, batch_size = 16, fsync_interval = 60.0, resume_offset = None):
+        self.jsonl_path = path_root + '.jsonl'
+        self.json_path = path_root + '.json'
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.buffer = []
+        self.num_records = 0
+        self.last_fsync = time.time()
+        if resume_offset is not None: # records written after the checkpoint are dropped, the resumed run writes them again
+            self.file = open(self.jsonl_path, 'r+', encoding='utf-8')
+            self.file.truncate(resume_offset)
+            self.file.seek(resume_offset)
+        else:
+            self.file = open(self.jsonl_path, 'w', encoding='utf-8')
+            self.file.write(json.dumps({'Metadata': metadata, 'StartTime': start_time}) + '\n')
+
+    def write(self, time_key, record):
+        """Adds the record of one market interval
+
+        Args:
+            time_key (str): the time of the interval in seconds, key of the record in the legacy json
+            record (dict): the metrics of this interval
+        """
+        self.buffer.append(json.dumps({time_key: record}) + '\n')
+        self.num_records += 1
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self, sync = False):
+        if len(self.buffer) > 0:
+            self.file.write(''.join(self.buffer))
+            self.buffer.clear()
+        self.file.flush()
+        if sync or time.time() - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.time()
+
+    def sync_offset(self):
+        # flushes and fsyncs the records, returns the file offset after the last one
+        self.flush(sync=True)
+        return self.file.tell()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush(sync=True)
+            self.file.close()
+
+    def finalize(self):
+        """Closes the sink and writes the legacy single-object json file
+        """
+        self.close()
+        metrics_jsonl_to_json(self.jsonl_path, self.json_path)
+
+
+def in_folder(path, folder):
+    """True if path is folder or below it, a sibling folder with the same name prefix does not count"""
+    return os.path.commonpath([path, folder]) == folder
+
+
+def metrics_jsonl_to_json(jsonl_path, json_path):
+    """Converts a METRICS_SINK JSON-lines file into the legacy single-object json file
+
+    Also works on the file of a crashed run, an incomplete last line is skipped.
+    The output is the same as json.dumps of the metrics dict, one record in memory at a time.
+
+    Args:
+        jsonl_path (str): the .jsonl file written by METRICS_SINK
+        json_path (str): the json file to write
+    """
+    with open(jsonl_path, encoding='utf-8') as fin, open(json_path, 'w', encoding='utf-8') as fout:
+        header = json.loads(fin.readline())
+        fout.write(json.dumps(header)[:-1]) # leave the object open
+        for line in fin:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break # truncated last line of a crashed run
+            for key, val in record.items():
+                fout.write(', ' + json.dumps(key) + ': ' + json.dumps(val))
+        fout.write('}\n')
+
+
+class PUBLICATION_CACHE:
+    """Publishes values to HELICS only when they differ from the last value sent on the same handle
+
+    HELICS subscribers keep the last value they received, so skipping a repeated
+    value does not change what the other federates see.
+
+    Args:
+        tolerance (float): doubles within this absolute difference of the last sent value are
+            suppressed, 0 means only identical values are suppressed
+
+    Attributes:
+        last_values (dict): last value sent, keyed by id of the publication handle
+        num_sent (int): number of values published to HELICS
+        num_suppressed (int): number of values skipped because they did not change
+    """
+    def __init__(self, tolerance = 0.0):
+        self.tolerance = tolerance
+        self.last_values = {}
+        self.num_sent = 0
+        self.num_suppressed = 0
+
+    def publish_double(self, pub, value):
+        key = id(pub)
+        last = self.last_values.get(key)
+        if last is not None and abs(value - last) <= self.tolerance:
+            self.num_suppressed += 1
+            return False
+        helics.helicsPublicationPublishDouble(pub, value)
+        self.last_values[key] = value
+        self.num_sent += 1
+        return True
+
+    def publish_string(self, pub, value):
+        key = id(pub)
+        if self.last_values.get(key) == value:
+            self.num_suppressed += 1
+            return False
+        helics.helicsPublicationPublishString(pub, value)
+        self.last_values[key] = value
+        self.num_sent += 1
+        return True
+
+    def invalidate(self, pub = None):
+        # forget the last value of one handle (or all handles), so the next value is always sent
+        if pub is None:
+            self.last_values.clear()
+        else:
+            self.last_values.pop(id(pub), None)
+
+    def show_statistics(self):
+        total = self.num_sent + self.num_suppressed
+        ratio = self.num_suppressed/total if total > 0 else 0
+        print("Publications: {} sent, {} suppressed ({:.1f}% unchanged)".format(self.num_sent, self.num_suppressed, ratio*100))
+
+
+class INPUT_SNAPSHOT:
+    """Flat table of HELICS input handles with the latest values kept in NumPy columns
+
+    All registered inputs share one flat handle index. refresh() checks every handle
+    with helicsInputIsUpdated and only reads the inputs that got a new value since
+    the last grant, the other entries keep their previous value (same as what
+    helicsInputGetComplex/Double would return for them).
+
+    Args:
+        row_names ([str]): names of the rows (house names), fixes the row order of all columns
+
+    Attributes:
+        rows (dict): row index of each row name
+        columns (dict): one np.ndarray of length len(row_names) per measurement kind,
+            complex kinds registered with keep_imag also get a kind + '_imag' column
+        handles ([object]): flat list of all input handles
+        num_reads (int): number of inputs read by the last refresh
+    """
+    def __init__(self, row_names):
+        self.row_names = list(row_names)
+        self.rows = {name: i for i, name in enumerate(self.row_names)}
+        self.columns = {}
+        self.handles = []
+        self.kind_handles = {} # input handles of each kind
+        self.num_reads = 0
+
+        self._entries = [] # (column, imag column or None, row, is_complex) per handle, same order as handles
+
+    def register(self, kind, subs_dict, is_complex = False, keep_imag = False):
+        """Adds all inputs of one measurement kind to the table
+
+        Args:
+            kind (str): name of the column
+            subs_dict (dict): input handles keyed by row name, rows without a handle stay 0
+            is_complex (bool): read the input with helicsInputGetComplex, the real part goes to the column
+            keep_imag (bool): also keep the imaginary part in column kind + '_imag'
+        """
+        column = np.zeros(len(self.row_names))
+        self.columns[kind] = column
+        imag = None
+        if keep_imag:
+            imag = np.zeros(len(self.row_names))
+            self.columns[kind + '_imag'] = imag
+        # columns start at 0, the HELICS default before the first update
+        self.kind_handles[kind] = list(subs_dict.values())
+        for name, sub in subs_dict.items():
+            self.handles.append(sub)
+            self._entries.append((column, imag, self.rows[name], is_complex))
+
+    def refresh(self):
+        """Reads the inputs updated since the last call into the columns
+
+        Returns:
+            int: number of inputs read
+        """
+        isUpdated = helics.helicsInputIsUpdated
+        num_reads = 0
+        for sub, (column, imag, row, is_complex) in zip(self.handles, self._entries):
+            if isUpdated(sub):
+                self._read(sub, column, imag, row, is_complex)
+                num_reads += 1
+        self.num_reads = num_reads
+        return num_reads
+
+    def _read(self, sub, column, imag, row, is_complex):
+        if is_complex:
+            cval = helics.helicsInputGetComplex(sub)
+            column[row] = cval[0]
+            if imag is not None:
+                imag[row] = cval[1]
+        else:
+            column[row] = helics.helicsInputGetDouble(sub)
+
+
 class CURVES_TO_PLOT:
+    auction_series = AUCTION_SERIES # recorded once per market interval, the others at every state update
+
     def __init__(self, num_prosumers):
 
         self.num_prosumers = num_prosumers
@@ -486,7 +972,13 @@ class CURVES_TO_PLOT:
         self.time_hour_auction = []
 
 
-    def save_statistics(self, path):
+    def save_statistics(self, path, store = None):
+        """Saves the recorded series into path/data.pkl
+
+        Args:
+            path (str): experiment directory, ending with '/'
+            store (EXPERIMENT_STORE): if given, the series are also saved into the columnar store and the store is closed
+        """
         data_dict = {}
         data_dict['time_hour_auction'] = self.time_hour_auction
         data_dict['buyer_ratio'] = self.buyer_ratio
@@ -531,6 +1023,16 @@ class CURVES_TO_PLOT:
         with open(path+'data.pkl', 'wb') as f:
             pickle.dump(data_dict, f)
 
+        if store is not None:
+            store.save_time_index('system', self.time_hour_system)
+            store.save_time_index('auction', self.time_hour_auction)
+            for name, values in data_dict.items():
+                if name.startswith('time_hour_'):
+                    continue
+                index = 'auction' if name in self.auction_series else 'system'
+                store.save_series(name, values, index)
+            store.close()
+
 
 
     def record_auction_statistics(self, seconds, houseObjs, aucObj):
@@ -544,10 +1046,14 @@ class CURVES_TO_PLOT:
         self.LMP.append(aucObj.lmp)
 
 
-    def record_state_statistics(self, seconds, houseObjs, aucObj, vpp):
+    def record_state_statistics(self, seconds, houseObjs, aucObj, vpp, population = None):
 
         self.time_hour_system.append(seconds/3600)
 
+        if population is not None: # the house state is available as arrays
+            self.record_population_statistics(population, aucObj, vpp)
+            return
+
         # temperature related
         temp_list = []
         base_temp_list = []
@@ -619,6 +1125,42 @@ class CURVES_TO_PLOT:
         self.vpp_load_q.append(vpp.vpp_load_q)
 
 
+    def record_population_statistics(self, population, aucObj, vpp):
+        # same statistics as record_state_statistics, computed from the HousePopulation columns
+        temp = population.air_temp
+        self.temp_mean.append(temp.mean()) # mean temperature
+        self.temp_max.append(temp.max()) # max temperature
+        self.temp_min.append(temp.min()) # min temperature
+        self.basepoint_mean.append(population.basepoint.mean()) # mean basepoint
+        self.setpoint_mean.append((population.basepoint + population.offset).mean())    # mean setpoint
+
+        self.system_hvac_load.append(population.hvac_kw.sum())
+        self.system_house_load.append(population.house_kw.sum())
+        self.system_PV.append(population.solar_kw.sum())
+        self.system_house_unres.append(population.unres_kw.sum())
+
+        self.hvac_load_mean.append(population.hvac_kw.mean())
+        self.hvac_load_max.append(population.hvac_kw.max())
+        self.hvac_load_min.append(population.hvac_kw.min())
+        self.house_load_mean.append(population.house_kw.mean())
+        self.house_load_max.append(population.house_kw.max())
+        self.house_load_min.append(population.house_kw.min())
+        self.house_PV_mean.append(population.solar_kw.mean())
+        self.house_PV_max.append(population.solar_kw.max())
+        self.house_PV_min.append(population.solar_kw.min())
+        self.house_unres_mean.append(population.unres_kw.mean())
+        self.house_unres_max.append(population.unres_kw.max())
+        self.house_unres_min.append(population.unres_kw.min())
+
+        self.hvac_on_ratio.append(np.count_nonzero(population.hvac_on)/population.num_houses)
+
+        self.distri_load_p.append(aucObj.refload_p)
+        self.distri_load_q.append(aucObj.refload_q)
+
+        self.vpp_load_p.append(vpp.vpp_load_p)
+        self.vpp_load_q.append(vpp.vpp_load_q)
+
+
     def update_curves(self, seconds):
         self.time_hour_curve.append(seconds/3600)
 
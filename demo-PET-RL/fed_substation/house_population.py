@@ -0,0 +1,315 @@
+# file: house_population.py
+"""Structure-of-arrays state engine for all houses of a substation.
+
+The per-second house update (measurements, schedule, power needed and
+predictions) is executed as whole-population NumPy kernels instead of a
+Python loop over HOUSE objects. After binding, the HOUSE, HVAC, PV and
+BATTERY objects keep working as before, but their state attributes become
+thin views on the population columns.
+"""
+import numpy as np
+import helics
+from basepoint_schedule import BASEPOINT_SCHEDULE
+
+
+class PopulationField:
+    """Attribute descriptor that stores its value in a HousePopulation column
+
+    Before the owner object is bound to a population, the value lives in the
+    instance dictionary like a normal attribute. After binding, reads and writes
+    go to element [idx] of the named population column.
+
+    Args:
+        column (str): name of the HousePopulation column backing this attribute
+    """
+    def __init__(self, column):
+        self.column = column
+        self.name = column
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        population = obj.__dict__.get('_population')
+        if population is None:
+            return obj.__dict__[self.name]
+        return getattr(population, self.column)[obj.__dict__['_population_idx']].item()
+
+    def __set__(self, obj, value):
+        population = obj.__dict__.get('_population')
+        if population is None:
+            obj.__dict__[self.name] = value
+        else:
+            getattr(population, self.column)[obj.__dict__['_population_idx']] = value
+
+
+def bind_to_population(obj, population, idx):
+    """Turns the PopulationField attributes of obj into views on the population row idx
+    """
+    obj.__dict__['_population'] = population
+    obj.__dict__['_population_idx'] = idx
+
+
+class HousePopulation:
+    """Keeps the state of all houses as contiguous arrays and updates them in bulk
+
+    Args:
+        houses (dict): HOUSE objects keyed by house name, HELICS subscriptions and
+            RL agents of the houses must already be assigned
+        snapshot (INPUT_SNAPSHOT): bulk input table of the federate helper; if None,
+            the measurements are read handle by handle
+        columns (dict): arrays to use as the state columns instead of new ones, e.g. the rows of a
+            shard in SHARD_TABLES; they are initialized from the houses like new columns
+
+    Attributes:
+        names ([str]): house names, the row order of all columns
+        index (dict): row index of each house name
+        has_pv (np.ndarray): True if the house has a PV inverter
+        has_batt (np.ndarray): True if the house has a battery inverter
+        air_temp (np.ndarray): air temperature of the houses in deg F
+        hvac_kw (np.ndarray): HVAC load in kW
+        hvac_on (np.ndarray): True if the HVAC is running
+        house_kw (np.ndarray): house meter power in kW
+        unres_kw (np.ndarray): unresponsive load in kW
+        solarDC_Vout (np.ndarray): PV DC output voltage in V
+        solarDC_Iout (np.ndarray): PV DC output current in A
+        battery_SoC (np.ndarray): battery state of charge
+        basepoint (np.ndarray): time-scheduled thermostat setpoint in deg F
+        setpoint (np.ndarray): thermostat setpoint including the price response offset in deg F
+        power_needed (np.ndarray): True if the HVAC needs power
+    """
+    # state columns, initialized from the bound HOUSE (or its HVAC for hvac_columns)
+    float_columns = ['mtr_voltage', 'mtr_power', 'house_kw', 'solar_kw', 'battery_kw', 'unres_kw',
+                     'solarDC_Vout', 'solarDC_Iout', 'battery_SoC', 'time_now', 'house_load_predict',
+                     'solar_power_predict', 'air_temp', 'hvac_kw', 'basepoint', 'setpoint', 'offset',
+                     'probability', 'MTTR_now', 'energyMarket', 'energy_cumulated', 'last_update_time']
+    bool_columns = ['hvac_on', 'power_needed', 'fix_basepoint']
+    hvac_columns = ['air_temp', 'hvac_kw', 'hvac_on', 'power_needed', 'basepoint', 'setpoint', 'offset',
+                    'probability', 'MTTR_now', 'energyMarket', 'energy_cumulated', 'last_update_time', 'fix_basepoint']
+    # static HVAC parameters, never changed during a run
+    hvac_parameters = ['deadband', 'request_period', 'update_period',
+                       'wakeup_start', 'daylight_start', 'evening_start', 'night_start',
+                       'wakeup_set', 'daylight_set', 'evening_set', 'night_set',
+                       'weekend_day_start', 'weekend_day_set', 'weekend_night_start', 'weekend_night_set']
+
+    def __init__(self, houses, snapshot = None, columns = None):
+        self.houses = list(houses.values())
+        self.names = list(houses.keys())
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.num_houses = n = len(self.houses)
+
+        self.has_pv = np.array([house.hasPV for house in self.houses], dtype=bool)
+        self.has_batt = np.array([house.hasBatt for house in self.houses], dtype=bool)
+        self.pv_idx = np.flatnonzero(self.has_pv)
+        self.batt_idx = np.flatnonzero(self.has_batt)
+
+        # initialize the columns from the current object state, then bind the objects
+        for column in self.float_columns:
+            setattr(self, column, columns[column] if columns else np.zeros(n, dtype=np.float64))
+        for column in self.bool_columns:
+            setattr(self, column, columns[column] if columns else np.zeros(n, dtype=bool))
+        for column in self.hvac_parameters:
+            setattr(self, column, np.array([getattr(house.hvac, column) for house in self.houses], dtype=np.float64))
+        for i, house in enumerate(self.houses):
+            for column in self.float_columns + self.bool_columns:
+                owner = house.hvac if column in self.hvac_columns else house
+                getattr(self, column)[i] = getattr(owner, column)
+
+        for i, house in enumerate(self.houses):
+            bind_to_population(house, self, i)
+            bind_to_population(house.hvac, self, i)
+            if house.hasPV:
+                bind_to_population(house.pv, self, i)
+            if house.hasBatt:
+                bind_to_population(house.battery, self, i)
+
+        # the thermostat schedules compiled into period tables, see basepoint_schedule.py
+        self.schedule = BASEPOINT_SCHEDULE([house.hvac for house in self.houses])
+
+        # houses whose RL environment/agents need the simulation time
+        self.rl_houses = [house for house in self.houses if house.rl_env]
+
+        # raw HELICS measurements, one column per measurement kind
+        self.volt_re = np.zeros(n)
+        self.volt_im = np.zeros(n)
+        self.mtr_power_re = np.zeros(n)
+        self.house_power_re = np.zeros(n)
+        self.temp_raw = np.zeros(n)
+        self.hvac_load_raw = np.zeros(n)
+        self.solar_power_re = np.zeros(len(self.pv_idx))
+        self.solar_vout_re = np.zeros(len(self.pv_idx))
+        self.solar_iout_re = np.zeros(len(self.pv_idx))
+        self.batt_power_re = np.zeros(len(self.batt_idx))
+        self.batt_soc_raw = np.zeros(len(self.batt_idx))
+
+        # rows of the houses in the input snapshot table
+        self.snapshot = snapshot
+        if snapshot is not None:
+            self.snapshot_rows = np.array([snapshot.rows[name] for name in self.names], dtype=np.intp)
+            self.snapshot_pv_rows = self.snapshot_rows[self.pv_idx]
+            self.snapshot_batt_rows = self.snapshot_rows[self.batt_idx]
+
+        # HELICS input handles in row order
+        self.subs_volt = [house.subs['subVolt'] for house in self.houses]
+        self.subs_mtr_power = [house.subs['subMtrPower'] for house in self.houses]
+        self.subs_house_power = [house.subs['subHousePower'] for house in self.houses]
+        self.subs_temp = [house.subs['subTemp'] for house in self.houses]
+        self.subs_hvac_load = [house.subs['subHVACLoad'] for house in self.houses]
+        self.subs_solar_power = [self.houses[i].subs['subSolarPower'] for i in self.pv_idx]
+        self.subs_solar_vout = [self.houses[i].subs['subSolarVout'] for i in self.pv_idx]
+        self.subs_solar_iout = [self.houses[i].subs['subSolarIout'] for i in self.pv_idx]
+        self.subs_batt_power = [self.houses[i].subs['subBattPower'] for i in self.batt_idx]
+        self.subs_batt_soc = [self.houses[i].subs['subBattSoC'] for i in self.batt_idx]
+
+    def checkpoint_state(self):
+        # the state columns, the raw measurements are read again at the next update
+        return {column: getattr(self, column).copy() for column in self.float_columns + self.bool_columns}
+
+    def restore_checkpoint(self, state):
+        for column, values in state.items():
+            getattr(self, column)[:] = values # in place, the bound objects keep viewing the same arrays
+
+    def step(self, seconds, hod, dow):
+        """Runs the house state update for the whole population, every second or on input
+
+        Same sequence as update_time, update_measurements, hvac.change_basepoint,
+        hvac.determine_power_needed, predict_solar_power and predict_house_load
+        called on every HOUSE.
+
+        Args:
+            seconds (int): current simulation time in seconds
+            hod (float): the hour of the day, from 0 to 24
+            dow (int): the day of the week, zero being Monday
+        """
+        self.update_time(seconds)
+        self.update_measurements()
+        self.change_basepoint(hod, dow)
+        self.determine_power_needed()
+        self.predict_solar_power()
+        self.predict_house_load()
+
+    def update_time(self, seconds):
+        self.time_now[:] = seconds
+        for house in self.rl_houses:
+            house.update_time(seconds)
+
+    def read_inputs(self):
+        """Reads the raw measurements of all houses from HELICS
+        """
+        if self.snapshot is not None:
+            self.snapshot.refresh()
+            columns = self.snapshot.columns
+            rows = self.snapshot_rows
+            self.volt_re[:] = columns['volt'][rows]
+            self.volt_im[:] = columns['volt_imag'][rows]
+            self.mtr_power_re[:] = columns['mtr_power'][rows]
+            self.house_power_re[:] = columns['house_power'][rows]
+            self.temp_raw[:] = columns['temp'][rows]
+            self.hvac_load_raw[:] = columns['hvac_load'][rows]
+            self.solar_power_re[:] = columns['solar_power'][self.snapshot_pv_rows]
+            self.solar_vout_re[:] = columns['solar_vout'][self.snapshot_pv_rows]
+            self.solar_iout_re[:] = columns['solar_iout'][self.snapshot_pv_rows]
+            self.batt_power_re[:] = columns['batt_power'][self.snapshot_batt_rows]
+            self.batt_soc_raw[:] = columns['batt_soc'][self.snapshot_batt_rows]
+            return
+
+        for i, sub in enumerate(self.subs_volt):
+            cval = helics.helicsInputGetComplex(sub)
+            self.volt_re[i] = cval[0]
+            self.volt_im[i] = cval[1]
+        for i, sub in enumerate(self.subs_mtr_power):
+            self.mtr_power_re[i] = helics.helicsInputGetComplex(sub)[0]
+        for i, sub in enumerate(self.subs_house_power):
+            self.house_power_re[i] = helics.helicsInputGetComplex(sub)[0]
+        for i, sub in enumerate(self.subs_temp):
+            self.temp_raw[i] = helics.helicsInputGetDouble(sub)
+        for i, sub in enumerate(self.subs_hvac_load):
+            self.hvac_load_raw[i] = helics.helicsInputGetDouble(sub)
+        for i, sub in enumerate(self.subs_solar_power):
+            self.solar_power_re[i] = helics.helicsInputGetComplex(sub)[0]
+        for i, sub in enumerate(self.subs_solar_vout):
+            self.solar_vout_re[i] = helics.helicsInputGetComplex(sub)[0]
+        for i, sub in enumerate(self.subs_solar_iout):
+            self.solar_iout_re[i] = helics.helicsInputGetComplex(sub)[0]
+        for i, sub in enumerate(self.subs_batt_power):
+            self.batt_power_re[i] = helics.helicsInputGetComplex(sub)[0]
+        for i, sub in enumerate(self.subs_batt_soc):
+            self.batt_soc_raw[i] = helics.helicsInputGetDouble(sub)
+
+    def update_measurements(self):
+        """Population version of HOUSE.update_measurements
+        """
+        self.read_inputs()
+
+        # billing meter and house meter
+        self.mtr_voltage[:] = np.abs(self.volt_re + 1j*self.volt_im)
+        self.mtr_power[:] = self.mtr_power_re*0.001 # unit. kW
+        self.house_kw[:] = self.house_power_re*0.001 # unit. kW
+
+        # HVAC state, same as hvac.update_energyMarket and hvac.get_state
+        # the load of the previous update ran until now, more than update_period when the substation only wakes on input
+        dEnergy = self.hvac_kw*(self.time_now - self.last_update_time)/3600
+        self.last_update_time[:] = self.time_now
+        self.energyMarket += dEnergy
+        self.energy_cumulated += dEnergy
+        self.air_temp[:] = self.temp_raw
+        self.hvac_kw[:] = np.maximum(self.hvac_load_raw, 0) # unit kW
+        self.update_request_probability()
+
+        # unresponsive load
+        self.unres_kw[:] = np.maximum(self.house_kw - self.hvac_kw, 0)
+
+        # PV and battery
+        self.solar_kw[self.pv_idx] = np.abs(self.solar_power_re*0.001) # unit. kW
+        self.solarDC_Vout[self.pv_idx] = self.solar_vout_re # unit. V
+        self.solarDC_Iout[self.pv_idx] = self.solar_iout_re # unit. A
+        self.battery_kw[self.batt_idx] = self.batt_power_re*0.001 # unit. kW
+        self.battery_SoC[self.batt_idx] = self.batt_soc_raw
+
+    def update_request_probability(self):
+        """Population version of HVAC.get_request_probability
+        """
+        self.setpoint[:] = self.basepoint + self.offset
+        up_bound = self.setpoint + 1/2*self.deadband
+        lower_bound = self.setpoint - 1/2*self.deadband
+
+        mr = 1/self.MTTR_now
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mu = mr * (self.air_temp-lower_bound)/(up_bound-self.air_temp)*(up_bound-self.setpoint)/(self.setpoint-lower_bound)
+        mu = np.where(self.air_temp >= up_bound, np.inf, np.where(self.air_temp <= lower_bound, 0.0, mu))
+        self.probability[:] = 1 - np.exp(-mu*self.request_period)
+
+    def change_basepoint(self, hod, dow):
+        """Population version of HVAC.change_basepoint
+
+        Args:
+            hod (float): the hour of the day, from 0 to 24
+            dow (int): the day of the week, zero being Monday
+
+        Returns:
+            np.ndarray: row indices of the houses whose basepoint changed
+        """
+        changed, val = self.schedule.changed(self.basepoint, hod, dow, self.fix_basepoint)
+        self.basepoint[changed] = val[changed]
+        return changed
+
+    def determine_power_needed(self):
+        """Population version of HVAC.determine_power_needed
+        """
+        self.setpoint[:] = self.basepoint + self.offset
+        up_bound = self.setpoint + 1/2*self.deadband
+        lower_bound = self.setpoint - 1/2*self.deadband
+
+        self.power_needed[self.air_temp > up_bound] = True
+        self.power_needed[self.air_temp < lower_bound] = False
+
+        for _ in np.flatnonzero((self.air_temp < (lower_bound-3)) & self.hvac_on):
+            print("Something wrong")
+
+    def predict_solar_power(self):
+        self.solar_power_predict[:] = np.where(self.has_pv, self.solarDC_Vout * self.solarDC_Iout /1000, 0)
+
+    def predict_house_load(self):
+        self.house_load_predict[:] = np.where(self.power_needed, 3.0 + self.unres_kw, self.unres_kw)
@@ -0,0 +1,232 @@
+# file: house_shards.py
+"""Houses of the substation split into shards that run in worker processes.
+
+The substation federate (the coordinator) keeps the AUCTION, the VPP and the
+scheduler. The houses are split into contiguous shards, every shard runs in
+a shard_worker.py process that is a HELICS federate of its own: it holds the
+subscriptions and publications of its houses (published under the name of
+the substation federate, so GridLAB-D does not see a difference), runs the
+state update, the bids, the post-market control and the RL agents of its
+houses. The state columns of the house population and the bids of all houses
+are kept in one shared memory block, every worker writes its rows and the
+coordinator reads the whole population for the market and the statistics.
+The coordinator sends the phases to run over a multiprocessing connection and
+waits until every worker is done, the workers run them at the same time.
+"""
+import os
+import sys
+import json
+import secrets
+import numpy as np
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener
+from house_population import HousePopulation
+from federate_supervisor import FEDERATE_SPEC
+from live_monitor import attach_shared_memory
+
+# one row per house in the bid table, role is coded as in the experiment store
+BID_COLUMNS = ['price', 'quantity', 'hvac_needed', 'role', 'unres_kw', 'base_covered']
+ROLE_CODES = {'buyer': 1, 'seller': -1} # any other role (none-participant) is 0
+ROLE_NAMES = {1: 'buyer', -1: 'seller', 0: 'none-participant'}
+
+
+class SHARD_TABLES:
+    """State columns and bids of all houses in one shared memory block
+
+    The layout only depends on the number of houses, the coordinator creates the block
+    and the workers attach to it by name.
+
+    Args:
+        num_houses (int): number of houses of the substation
+        name (str): name of the shared memory block, a new unique name if None
+        create (bool): create the block (coordinator) or attach to it (worker)
+
+    Attributes:
+        bids (np.ndarray): [house, BID_COLUMNS] float64
+        num_houses (int): number of houses
+        <column> (np.ndarray): one array per HousePopulation state column
+    """
+    def __init__(self, num_houses, name = None, create = False):
+        self.num_houses = num_houses
+        layout = []
+        offset = 0
+        for column in HousePopulation.float_columns + HousePopulation.bool_columns:
+            dtype = np.dtype(bool) if column in HousePopulation.bool_columns else np.dtype(np.float64)
+            layout.append((column, dtype, (num_houses,), offset))
+            offset += -(-num_houses * dtype.itemsize // 8) * 8 # keep the float columns 8-byte aligned
+        layout.append(('bids', np.dtype(np.float64), (num_houses, len(BID_COLUMNS)), offset))
+        offset += num_houses * len(BID_COLUMNS) * 8
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name or 'pet_shards_' + secrets.token_hex(4), create=True, size=max(offset, 8))
+        else:
+            self.shm = attach_shared_memory(name)
+        self.name = self.shm.name
+        self.owner = create
+        for column, dtype, shape, start in layout:
+            setattr(self, column, np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=start))
+        if create:
+            self.bids[:] = np.nan
+
+    def columns(self, start, stop):
+        # views on the rows of one shard, used as the columns of its HousePopulation
+        return {column: getattr(self, column)[start:stop] for column in HousePopulation.float_columns + HousePopulation.bool_columns}
+
+    def close(self):
+        for column in HousePopulation.float_columns + HousePopulation.bool_columns + ['bids']:
+            setattr(self, column, None) # release the views before the buffer
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def split_houses(house_names, num_shards):
+    """Splits the houses into num_shards contiguous [start, stop) row ranges of about the same size
+    """
+    bounds = np.linspace(0, len(house_names), num_shards + 1).round().astype(int)
+    return [(int(bounds[k]), int(bounds[k+1])) for k in range(num_shards)]
+
+
+def house_objects(agents_dict, house_name):
+    # names of the GridLAB-D objects and controllers that belong to a house
+    house = agents_dict['houses'][house_name]
+    names = {house_name, house_name + '_hvac', house['billingmeter_id'], house['parent']}
+    for inv_name, inv in agents_dict['inverters'].items():
+        if inv['billingmeter_id'] == house['billingmeter_id']:
+            names.update([inv_name, inv['parent'], inv['resource_name']])
+    return names
+
+
+def split_helics_config(helics_config, agents_dict, shards, house_names):
+    """Splits the HELICS config of the substation into the coordinator and the shard configs
+
+    The publications and subscriptions of a house go to the shard of the house. The shard
+    publications are global and keep the name <substation>/<key>, as GridLAB-D subscribes to them.
+
+    Returns:
+        (dict, [dict]): the coordinator config and one config per shard
+    """
+    fed_name = helics_config['name']
+    owner = {}
+    for k, (start, stop) in enumerate(shards):
+        for house_name in house_names[start:stop]:
+            for name in house_objects(agents_dict, house_name):
+                owner[name] = k
+
+    def shard_of(key):
+        name = key.split('#')[0].split('/')
+        return owner.get(name[1] if len(name) > 1 and '#' in key else name[0])
+
+    coordinator = {key: value for key, value in helics_config.items() if key not in ['publications', 'subscriptions']}
+    coordinator['publications'], coordinator['subscriptions'] = [], []
+    shard_configs = []
+    for k in range(len(shards)):
+        config = dict(coordinator)
+        config['name'] = '{}_shard{}'.format(fed_name, k)
+        config['publications'], config['subscriptions'] = [], []
+        shard_configs.append(config)
+    for pub in helics_config.get('publications', []):
+        k = shard_of(pub['key'])
+        if k is None:
+            coordinator['publications'].append(pub)
+        else:
+            pub = dict(pub, key=fed_name + '/' + pub['key'], **{'global': True})
+            shard_configs[k]['publications'].append(pub)
+    for sub in helics_config.get('subscriptions', []):
+        k = shard_of(sub['key'])
+        (coordinator if k is None else shard_configs[k])['subscriptions'].append(sub)
+    return coordinator, shard_configs
+
+
+class HOUSE_SHARDS:
+    """Coordinator side of the house shards
+
+    Writes the HELICS configs of the coordinator and the shards, creates the shared tables,
+    starts the workers (as federates of the FEDERATE_SUPERVISOR) and sends them the phases.
+
+    Args:
+        fh (FEDERATE_HELPER): federate helper of the substation, not yet started
+        num_shards (int): number of worker processes
+        settings (dict): passed to the workers, see shard_worker.py
+        work_path (str): folder of the generated config files
+
+    Attributes:
+        shards ([(int, int)]): row range of every shard
+        tables (SHARD_TABLES): state columns and bids of all houses
+    """
+    def __init__(self, fh, num_shards, settings, work_path = 'shards'):
+        self.fh = fh
+        self.house_names = list(fh.house_name_list)
+        self.shards = split_houses(self.house_names, num_shards)
+        self.tables = SHARD_TABLES(len(self.house_names), create=True)
+        self.authkey = secrets.token_bytes(16)
+        self.listener = Listener(('127.0.0.1', 0), authkey=self.authkey)
+        self.connections = [None] * num_shards
+        self.num_round_trips = 0
+        if not os.path.exists(work_path):
+            os.makedirs(work_path)
+
+        coordinator, shard_configs = split_helics_config(fh.helics_config, fh.agents_dict, self.shards, self.house_names)
+        coordinator_path = os.path.join(work_path, 'coordinator_helics.json')
+        with open(coordinator_path, 'w', encoding='utf-8') as f:
+            json.dump(coordinator, f, indent=2)
+        fh.helicsConfig = coordinator_path # the substation federate keeps only the market and grid interfaces
+        fh.local_house_names = []
+
+        for k, (start, stop) in enumerate(self.shards):
+            helics_path = os.path.join(work_path, 'shard{}_helics.json'.format(k))
+            with open(helics_path, 'w', encoding='utf-8') as f:
+                json.dump(shard_configs[k], f, indent=2)
+            worker_settings = dict(settings, shard=k, start=start, stop=stop, helics_config=helics_path,
+                                   agent_config=fh.configfile, metrics_root=fh.metrics_root, topic_root=fh.fedName,
+                                   tables=self.tables.name, num_houses=len(self.house_names),
+                                   address=list(self.listener.address))
+            settings_path = os.path.join(work_path, 'shard{}.json'.format(k))
+            with open(settings_path, 'w', encoding='utf-8') as f:
+                json.dump(worker_settings, f, indent=1)
+            fh.extra_federates.append(FEDERATE_SPEC(
+                'shard{}'.format(k), [sys.executable, 'shard_worker.py', settings_path], os.getcwd(),
+                os.path.join(work_path, 'shard{}.log'.format(k)), env={'PET_SHARD_KEY': self.authkey.hex()},
+                ready_pattern='shard ready', helics_config=helics_path, broker_group='feeder1', wall_timeout=fh.federate_wall_timeout, idle_timeout=fh.federate_idle_timeout))
+
+    def connect(self):
+        # every worker connects when it starts and sends its shard index
+        for _ in range(len(self.shards)):
+            conn = self.listener.accept()
+            self.connections[conn.recv()] = conn
+        self.listener.close()
+
+    def run(self, phase, time_granted, hod = 0, dow = 0, payload = None):
+        """Runs one phase on all shards at the same time, returns when every worker is done
+
+        Args:
+            phase (str): 'update', 'control', 'lmp', 'bid', 'clear' or 'adjust', see shard_worker.py
+            time_granted (int): the time granted to the coordinator, the workers request it from HELICS first
+            hod (float): hour of the day, used by 'update'
+            dow (int): day of the week, used by 'update'
+            payload (object): data of the phase, the LMP for 'lmp', the market results for 'clear'
+        """
+        for conn in self.connections:
+            conn.send((phase, time_granted, hod, dow, payload))
+        for k, conn in enumerate(self.connections):
+            reply = conn.recv()
+            if reply[0] != 'done':
+                raise RuntimeError('shard {} failed in phase {}: {}'.format(k, phase, reply[1]))
+        self.num_round_trips += 1
+
+    def bids(self):
+        """Returns the bids of all houses in the format of HOUSE.formulate_bid, in house order
+        """
+        rows = self.tables.bids.tolist()
+        return [[row[0], row[1], bool(row[2]), ROLE_NAMES[int(row[3])], row[4], name, bool(row[5])]
+                for name, row in zip(self.house_names, rows)]
+
+    def stop(self):
+        # the workers destroy their federates and exit
+        for conn in self.connections:
+            if conn is not None:
+                try:
+                    conn.send(('stop', None, 0, 0, None))
+                    conn.close()
+                except OSError:
+                    pass
+        self.tables.close()
@@ -18,6 +18,10 @@ import random
 import psutil
 import subprocess
 from PET_Prosumer import HOUSE, VPP        # import user-defined my_hvac class for hvac controllers
+from house_population import HousePopulation
+from experiment_store import EXPERIMENT_STORE
+from scheduler import SubstationScheduler
+from phase_timer import PHASE_TIMER
 from env import BIDING_ENV
 from ddpg import DDPG
 from datetime import datetime
@@ -25,29 +29,79 @@ from datetime import timedelta
 from my_auction import AUCTION  # import user-defined my_auction class for market
 import matplotlib.pyplot as plt
 import my_tesp_support_api.helpers as helpers
+import my_tesp_support_api.grant_trace as grant_trace
 from federate_helper import FEDERATE_HELPER, CURVES_TO_PLOT
+from live_monitor import LIVE_MONITOR, DEFAULT_NAME
+from checkpoint import SUBSTATION_CHECKPOINT
+from house_shards import HOUSE_SHARDS
 
 
 
 """================================Declare something====================================="""
-data_path = './data/exp(RL-test)/'
+# settings of a scenario written by run_scenarios.py override the defaults below
+scenario = {}
+if os.path.exists('scenario.json'):
+  with open('scenario.json', encoding='utf-8') as f:
+    scenario = json.load(f)
+
+data_path = scenario.get('data_path', './data/exp(RL-test)/')
 if not os.path.exists(data_path):
     os.makedirs(data_path)
 configfile = 'TE_Challenge_agent_dict.json'
 helicsConfig = 'TE_Challenge_HELICS_substation.json'
 metrics_root = 'TE_ChallengeH'
-hour_stop = 4*24  # simulation duration (default 48 hours)
+hour_stop = scenario.get('hour_stop', 4*24)  # simulation duration (default 48 hours)
 hour_stop_seconds = hour_stop*3600
-hasMarket = True # have market or not
-vppEnable = False # have Vpp coordinator or not
-drawFigure = True # draw figures during the simulation
-has_demand_response = False
-has_RL = True
-fh = FEDERATE_HELPER(configfile, helicsConfig, metrics_root, hour_stop) # initialize the federate helper
+hasMarket = scenario.get('hasMarket', True) # have market or not
+vppEnable = scenario.get('vppEnable', False) # have Vpp coordinator or not
+drawFigure = scenario.get('drawFigure', False) # draw figures in this process during the simulation (blocks the loop while drawing)
+liveMonitor = scenario.get('liveMonitor', True) # push the curves to a shared memory ring buffer, watch them with 'python live_monitor.py'
+has_demand_response = scenario.get('has_demand_response', False)
+has_RL = scenario.get('has_RL', True)
+clearing_engine = scenario.get('clearing_engine', 'vectorized') # 'loop' or 'vectorized' market clearing, both give the same results
+request_seed = scenario.get('request_seed', 1) # seed of the arrival order of the requests at the VPP, None for a different run every time
+wakeOnInput = scenario.get('wakeOnInput', False) # the state update runs when a subscribed input changes (plus a heartbeat) instead of every update period
+checkpoint_hours = scenario.get('checkpoint_hours', 24) # the substation state is saved every checkpoint_hours of simulation time, None for no checkpoints
+resume = scenario.get('resume', False) or '--resume' in sys.argv # continue from the latest checkpoint in data_path/checkpoints
+feeder_member = scenario.get('feeder_member', False) # a feeder of a multi-feeder case, launched by the substation of feeder 1
+num_feeders = scenario.get('num_feeders', 1) # feeders made by generate_feeders.py, this case is feeder 1
+broker_layout = scenario.get('broker_layout', 'flat') # 'hierarchical' gives every feeder its own sub-broker under a root broker (broker_topology.py)
+num_shards = scenario.get('num_shards', 0) # the houses run in num_shards worker processes (house_shards.py), 0 runs them in this process
+if num_shards > 0 and (wakeOnInput or checkpoint_hours or resume):
+  print('the houses run in', num_shards, 'shards, wake-on-input and checkpoints are not supported and disabled', flush=True)
+  wakeOnInput, checkpoint_hours, resume = False, None, False
+checkpoints = SUBSTATION_CHECKPOINT(os.path.join(data_path, 'checkpoints'))
+resume_state = checkpoints.load() if resume else None
+if resume and resume_state is None:
+  print('no checkpoint in', checkpoints.path, 'the simulation starts from the beginning', flush=True)
+fh = FEDERATE_HELPER(configfile, helicsConfig, metrics_root, hour_stop, wakeOnInput,
+                     scenario.get('broker_port'), scenario.get('broker_name', 'mainbroker')) # initialize the federate helper
+fh.federate_wall_timeout = scenario.get('federate_wall_timeout') # a federate running longer is stopped, None for no limit
+fh.federate_idle_timeout = scenario.get('federate_idle_timeout') # a federate silent for longer counts as hung
+fh.lookahead = scenario.get('lookahead', 0) # seconds GridLAB-D may run ahead of the substation (output delay), 0 for lockstep
+fh.input_delay = scenario.get('input_delay', 0) # seconds the substation may run ahead of GridLAB-D (input delay), 0 for lockstep
+fh.broker_layout = broker_layout
+fh.broker_port_limit = scenario.get('broker_port_limit') # end of the port block of this scenario, set by run_scenarios.py
+fh.open_metrics(data_path, resume=resume_state['loop']['metrics'] if resume_state else None) # auction and prosumer metrics are streamed to data_path during the simulation
+if num_feeders > 1 and not feeder_member: # the other feeders are launched with the other federates
+  with open(os.path.join('..', 'feeders', 'feeders.json'), encoding='utf-8') as f:
+    feeders = json.load(f)['feeders']
+  if len(feeders) < num_feeders - 1:
+    raise ValueError('{} feeders requested, generate_feeders.py made {}'.format(num_feeders, len(feeders) + 1))
+  fh.add_feeders(feeders[:num_feeders - 1], dict(scenario, resume=resume), data_path)
+shards = None
+if num_shards > 0: # the substation federate keeps the market, the shard workers are launched with the other federates
+  shards = HOUSE_SHARDS(fh, num_shards, {'hour_stop': hour_stop, 'has_RL': has_RL, 'lookahead': fh.lookahead, 'input_delay': fh.input_delay})
 
 
 """=============================Start The Co-simulation==================================="""
-fh.cosimulation_start() # launch the broker; launch other federates; the substation federate enters executing mode
+if feeder_member:
+  fh.join_cosimulation() # the broker and the other federates run already
+else:
+  fh.cosimulation_start() # launch the broker; launch other federates; the substation federate enters executing mode
+fh.start_resource_sampler(data_path) # CPU, memory, open files and I/O of every federate, sampled during the run
+if shards is not None:
+  shards.connect()
 
 
 """============================Substation Initialization=================================="""
@@ -55,41 +109,52 @@ print ('##,tnow,tclear,ClearType,ClearQ,ClearP,BuyCount,BuyUnresp,BuyResp,SellCo
 
 # initialize a user-defined Vpp coordinator object
 vpp_name = fh.vpp_name_list[0] # select the first VPP
-vpp = VPP(vpp_name,vppEnable)
+vpp = VPP(vpp_name,vppEnable,request_seed)
 vpp.get_helics_subspubs(fh.get_agent_pubssubs(vpp.name, 'VPP'))
 
 # initialize a user-defined auction object
-auction = AUCTION (fh.market_row, fh.market_key)
+auction = AUCTION (fh.market_row, fh.market_key, clearing_engine)
 auction.get_helics_subspubs(fh.get_agent_pubssubs(auction.name, 'auction'))
 auction.initAuction()
 
 
 # initialize House objects
 houses = {}
-seed = 1
-for key, info in fh.housesInfo_dict.items(): # key: house name, info: information of the house, including names of PV, battery ...
-  houses[key] = HOUSE(key, info, fh.agents_dict, auction, seed) # initialize a house object
-  houses[key].get_helics_subspubs(fh.get_agent_pubssubs(key, 'house', info)) # get subscriptions and publications for house meters
-  houses[key].set_meter_mode() # set meter mode
-  houses[key].get_cleared_price(auction.clearing_price)
-  houses[key].hvac.turn_OFF()  # at the beginning of the simulation, turn off all HVACs
-  seed += 1
-last_house_name = key
-
-# initialize RL agent for houses
-if has_RL:
-  for key, house in houses.items():
-    house.rl_env = BIDING_ENV(len(houses), key, house.hvac.price_cap, hour_stop_seconds, 'seller-buyer')
-    if house.rl_env.has_seller_agent:
-      house.rl_agent_seller = DDPG(house.rl_env)
-    if house.rl_env.has_buyer_agent:
-      house.rl_agent_buyer = DDPG(house.rl_env)
+house_names = list(fh.housesInfo_dict.keys())
+if shards is None:
+  seed = 1
+  for key, info in fh.housesInfo_dict.items(): # key: house name, info: information of the house, including names of PV, battery ...
+    houses[key] = HOUSE(key, info, fh.agents_dict, auction, seed) # initialize a house object
+    houses[key].get_helics_subspubs(fh.get_agent_pubssubs(key, 'house', info), fh.pub_cache) # get subscriptions and publications for house meters
+    houses[key].set_meter_mode() # set meter mode
+    houses[key].get_cleared_price(auction.clearing_price)
+    houses[key].hvac.turn_OFF()  # at the beginning of the simulation, turn off all HVACs
+    seed += 1
+  last_house_name = key
+
+  # initialize RL agent for houses
+  if has_RL:
+    for key, house in houses.items():
+      house.rl_env = BIDING_ENV(len(houses), key, house.hvac.price_cap, hour_stop_seconds, 'seller-buyer')
+      if house.rl_env.has_seller_agent:
+        house.rl_agent_seller = DDPG(house.rl_env)
+      if house.rl_env.has_buyer_agent:
+        house.rl_agent_buyer = DDPG(house.rl_env)
+
+  # bind all houses to a structure-of-arrays population, the state update runs as array kernels
+  population = HousePopulation(houses, fh.input_snapshot)
+  sample_house = houses[last_house_name]
+else: # the houses run in the shard workers, the population columns are their rows in the shared tables
+  population = shards.tables
+  sample_house = HOUSE(house_names[-1], fh.housesInfo_dict[house_names[-1]], fh.agents_dict, auction, len(house_names)) # gives the periods of the house controllers
 
 # initialize DATA_TO_PLOT class to visualize data in the simulation
-num_houses = len(houses)
+num_houses = len(house_names)
 curves = CURVES_TO_PLOT(num_houses)
 if drawFigure:
   fig, (ax1, ax2, ax3, ax4, ax5) = plt.subplots(5)
+if liveMonitor:
+  monitor = LIVE_MONITOR(scenario.get('monitor_name', DEFAULT_NAME)) # the viewer process can attach and detach at any time
 
 
 # initialize time parameters
@@ -98,179 +163,263 @@ StartTime = '2013-07-01 00:00:00 -0800' # co-simulation start time
 dt_now = datetime.strptime (StartTime, '%Y-%m-%d %H:%M:%S %z')
 
 dt = fh.dt # HELCIS period (1 seconds)
-update_period = houses[last_house_name].hvac.update_period # state update period (15 seconds)
-control_period = houses[last_house_name].hvac.update_period
-request_period = houses[last_house_name].hvac.request_period   # local controller samples energy packet request period
+update_period = sample_house.hvac.update_period # state update period (15 seconds)
+control_period = sample_house.hvac.update_period
+request_period = sample_house.hvac.request_period   # local controller samples energy packet request period
 market_period = auction.period # market period (300 seconds)
 adjust_period = market_period # market response period (300 seconds)
 fig_update_period = market_period # figure update time period
-tnext_update = dt             # the next time to update the state
-tnext_control = control_period
-tnext_request = dt            # the next time to request
-tnext_lmp = market_period - dt
-tnext_bid = market_period - 2 * dt  # the next time controllers calculate their final bids
-tnext_agg = market_period - 2 * dt  # the next time auction calculates and publishes aggregate bid
-tnext_clear = market_period         # the next time clear the market
-tnext_adjust = market_period       # the next time controllers adjust control parameters/setpoints based on their bid and clearing price
-tnext_fig_update = market_period + dt   # the next time to update figures
+heartbeat_period = market_period # wake-on-input mode: longest time without a state update
+state_period = heartbeat_period if wakeOnInput else update_period
+
+# per-phase timing of the loop, histograms per market period are written to data_path/timing.json
+timer = PHASE_TIMER(market_period)
+tracer = grant_trace.GRANT_TRACER(fh.fedName) # writes the time grants when PET_GRANT_TRACE is set
+for key, house in houses.items():
+  house.timer = timer
+
+# columnar results store, the bids of all houses are written to it every market interval
+store = EXPERIMENT_STORE(data_path, house_names, int(StopTime // market_period), market_period, resume_state is not None)
 
 time_granted = 0
 time_last = 0
+num_input_wakes = 0
+hour_of_day = 0
+day_of_week = dt_now.weekday()
 
 
-"""============================Substation Loop=================================="""
+"""============================Substation Phases=================================="""
 
-while (time_granted < StopTime):
+def update_phase(time_granted):
+  """ houses update state/measurements for all devices,
+      update schedule and determine the power needed for hvac,
+      make power predictions for solar,
+      make power predictions for house load"""
+  if shards is not None:
+    shards.run('update', time_granted, hour_of_day, day_of_week)
+  else:
+    population.step(time_granted, hour_of_day, day_of_week) # update time, measurements, schedule, power needed and predictions for all houses
+  vpp.get_vpp_load() # get the VPP load
+  curves.record_state_statistics(time_granted, houses, auction, vpp, population) # record something
 
-  """ 1. step the co-simulation time """
-  nextHELICSTime = int(min ([tnext_update,tnext_request,tnext_lmp, tnext_bid, tnext_agg, tnext_clear, tnext_adjust, StopTime]))
-  time_granted = int (helics.helicsFederateRequestTime(fh.hFed, nextHELICSTime))
-  time_delta = time_granted - time_last
-  time_last = time_granted
-  hour_of_day = 24.0 * ((float(time_granted) / 86400.0) % 1.0)
-  dt_now = dt_now + timedelta(seconds=time_delta) # this is the actual time
-  day_of_week = dt_now.weekday() # get the day of week
-  hour_of_day = dt_now.hour # get the hour of the day
 
+def control_phase(time_granted):
+  """ houses launch basic real-time control actions (not post-market control)
+      including the control for battery"""
+  if shards is not None:
+    shards.run('control', time_granted)
+  for key, house in houses.items():
+    if house.hasBatt:
+      house.battery.auto_control() # real-time basic control of battery to track the HVAC load
+    # house.hvac.auto_control()
 
-  """ 2. houses update state/measurements for all devices, 
-         update schedule and determine the power needed for hvac,
-         make power predictions for solar,
-         make power predictions for house load"""
-  if time_granted >= tnext_update:
+
+def lmp_phase(time_granted):
+  """ market gets the local marginal price (LMP) from the bulk power grid,"""
+  auction.get_lmp () # get local marginal price (LMP) from the bulk power grid
+  auction.get_refload() # get distribution load from gridlabd
+  if shards is not None:
+    shards.run('lmp', time_granted, payload=auction.lmp)
+  for key, house in houses.items():
+    house.get_lmp_from_market(auction.lmp) # houses get LMP from the market
+
+
+def bid_phase(time_granted):
+  """ houses formulate and send their bids"""
+  auction.clear_bids() # auction remove all previous records, re-initialize
+  time_key = str(int(scheduler.next_due('clear')))
+  prosumer_record = {}
+  if shards is not None:
+    shards.run('bid', time_granted)
+    bids = shards.bids()
+  else:
+    bids = []
     for key, house in houses.items():
-      house.update_time(time_granted) # update time for all elements of the house
-      house.update_measurements() # update measurements for all devices
-      house.hvac.change_basepoint(hour_of_day, day_of_week) # update schedule
-      house.hvac.determine_power_needed() # hvac determines if power is needed based on current state
-      house.predict_solar_power() # predict the solar power generation
-      house.predict_house_load()  # predict the house load
-    vpp.get_vpp_load() # get the VPP load
-    curves.record_state_statistics(time_granted, houses, auction, vpp) # record something
-    tnext_update += update_period
-
-
-  """ 3. houses launch basic real-time control actions (not post-market control)
-      including the control for battery"""
-  if time_granted >= tnext_control:
+      house.bid = house.formulate_bid() # bid is [bid_price, quantity, hvac.power_needed, role, unres_kw, name]
+      bids.append(house.bid)
+  for bid in bids:
+    prosumer_record[bid[5]] = [bid[0], bid[1], bid[2], bid[3]]
+    if hasMarket:
+      auction.collect_bid(bid)
+  fh.prosumer_sink.write(time_key, prosumer_record)
+  store.record_bids(scheduler.next_due('clear'), prosumer_record)
+
+
+def agg_phase(time_granted):
+  """ market aggreates bids from prosumers"""
+  auction.aggregate_bids()
+  auction.publish_agg_bids_for_buyer()
+
+
+def clear_phase(time_granted):
+  """ market clears the market """
+  tclear = scheduler.next_due('clear')
+  if hasMarket:
+    auction.clear_market(tclear, time_granted)
+    auction.surplusCalculation(tclear, time_granted)
+    auction_info = auction.publish_cleared_market_information() # used to generate the observation for agent
+    print("!!The cleared price is: ",auction.clearing_price)
+    timer.begin('post_market') # houses receive the market results and run the post-market control
+    if shards is not None:
+      shards.run('clear', time_granted, payload=(auction_info, auction.market_condition, auction.marginal_quantity))
     for key, house in houses.items():
-      if house.hasBatt:
-        house.battery.auto_control() # real-time basic control of battery to track the HVAC load
-      # house.hvac.auto_control()
-    tnext_control += control_period
+      house.get_cleared_market_information(auction_info)
+      house.calculate_reward()
+      house.publish_meter_price()
+      house.post_market_control(auction.market_condition, auction.marginal_quantity) # post-market control is needed
+    timer.end()
 
 
-  """ 4. market gets the local marginal price (LMP) from the bulk power grid,"""
-  if time_granted >= tnext_lmp:
-    auction.get_lmp () # get local marginal price (LMP) from the bulk power grid
-    auction.get_refload() # get distribution load from gridlabd
-    for key, house in houses.items():
-      house.get_lmp_from_market(auction.lmp) # houses get LMP from the market
-    tnext_lmp += market_period
+  time_key = str(int(tclear))
+  fh.auction_sink.write(time_key, {auction.name:[auction.clearing_price, auction.clearing_type, auction.consumerSurplus, auction.averageConsumerSurplus, auction.supplierSurplus]})
+  curves.record_auction_statistics(time_granted, house_names, auction)
 
 
-  """ 5. houses formulate and send their bids"""
-  if time_granted >= tnext_bid:
-    auction.clear_bids() # auction remove all previous records, re-initialize
-    time_key = str(int(tnext_clear))
-    fh.prosumer_metrics[time_key] = {}
+def adjust_phase(time_granted):
+  """ prosumer demand response (adjust control parameters/setpoints) """
+  if has_demand_response:
+    if shards is not None:
+      shards.run('adjust', time_granted)
     for key, house in houses.items():
-      house.bid = house.formulate_bid() # bid is [bid_price, quantity, hvac.power_needed, role, unres_kw, name]
-      fh.prosumer_metrics[time_key][house.name] = [house.bid[0], house.bid[1], house.bid[2], house.bid[3]]
-      if hasMarket:
-        auction.collect_bid(house.bid)
-    tnext_bid += market_period
+      house.demand_response()
+
+
+def fig_phase(time_granted):
+  """ visualize some results during the simulation"""
+  curves.update_curves(time_granted)
+  ax1.cla()
+  ax1.set_ylabel("VPP Load (kW)")
+  # ax1.plot(curves.time_hour_curve, curves.curve_distri_load_p)
+  ax1.plot(curves.time_hour_curve, curves.curve_vpp_load_p)
+  ax1.legend(['VPP Load'])
+
+  ax2.cla()
+  ax2.set_ylabel("House Load (kW)")
+  ax2.plot(curves.time_hour_curve, curves.curve_house_load_max)
+  ax2.plot(curves.time_hour_curve, curves.curve_house_load_mean)
+  ax2.plot(curves.time_hour_curve, curves.curve_house_load_min)
+  ax2.legend(['max', 'mean', 'min'])
+
+  ax3.cla()
+  ax3.set_ylabel("Temperature (degF)")
+  ax3.plot(curves.time_hour_curve, curves.curve_temp_max)
+  ax3.plot(curves.time_hour_curve, curves.curve_temp_mean)
+  ax3.plot(curves.time_hour_curve, curves.curve_temp_min)
+  ax3.plot(curves.time_hour_curve, curves.curve_basepoint_mean)
+  ax3.plot(curves.time_hour_curve, curves.curve_setpoint_mean)
+  ax3.legend(['max', 'mean', 'min', 'base-point', 'set-point'])
+
+  ax4.cla()
+  ax4.set_ylabel("Cleared Price ($)")
+  ax4.plot(curves.time_hour_curve, curves.curve_cleared_price)
+
+  ax5.cla()
+  ax5.set_xlabel("Time (h)")
+  ax5.set_ylabel("Percentage")
+  ax5.plot(curves.time_hour_curve, curves.curve_hvac_on_ratio)
+  ax5.plot(curves.time_hour_curve, curves.curve_buyer_ratio)
+  ax5.plot(curves.time_hour_curve, curves.curve_seller_ratio)
+  ax5.plot(curves.time_hour_curve, curves.curve_nontcp_ratio)
+  ax5.legend(['HVAC-ON ratio', 'Buyer ratio', 'Seller ratio', 'None-participant ratio'])
+
+
+  plt.pause(0.01)
+
+
+def monitor_phase(time_granted):
+  """ push the latest curve samples to the live monitor, never waits for the viewer"""
+  monitor.push(time_granted, curves)
+
+
+# register the phases, tasks due at the same time run in ascending priority
+scheduler = SubstationScheduler(StopTime, timer)
+scheduler.add_periodic('update', update_phase, state_period, dt, priority=1)
+scheduler.add_periodic('control', control_phase, state_period, control_period, priority=2)
+scheduler.add_periodic('lmp', lmp_phase, market_period, market_period - dt, priority=3)
+scheduler.add_periodic('bid', bid_phase, market_period, market_period - 2 * dt, priority=4)  # controllers calculate their final bids
+scheduler.add_periodic('agg', agg_phase, market_period, market_period - 2 * dt, priority=5)  # auction calculates and publishes aggregate bid
+scheduler.add_periodic('clear', clear_phase, market_period, market_period, priority=6)
+scheduler.add_periodic('adjust', adjust_phase, adjust_period, market_period, priority=7)  # controllers adjust setpoints based on their bid and clearing price
+if drawFigure:
+  scheduler.add_periodic('fig', fig_phase, fig_update_period, market_period + dt, priority=8)
+if liveMonitor:
+  scheduler.add_periodic('monitor', monitor_phase, fig_update_period, market_period + dt, priority=9)
+
+
+"""============================Checkpoint and Resume=================================="""
+# everything the substation needs to continue a run, the HELICS wiring is set up again by the new run
+checkpoint_objects = {'house/' + key: house for key, house in houses.items()}
+checkpoint_objects.update({'auction': auction, 'vpp': vpp, 'curves': curves, 'population': population,
+                           'scheduler': scheduler, 'timer': timer, 'store': store})
+checkpoint_period = int(checkpoint_hours * 3600) if checkpoint_hours else None
+
+def save_checkpoint(time_granted):
+  """ save the substation state after all phases due at time_granted have run"""
+  start = time.perf_counter_ns()
+  loop = {'time_granted': time_granted, 'time_last': time_last, 'dt_now': dt_now, 'hour_of_day': hour_of_day,
+          'day_of_week': day_of_week, 'num_input_wakes': num_input_wakes, 'metrics': fh.metrics_offsets()}
+  path = checkpoints.save(time_granted, checkpoint_objects, loop)
+  timer.add('checkpoint', time.perf_counter_ns() - start)
+  print('checkpoint at', time_granted, 'written to', path, flush=True)
+
+if resume_state is not None:
+  checkpoints.restore(resume_state, checkpoint_objects)
+  loop = resume_state['loop']
+  time_granted, time_last, dt_now = loop['time_granted'], loop['time_last'], loop['dt_now']
+  hour_of_day, day_of_week, num_input_wakes = loop['hour_of_day'], loop['day_of_week'], loop['num_input_wakes']
+  print('resuming from the checkpoint at', time_granted, flush=True)
+  granted = 0
+  while granted < time_granted: # the other federates start again and run up to the checkpoint time, the substation only waits
+    granted = int(tracer.request_time(fh.hFed, time_granted))
+next_checkpoint = (time_granted // checkpoint_period + 1) * checkpoint_period if checkpoint_period else None
+
+
+"""============================Substation Loop=================================="""
 
+while (time_granted < StopTime):
 
-  """ 6. market aggreates bids from prosumers"""
-  if time_granted >= tnext_agg:
-    auction.aggregate_bids()
-    auction.publish_agg_bids_for_buyer()
-    tnext_agg += market_period
+  """ 1. step the co-simulation time to the next due task """
+  nextHELICSTime = int(scheduler.next_time())
+  wait_start = time.perf_counter_ns()
+  time_granted = int (tracer.request_time(fh.hFed, nextHELICSTime))
+  timer.set_time(time_granted)
+  timer.add('helics_wait', time.perf_counter_ns() - wait_start) # time blocked until HELICS grants, not computing
+  if wakeOnInput and time_granted < nextHELICSTime: # granted early, a subscribed input changed
+    scheduler.wake('update', time_granted)
+    scheduler.wake('control', time_granted)
+    num_input_wakes += 1
+  time_delta = time_granted - time_last
+  time_last = time_granted
+  dt_now = dt_now + timedelta(seconds=time_delta) # this is the actual time
+  day_of_week = dt_now.weekday() # get the day of week
+  hour_of_day = dt_now.hour # get the hour of the day
 
+  """ 2. run all phases due at the granted time """
+  scheduler.run_due(time_granted)
 
-  """ 7. market clears the market """
-  if time_granted >= tnext_clear:
-    if hasMarket:
-      auction.clear_market(tnext_clear, time_granted)
-      auction.surplusCalculation(tnext_clear, time_granted)
-      auction_info = auction.publish_cleared_market_information() # used to generate the observation for agent
-      print("!!The cleared price is: ",auction.clearing_price)
-      for key, house in houses.items():
-        house.get_cleared_market_information(auction_info)
-        house.calculate_reward()
-        house.publish_meter_price()
-        house.post_market_control(auction.market_condition, auction.marginal_quantity) # post-market control is needed
-
-
-    time_key = str(int(tnext_clear))
-    fh.auction_metrics [time_key] = {auction.name:[auction.clearing_price, auction.clearing_type, auction.consumerSurplus, auction.averageConsumerSurplus, auction.supplierSurplus]}
-    curves.record_auction_statistics(time_granted, houses, auction)
-    tnext_clear += market_period
-
-
-  """ 8. prosumer demand response (adjust control parameters/setpoints) """
-  if time_granted >= tnext_adjust:
-    if has_demand_response:
-      for key, house in houses.items():
-        house.demand_response()
-    tnext_adjust += market_period
-
-
-  """ 9. visualize some results during the simulation"""
-  if drawFigure and time_granted >= tnext_fig_update:
-    curves.update_curves(time_granted)
-    ax1.cla()
-    ax1.set_ylabel("VPP Load (kW)")
-    # ax1.plot(curves.time_hour_curve, curves.curve_distri_load_p)
-    ax1.plot(curves.time_hour_curve, curves.curve_vpp_load_p)
-    ax1.legend(['VPP Load'])
-
-    ax2.cla()
-    ax2.set_ylabel("House Load (kW)")
-    ax2.plot(curves.time_hour_curve, curves.curve_house_load_max)
-    ax2.plot(curves.time_hour_curve, curves.curve_house_load_mean)
-    ax2.plot(curves.time_hour_curve, curves.curve_house_load_min)
-    ax2.legend(['max', 'mean', 'min'])
-
-    ax3.cla()
-    ax3.set_ylabel("Temperature (degF)")
-    ax3.plot(curves.time_hour_curve, curves.curve_temp_max)
-    ax3.plot(curves.time_hour_curve, curves.curve_temp_mean)
-    ax3.plot(curves.time_hour_curve, curves.curve_temp_min)
-    ax3.plot(curves.time_hour_curve, curves.curve_basepoint_mean)
-    ax3.plot(curves.time_hour_curve, curves.curve_setpoint_mean)
-    ax3.legend(['max', 'mean', 'min', 'base-point', 'set-point'])
-
-    ax4.cla()
-    ax4.set_ylabel("Cleared Price ($)")
-    ax4.plot(curves.time_hour_curve, curves.curve_cleared_price)
-
-    ax5.cla()
-    ax5.set_xlabel("Time (h)")
-    ax5.set_ylabel("Percentage")
-    ax5.plot(curves.time_hour_curve, curves.curve_hvac_on_ratio)
-    ax5.plot(curves.time_hour_curve, curves.curve_buyer_ratio)
-    ax5.plot(curves.time_hour_curve, curves.curve_seller_ratio)
-    ax5.plot(curves.time_hour_curve, curves.curve_nontcp_ratio)
-    ax5.legend(['HVAC-ON ratio', 'Buyer ratio', 'Seller ratio', 'None-participant ratio'])
-
-
-    plt.pause(0.01)
-    tnext_fig_update += fig_update_period
+  """ 3. save the substation state every checkpoint period """
+  if next_checkpoint is not None and next_checkpoint <= time_granted < StopTime:
+    save_checkpoint(time_granted)
+    next_checkpoint = (time_granted // checkpoint_period + 1) * checkpoint_period
 
 
 """============================ Finalize the metrics output ============================"""
-curves.save_statistics(data_path)
+curves.save_statistics(data_path, store)
+if liveMonitor:
+  monitor.close() # the viewer detaches when the buffer is removed
 print ('writing metrics', flush=True)
-auction_op = open (data_path+'auction_' + metrics_root + '_metrics.json', 'w')
-print(json.dumps(fh.auction_metrics), file=auction_op)
-auction_op.close()
-house_op = open (data_path+'house_' + metrics_root + '_metrics.json', 'w')
-print(json.dumps(fh.prosumer_metrics), file=house_op)
-house_op.close()
+fh.finalize_metrics() # write the auction and house metrics json from the streamed records
+if shards is not None:
+  shards.stop() # the shard workers destroy their federates and exit
 fh.destroy_federate()  # destroy the federate
+fh.wait_federates(600) # let the other federates write their metrics, stop them if they do not end
+fh.stop_resource_sampler()
 fh.show_resource_consumption() # after simulation, print the resource consumption
+fh.pub_cache.show_statistics() # how many publications were skipped because they did not change
+timer.save(data_path)
+timer.show_statistics() # where the wall time of the loop went
+if wakeOnInput:
+  print('state updates woken by input changes:', num_input_wakes)
 plt.show()
 # fh.kill_processes(True) # it is not suggested here because some other federates may not end their simulations, it will affect their output metrics
 
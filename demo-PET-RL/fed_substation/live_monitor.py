@@ -0,0 +1,211 @@
+# file: live_monitor.py
+"""Out-of-process live plotting for the substation federate.
+
+The substation pushes the latest CURVES_TO_PLOT samples into a ring buffer
+in shared memory (LIVE_MONITOR); pushing is a few array stores and never
+waits for anybody. A viewer process (run this file) maps the same buffer,
+redraws at its own frame rate, and can be started, closed and restarted
+at any time while the co-simulation runs:
+
+    python live_monitor.py [--name pet_substation_monitor] [--fps 2]
+
+Shared memory layout:
+    int64[6] header: magic, capacity, number of series, write count, run id, names length
+    names block: JSON list of the series names, NAMES_BYTES bytes
+    float64[capacity, 1 + number of series]: time in hours, then one column per series
+"""
+import json
+import time
+import argparse
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = 0x50455431 # 'PET1'
+HEADER_FIELDS = 6
+NAMES_BYTES = 4096
+DEFAULT_NAME = 'pet_substation_monitor'
+
+# series of CURVES_TO_PLOT pushed to the monitor, the latest value of each list is sent
+MONITOR_SERIES = ['vpp_load_p', 'distri_load_p',
+                  'house_load_max', 'house_load_mean', 'house_load_min',
+                  'hvac_load_max', 'hvac_load_mean', 'hvac_load_min',
+                  'temp_max', 'temp_mean', 'temp_min', 'basepoint_mean', 'setpoint_mean',
+                  'cleared_price',
+                  'hvac_on_ratio', 'buyer_ratio', 'seller_ratio', 'nontcp_ratio']
+
+
+def _layout(buf, capacity, num_series):
+    header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=buf)
+    names = np.ndarray((NAMES_BYTES,), dtype=np.uint8, buffer=buf, offset=header.nbytes)
+    data = np.ndarray((capacity, 1 + num_series), dtype=np.float64, buffer=buf, offset=header.nbytes + NAMES_BYTES)
+    return header, names, data
+
+
+class LIVE_MONITOR:
+    """Writer side of the live monitor, owned by the substation federate
+
+    Args:
+        name (str): name of the shared memory block
+        series ([str]): CURVES_TO_PLOT list names to push
+        capacity (int): number of samples kept in the ring buffer
+
+    Attributes:
+        num_pushed (int): number of samples pushed so far
+    """
+    def __init__(self, name = DEFAULT_NAME, series = MONITOR_SERIES, capacity = 48*12):
+        self.name = name
+        self.series = list(series)
+        self.capacity = capacity
+        size = HEADER_FIELDS*8 + NAMES_BYTES + capacity*(1 + len(self.series))*8
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError: # left over from a crashed run
+            old = shared_memory.SharedMemory(name=name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        self.header, names, self.data = _layout(self.shm.buf, capacity, len(self.series))
+        encoded = json.dumps(self.series).encode('utf-8')
+        names[:len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+        self.header[:] = [MAGIC, capacity, len(self.series), 0, time.time_ns(), len(encoded)]
+        self.num_pushed = 0
+
+    def push(self, seconds, curves):
+        """Writes the latest samples of curves into the ring buffer
+
+        Args:
+            seconds (int): simulation time in seconds
+            curves (CURVES_TO_PLOT): the recorded statistics
+        """
+        row = self.data[self.num_pushed % self.capacity]
+        row[0] = seconds/3600
+        for k, series in enumerate(self.series):
+            values = getattr(curves, series)
+            row[k+1] = values[-1] if len(values) > 0 else np.nan
+        self.num_pushed += 1
+        self.header[3] = self.num_pushed # publish the row after it is complete
+
+    def close(self):
+        del self.header, self.data
+        self.shm.close()
+        self.shm.unlink()
+
+
+class MONITOR_VIEW:
+    """Reader side of the live monitor, attaches to the ring buffer of a running substation
+
+    Args:
+        name (str): name of the shared memory block
+    """
+    def __init__(self, name = DEFAULT_NAME):
+        self.shm = attach_shared_memory(name)
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=self.shm.buf)
+        if header[0] != MAGIC:
+            raise ValueError('{} is not a live monitor buffer'.format(name))
+        capacity, num_series = int(header[1]), int(header[2])
+        self.header, names, self.data = _layout(self.shm.buf, capacity, num_series)
+        self.capacity = capacity
+        self.run_id = int(self.header[4])
+        self.series = json.loads(bytes(names[:int(self.header[5])]).decode('utf-8'))
+
+    def read(self):
+        """Copies the samples currently in the buffer, oldest first
+
+        Returns:
+            (np.ndarray, dict): time in hours and the values keyed by series name
+        """
+        count_before = int(self.header[3])
+        snapshot = self.data.copy()
+        count_after = int(self.header[3])
+        # samples pushed while copying (and the one being written now) may have overwritten the oldest slots
+        first = max(0, count_after + 1 - self.capacity)
+        rows = snapshot[np.arange(first, count_before) % self.capacity]
+        return rows[:, 0], {series: rows[:, k+1] for k, series in enumerate(self.series)}
+
+    def close(self):
+        del self.header, self.data
+        self.shm.close()
+
+
+def attach_shared_memory(name):
+    # attach without registering the block, otherwise the resource tracker of the viewer unlinks it at exit
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+def run_viewer(name, fps):
+    import matplotlib.pyplot as plt
+    fig, (ax1, ax2, ax3, ax4, ax5) = plt.subplots(5)
+    view = None
+    while plt.fignum_exists(fig.number):
+        if view is None:
+            try:
+                view = MONITOR_VIEW(name)
+                print('attached to', name, flush=True)
+            except (FileNotFoundError, ValueError):
+                plt.pause(1.0) # no substation running yet
+                continue
+        try: # the substation replaced or removed the buffer
+            current = attach_shared_memory(name)
+            run_id = int(np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=current.buf)[4])
+            current.close()
+        except FileNotFoundError:
+            run_id = None
+        if run_id != view.run_id:
+            view.close()
+            view = None
+            print('detached from', name, flush=True)
+            continue
+
+        t, s = view.read()
+        ax1.cla()
+        ax1.set_ylabel("VPP Load (kW)")
+        ax1.plot(t, s['vpp_load_p'])
+        ax1.legend(['VPP Load'])
+
+        ax2.cla()
+        ax2.set_ylabel("House Load (kW)")
+        ax2.plot(t, s['house_load_max'])
+        ax2.plot(t, s['house_load_mean'])
+        ax2.plot(t, s['house_load_min'])
+        ax2.legend(['max', 'mean', 'min'])
+
+        ax3.cla()
+        ax3.set_ylabel("Temperature (degF)")
+        ax3.plot(t, s['temp_max'])
+        ax3.plot(t, s['temp_mean'])
+        ax3.plot(t, s['temp_min'])
+        ax3.plot(t, s['basepoint_mean'])
+        ax3.plot(t, s['setpoint_mean'])
+        ax3.legend(['max', 'mean', 'min', 'base-point', 'set-point'])
+
+        ax4.cla()
+        ax4.set_ylabel("Cleared Price ($)")
+        ax4.plot(t, s['cleared_price'])
+
+        ax5.cla()
+        ax5.set_xlabel("Time (h)")
+        ax5.set_ylabel("Percentage")
+        ax5.plot(t, s['hvac_on_ratio'])
+        ax5.plot(t, s['buyer_ratio'])
+        ax5.plot(t, s['seller_ratio'])
+        ax5.plot(t, s['nontcp_ratio'])
+        ax5.legend(['HVAC-ON ratio', 'Buyer ratio', 'Seller ratio', 'None-participant ratio'])
+
+        plt.pause(1.0/fps)
+    if view is not None:
+        view.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='live plots of a running PET substation federate')
+    parser.add_argument('--name', default=DEFAULT_NAME, help='name of the shared memory block')
+    parser.add_argument('--fps', type=float, default=2.0, help='redraws per second')
+    args = parser.parse_args()
+    run_viewer(args.name, args.fps)
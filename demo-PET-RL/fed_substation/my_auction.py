@@ -16,6 +16,31 @@ import helics
 import numpy as np
 import my_tesp_support_api.helpers as helpers
 
+
+def sequential_sum(values):
+    # left to right sum, bitwise the same as accumulating the values in a loop
+    if len(values) == 0:
+        return 0
+    return np.cumsum(values)[-1]
+
+
+def sequential_split(quantity, mask):
+    """Sums quantity where mask is True and where it is False, in the same order as a loop would
+    """
+    return sequential_sum(np.where(mask, quantity, 0.0)), sequential_sum(np.where(mask, 0.0, quantity))
+
+
+def running_remainder(total, quantity):
+    """What is left of total before each quantity is taken, as a loop subtracting one by one would have it
+    """
+    return np.cumsum(np.concatenate(([total], -quantity)))[:-1]
+
+
+def first_false(mask):
+    # index of the first False entry, len(mask) if all are True
+    return int(np.argmin(mask)) if not np.all(mask) else len(mask)
+
+
 # Class definition
 class AUCTION:
     """This class implements a simplified version of the double-auction market embedded in GridLAB-D.
@@ -26,6 +51,8 @@ class AUCTION:
     Args:
         dict (dict): a row from the agent configuration JSON file
         key (str): the name of this agent, which is the market key from the agent configuration JSON file
+        clearing_engine (str): 'loop' walks the curves bid by bid, 'vectorized' finds the crossing
+            of the curves with cumulative sums and searchsorted; both give the same results
 
     Attributes:
         name (str): the name of this auction, also the market key from the configuration JSON file
@@ -39,8 +66,8 @@ class AUCTION:
         stat_interval (str): always 86400 seconds, for one day, not used, from dict
         stat_type (str): always mean and standard deviation, not used, from dict
         stat_value (str): always zero, not used, from dict
-        curve_buyer (curve): data structure to accumulate buyer bids
-        curve_seller (curve): data structure to accumulate seller bids
+        curve_buyer (array_curve): data structure to accumulate buyer bids
+        curve_seller (array_curve): data structure to accumulate seller bids
         refload (float): the latest substation load from GridLAB-D
         lmp (float): the latest locational marginal price from the bulk system market
         unresp (float): unresponsive load, i.e., total substation load less the bidding, running HVACs
@@ -57,8 +84,9 @@ class AUCTION:
         clearing_scalar (float): used for interpolation at boundary cases, always 0.5
     """
     # ====================Define instance variables ===================================
-    def __init__(self,dict,key):
+    def __init__(self,dict,key, clearing_engine = 'loop'):
         self.name = key
+        self.clearing_engine = clearing_engine
         self.std_dev = float(dict['init_stdev'])
         self.mean = float(dict['init_price'])
         self.period = float(dict['period'])
@@ -73,6 +101,8 @@ class AUCTION:
 
         # updated in collect_agent_bids, used in clear_market
         self.bids = []
+        self.buyer_points = []
+        self.seller_points = []
         self.curve_buyer = None
         self.curve_seller = None
 
@@ -160,9 +190,11 @@ class AUCTION:
     def clear_bids (self):
         """Re-initializes curve_buyer and curve_seller, sets the unresponsive load estimate to the total substation load.
         """
-        self.curve_buyer = helpers.curve ()
-        self.curve_seller = helpers.curve ()
+        self.curve_buyer = helpers.array_curve ()
+        self.curve_seller = helpers.array_curve ()
         self.bids.clear()
+        self.buyer_points = [] # (price, quantity, is_on) of the collected bids, added to the curves by aggregate_bids
+        self.seller_points = []
         # self.unresp = self.refload
         self.unresp = 0 # modified by Yuanliang
         # added
@@ -179,7 +211,7 @@ class AUCTION:
         """
         price = bid[0]
         quantity = bid[1]
-        self.curve_seller.add_to_curve (price, quantity, False)
+        self.seller_points.append((price, quantity, False))
 
     def collect_bid (self, bid):
         """Gather HVAC bids into curve_buyer
@@ -202,13 +234,13 @@ class AUCTION:
         if role == "seller":
             self.unresp_seller -= quantity
             if price > 0 and quantity > 0.0:
-                self.curve_seller.add_to_curve (price, quantity, True)
+                self.seller_points.append((price, quantity, True))
         elif role == "buyer":
             if not base_covered:
                 self.unresp += unresp_load # the calculation of unresponsive load may need be updated
             # it should collect the unresponsive load from houses, but also from other devices and loss
             if price > 0 and quantity > 0.0:
-                self.curve_buyer.add_to_curve (price, quantity, hvac_needed)
+                self.buyer_points.append((price, quantity, hvac_needed))
 
         # if is_on:
         #     self.unresp -= quantity
@@ -221,8 +253,18 @@ class AUCTION:
     def add_unresponsive_load(self, quantity):
         self.unresp += quantity
 
+    def add_collected_bids(self):
+        # the collected bids go into the curves in one bulk append per curve, in the order they were collected
+        for curve, points in ((self.curve_buyer, self.buyer_points), (self.curve_seller, self.seller_points)):
+            if len(points) > 0:
+                prices, quantities, is_on = zip(*points)
+                curve.add_bids(prices, quantities, is_on)
+            points.clear()
+
     def aggregate_bids(self):
 
+        self.add_collected_bids()
+
         # for buyers
         #Aggregates the unresponsive load and responsive load bids for submission to the bulk system market
         if self.unresp > 0:
@@ -315,50 +357,10 @@ class AUCTION:
         ## add finish
 
         if self.curve_buyer.count > 0 and self.curve_seller.count > 0:
-            a = self.pricecap
-            b = -self.pricecap
-            check = 0
-            demand_quantity = supply_quantity = 0
-            for i in range(self.curve_seller.count):
-                if self.curve_seller.price[i] == self.pricecap:
-                    self.unresponsive_sell += self.curve_seller.quantity[i]
-                else:
-                    self.responsive_sell += self.curve_seller.quantity[i]
-            for i in range(self.curve_buyer.count):
-                if self.curve_buyer.price[i] == self.pricecap:
-                    self.unresponsive_buy += self.curve_buyer.quantity[i]
-                else:
-                    self.responsive_buy += self.curve_buyer.quantity[i]
-            # Calculate clearing quantity and price here
-            # Define the section number of the buyer and the seller curves respectively as i and j
-            i = j = 0
-            self.clearing_type = helpers.ClearingType.NULL
-            self.clearing_quantity = self.clearing_price = 0
-            while i < self.curve_buyer.count and j < self.curve_seller.count and self.curve_buyer.price[i] >= self.curve_seller.price[j]:
-                buy_quantity = demand_quantity + self.curve_buyer.quantity[i]
-                sell_quantity = supply_quantity + self.curve_seller.quantity[j]
-                # If marginal buyer currently:
-                if buy_quantity > sell_quantity:
-                    self.clearing_quantity = supply_quantity = sell_quantity
-                    a = b = self.curve_buyer.price[i]
-                    j += 1
-                    check = 0
-                    self.clearing_type = helpers.ClearingType.BUYER
-                # If marginal seller currently:
-                elif buy_quantity < sell_quantity:
-                    self.clearing_quantity = demand_quantity = buy_quantity
-                    a = b = self.curve_seller.price[j]
-                    i += 1
-                    check = 0
-                    self.clearing_type = helpers.ClearingType.SELLER
-                # Buy quantity equal sell quantity but price split  
-                else:
-                    self.clearing_quantity = demand_quantity = supply_quantity = buy_quantity
-                    a = self.curve_buyer.price[i]
-                    b = self.curve_seller.price[j]
-                    i += 1
-                    j += 1
-                    check = 1
+            if self.clearing_engine == 'vectorized':
+                i, j, a, b, check, demand_quantity, supply_quantity = self.walk_curves_vectorized()
+            else:
+                i, j, a, b, check, demand_quantity, supply_quantity = self.walk_curves()
             # End of the curve comparison, and if EXACT, get the clear price
             if a == b:
                 self.clearing_price = a 
@@ -493,7 +495,136 @@ class AUCTION:
                 missingBidder = "buyer"
             print ('  Market %s fails to clear due to missing %s' % (self.name, missingBidder), flush=True)
             
-        # Calculation of the marginal 
+        # Calculation of the marginal
+        if self.clearing_engine == 'vectorized':
+            self.marginal_vectorized()
+        else:
+            self.marginal_loop()
+        # print ('##', time_granted, tnext_clear, self.clearing_type, self.clearing_quantity, 
+        #        self.clearing_price,
+        #        self.curve_buyer.count, self.unresponsive_buy, self.responsive_buy,
+        #        self.curve_seller.count, self.unresponsive_sell, self.responsive_sell,
+        #        self.marginal_quantity, self.marginal_frac, self.lmp, self.refload,
+        #        self.consumerSurplus, self.averageConsumerSurplus, self.supplierSurplus,
+        #        self.unrespSupplierSurplus, sep=',', flush=True)
+
+    def walk_curves(self):
+        """Walks the buyer and seller curves bid by bid until they cross
+
+        Also splits the quantity of both curves into responsive and unresponsive parts.
+
+        Returns:
+            (int, int, float, float, int, float, float): buyer index i, seller index j, last buyer price a,
+            last seller price b, check (1 if the last step matched both quantities), demand_quantity and supply_quantity
+        """
+        a = self.pricecap
+        b = -self.pricecap
+        check = 0
+        demand_quantity = supply_quantity = 0
+        for i in range(self.curve_seller.count):
+            if self.curve_seller.price[i] == self.pricecap:
+                self.unresponsive_sell += self.curve_seller.quantity[i]
+            else:
+                self.responsive_sell += self.curve_seller.quantity[i]
+        for i in range(self.curve_buyer.count):
+            if self.curve_buyer.price[i] == self.pricecap:
+                self.unresponsive_buy += self.curve_buyer.quantity[i]
+            else:
+                self.responsive_buy += self.curve_buyer.quantity[i]
+        # Calculate clearing quantity and price here
+        # Define the section number of the buyer and the seller curves respectively as i and j
+        i = j = 0
+        self.clearing_type = helpers.ClearingType.NULL
+        self.clearing_quantity = self.clearing_price = 0
+        while i < self.curve_buyer.count and j < self.curve_seller.count and self.curve_buyer.price[i] >= self.curve_seller.price[j]:
+            buy_quantity = demand_quantity + self.curve_buyer.quantity[i]
+            sell_quantity = supply_quantity + self.curve_seller.quantity[j]
+            # If marginal buyer currently:
+            if buy_quantity > sell_quantity:
+                self.clearing_quantity = supply_quantity = sell_quantity
+                a = b = self.curve_buyer.price[i]
+                j += 1
+                check = 0
+                self.clearing_type = helpers.ClearingType.BUYER
+            # If marginal seller currently:
+            elif buy_quantity < sell_quantity:
+                self.clearing_quantity = demand_quantity = buy_quantity
+                a = b = self.curve_seller.price[j]
+                i += 1
+                check = 0
+                self.clearing_type = helpers.ClearingType.SELLER
+            # Buy quantity equal sell quantity but price split  
+            else:
+                self.clearing_quantity = demand_quantity = supply_quantity = buy_quantity
+                a = self.curve_buyer.price[i]
+                b = self.curve_seller.price[j]
+                i += 1
+                j += 1
+                check = 1
+        return i, j, a, b, check, demand_quantity, supply_quantity
+
+    def walk_curves_vectorized(self):
+        """Same result as walk_curves, computed on cumulative sums of the curves
+
+        The walk advances over the buyer and seller cumulative quantities in increasing
+        order, so its states are given by searchsorted on the union of both cumulative
+        sums. The walk stops at the first state where the buyer price drops below the seller
+        price or a curve is exhausted. Falls back to walk_curves if a quantity is not positive.
+        """
+        pb = np.asarray(self.curve_buyer.price, dtype=float)
+        qb = np.asarray(self.curve_buyer.quantity, dtype=float)
+        ps = np.asarray(self.curve_seller.price, dtype=float)
+        qs = np.asarray(self.curve_seller.quantity, dtype=float)
+        if not (np.all(qb > 0) and np.all(qs > 0)):
+            return self.walk_curves()
+        nb = len(pb)
+        ns = len(ps)
+
+        # sequential sums, bitwise the same as the running sums of the loop
+        self.unresponsive_buy, self.responsive_buy = sequential_split(qb, pb == self.pricecap)
+        self.unresponsive_sell, self.responsive_sell = sequential_split(qs, ps == self.pricecap)
+        cum_buy = self.curve_buyer.cumulative_quantity # cached with the sorted curve
+        cum_sell = self.curve_seller.cumulative_quantity
+
+        # state t of the walk is (i[t], j[t]); every step consumes the next cumulative value of either or both curves
+        steps = np.union1d(cum_buy, cum_sell)
+        i_state = np.concatenate(([0], np.searchsorted(cum_buy, steps, side='right')))
+        j_state = np.concatenate(([0], np.searchsorted(cum_sell, steps, side='right')))
+        going = (i_state < nb) & (j_state < ns) & (pb[np.minimum(i_state, nb-1)] >= ps[np.minimum(j_state, ns-1)])
+        T = int(np.argmin(going)) # number of steps, the last state always stops the walk
+
+        i = int(i_state[T])
+        j = int(j_state[T])
+        demand_quantity = cum_buy[i-1] if i > 0 else 0
+        supply_quantity = cum_sell[j-1] if j > 0 else 0
+        self.clearing_type = helpers.ClearingType.NULL
+        self.clearing_quantity = self.clearing_price = 0
+        if T == 0:
+            return i, j, self.pricecap, -self.pricecap, 0, demand_quantity, supply_quantity
+
+        buyer_step = np.diff(i_state[:T+1]) > 0
+        seller_step = np.diff(j_state[:T+1]) > 0
+        single = np.flatnonzero(buyer_step != seller_step)
+        if len(single) > 0: # the clearing type comes from the last step that did not match both quantities
+            self.clearing_type = helpers.ClearingType.SELLER if buyer_step[single[-1]] else helpers.ClearingType.BUYER
+
+        check = 0
+        if buyer_step[-1] and seller_step[-1]: # quantities matched, price split
+            self.clearing_quantity = demand_quantity
+            a = pb[i-1]
+            b = ps[j-1]
+            check = 1
+        elif seller_step[-1]: # marginal buyer
+            self.clearing_quantity = supply_quantity
+            a = b = pb[i]
+        else: # marginal seller
+            self.clearing_quantity = demand_quantity
+            a = b = ps[j]
+        return i, j, a, b, check, demand_quantity, supply_quantity
+
+    def marginal_loop(self):
+        """Calculates marginal_quantity and marginal_frac of the marginal buyer or seller
+        """
         marginal_total = self.marginal_quantity = self.marginal_frac = 0.0
         if self.clearing_type == helpers.ClearingType.BUYER:
             marginal_subtotal = 0
@@ -532,13 +663,35 @@ class AUCTION:
         else:
             self.marginal_quantity = 0.0
             self.marginal_frac = 0.0
-        # print ('##', time_granted, tnext_clear, self.clearing_type, self.clearing_quantity, 
-        #        self.clearing_price,
-        #        self.curve_buyer.count, self.unresponsive_buy, self.responsive_buy,
-        #        self.curve_seller.count, self.unresponsive_sell, self.responsive_sell,
-        #        self.marginal_quantity, self.marginal_frac, self.lmp, self.refload,
-        #        self.consumerSurplus, self.averageConsumerSurplus, self.supplierSurplus,
-        #        self.unrespSupplierSurplus, sep=',', flush=True)
+
+    def marginal_vectorized(self):
+        """Same result as marginal_loop, computed with array operations
+        """
+        self.marginal_quantity = self.marginal_frac = 0.0
+        if self.clearing_type == helpers.ClearingType.BUYER:
+            crv = self.curve_buyer
+        elif self.clearing_type == helpers.ClearingType.SELLER:
+            crv = self.curve_seller
+        else:
+            return
+        price = np.asarray(crv.price, dtype=float)
+        quantity = np.asarray(crv.quantity, dtype=float)
+        marginal_subtotal = 0
+        i = 0
+        if crv.count > 0:
+            # the bids before the first one not above the clearing price
+            above = price > self.clearing_price
+            n_above = crv.count if above.all() else int(np.argmin(above))
+            if n_above > 0:
+                marginal_subtotal = crv.cumulative_quantity[n_above-1]
+            i = min(n_above, crv.count - 1)
+        self.marginal_quantity = self.clearing_quantity - marginal_subtotal
+        marginal_total = 0.0
+        if crv.count > 0 and price[i] == self.clearing_price:
+            # the loop adds the quantity of bid i once for every remaining bid
+            marginal_total = np.cumsum(np.full(crv.count - i, quantity[i]))[-1]
+        if marginal_total > 0.0:
+            self.marginal_frac = float(self.marginal_quantity) / marginal_total
 
     def surplusCalculation(self, tnext_clear=0, time_granted=0):
         """Calculates consumer surplus (and its average) and supplier surplus.
@@ -553,6 +706,40 @@ class AUCTION:
         :param time_granted (int): the current time in FNCS seconds, for the log file only
         :return: None
         """
+        if self.clearing_engine == 'vectorized':
+            grantedRespQuantity = self.surplus_vectorized()
+        else:
+            grantedRespQuantity = self.surplus_loop()
+        if grantedRespQuantity != 0.0:
+            print('cleared {:.4f} more quantity than supplied.'.format(grantedRespQuantity))
+        print ('##', 
+               time_granted, 
+               tnext_clear, 
+               self.clearing_type, 
+               '{:.3f}'.format(self.clearing_quantity), 
+               '{:.6f}'.format(self.clearing_price),
+               self.curve_buyer.count, 
+               '{:.3f}'.format(self.unresponsive_buy), 
+               '{:.3f}'.format(self.responsive_buy),
+               self.curve_seller.count, 
+               '{:.3f}'.format(self.unresponsive_sell), 
+               '{:.3f}'.format(self.responsive_sell),
+               '{:.3f}'.format(self.marginal_quantity), 
+               '{:.6f}'.format(self.marginal_frac), 
+               '{:.6f}'.format(self.lmp), 
+               '{:.3f}'.format(self.refload),
+               '{:.4f}'.format(self.consumerSurplus), 
+               '{:.4f}'.format(self.averageConsumerSurplus), 
+               '{:.4f}'.format(self.supplierSurplus),
+               '{:.4f}'.format(self.unrespSupplierSurplus), 
+               sep=',', flush=True)
+
+    def surplus_loop(self):
+        """Calculates the surpluses bid by bid, see surplusCalculation
+
+        Returns:
+            float: responsive quantity cleared but not covered by the sellers
+        """
         numberOfUnrespBuyerAboveClearingPrice = 0
         numberOfResponsiveBuyerAboveClearingPrice = 0
         self.supplierSurplus = 0.0
@@ -614,29 +801,77 @@ class AUCTION:
                     self.supplierSurplus += (self.clearing_price - self.curve_seller.price[i]) * grantedRespQuantity
                     grantedRespQuantity = 0.0
                     break
-        if grantedRespQuantity != 0.0:
-            print('cleared {:.4f} more quantity than supplied.'.format(grantedRespQuantity))
-        print ('##', 
-               time_granted, 
-               tnext_clear, 
-               self.clearing_type, 
-               '{:.3f}'.format(self.clearing_quantity), 
-               '{:.6f}'.format(self.clearing_price),
-               self.curve_buyer.count, 
-               '{:.3f}'.format(self.unresponsive_buy), 
-               '{:.3f}'.format(self.responsive_buy),
-               self.curve_seller.count, 
-               '{:.3f}'.format(self.unresponsive_sell), 
-               '{:.3f}'.format(self.responsive_sell),
-               '{:.3f}'.format(self.marginal_quantity), 
-               '{:.6f}'.format(self.marginal_frac), 
-               '{:.6f}'.format(self.lmp), 
-               '{:.3f}'.format(self.refload),
-               '{:.4f}'.format(self.consumerSurplus), 
-               '{:.4f}'.format(self.averageConsumerSurplus), 
-               '{:.4f}'.format(self.supplierSurplus),
-               '{:.4f}'.format(self.unrespSupplierSurplus), 
-               sep=',', flush=True)
+        return grantedRespQuantity
+
+    def surplus_vectorized(self):
+        """Same result as surplus_loop, computed with array operations
+
+        The sellers below the clearing price serve the unresponsive load first and then
+        the responsive load. The quantity left to serve before each seller is a running
+        subtraction, taken from np.cumsum (which adds left to right), and the surpluses
+        are sequential sums of the same terms, so all results are bitwise the same as in
+        surplus_loop.
+
+        Returns:
+            float: responsive quantity cleared but not covered by the sellers
+        """
+        pb = np.asarray(self.curve_buyer.price, dtype=float)
+        qb = np.asarray(self.curve_buyer.quantity, dtype=float)
+        ps = np.asarray(self.curve_seller.price, dtype=float)
+        qs = np.asarray(self.curve_seller.quantity, dtype=float)
+        if not np.all(qs > 0):
+            return self.surplus_loop()
+        cp = self.clearing_price
+
+        granted = pb >= cp
+        unresp = granted & (pb == self.pricecap)
+        resp = granted & (pb != self.pricecap)
+        grantedUnrespQuantity = sequential_sum(np.where(unresp, qb, 0.0))
+        grantedRespQuantity = sequential_sum(np.where(resp, qb, 0.0))
+        numberOfResponsiveBuyerAboveClearingPrice = int(np.count_nonzero(resp))
+        self.consumerSurplus = sequential_sum(np.where(resp, (pb - cp) * qb, 0.0))
+        self.averageConsumerSurplus = 0.0
+        if numberOfResponsiveBuyerAboveClearingPrice != 0:
+            self.averageConsumerSurplus = self.consumerSurplus / numberOfResponsiveBuyerAboveClearingPrice
+
+        # sellers below the clearing price, in seller order
+        selected = ps <= cp
+        q = qs[selected]
+        margin = cp - ps[selected] # surplus per unit of each seller
+
+        # the unresponsive load takes the whole quantity of the first m sellers
+        unresp_left = running_remainder(grantedUnrespQuantity, q)
+        m = first_false(unresp_left >= q)
+        unresp_terms = [margin[:m] * q[:m]]
+        resp_terms = []
+        start = m
+        if m < len(q) and unresp_left[m] != 0.0:
+            # seller m covers the rest of the unresponsive load, the responsive load gets the leftover
+            unresp_terms.append(margin[m:m+1] * unresp_left[m])
+            leftover = q[m] - unresp_left[m]
+            if grantedRespQuantity >= leftover:
+                resp_terms.append(margin[m:m+1] * leftover)
+                grantedRespQuantity -= leftover
+                start = m + 1
+            else:
+                resp_terms.append(margin[m:m+1] * grantedRespQuantity)
+                grantedRespQuantity = 0.0
+                start = len(q)
+        self.unrespSupplierSurplus = float(sequential_sum(np.concatenate(unresp_terms)))
+
+        # the responsive load takes the whole quantity of the next sellers, then a part of one more
+        if start < len(q):
+            resp_left = running_remainder(grantedRespQuantity, q[start:])
+            k = first_false(resp_left >= q[start:])
+            resp_terms.append(margin[start:start+k] * q[start:start+k])
+            if start + k < len(q):
+                resp_terms.append(margin[start+k:start+k+1] * resp_left[k])
+                grantedRespQuantity = 0.0
+            else:
+                grantedRespQuantity = resp_left[-1] - q[-1]
+        self.supplierSurplus = float(sequential_sum(np.concatenate(resp_terms))) if resp_terms else 0.0
+        return grantedRespQuantity
+
 
     def publish_cleared_market_information(self):
 
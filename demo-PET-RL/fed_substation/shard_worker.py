@@ -0,0 +1,120 @@
+# file: shard_worker.py
+"""
+Function:
+        run one shard of the houses of the substation federate in its own process, see house_shards.py
+        the worker is a HELICS federate holding the interfaces of its houses; it runs the phases sent by the
+        coordinator (launch_substation.py) and writes the house state and bids to the shared tables
+usage:  started by HOUSE_SHARDS as 'python shard_worker.py shards/shard<k>.json'
+"""
+
+import sys
+sys.path.append('..')
+import os
+import json
+import traceback
+import helics
+from multiprocessing.connection import Client
+from PET_Prosumer import HOUSE
+from house_population import HousePopulation
+from my_auction import AUCTION
+from federate_helper import FEDERATE_HELPER
+from house_shards import SHARD_TABLES, ROLE_CODES
+import my_tesp_support_api.grant_trace as grant_trace
+
+
+with open(sys.argv[1], encoding='utf-8') as f:
+  settings = json.load(f)
+start, stop = settings['start'], settings['stop']
+conn = Client(tuple(settings['address']), authkey=bytes.fromhex(os.environ['PET_SHARD_KEY']))
+conn.send(settings['shard'])
+
+# a federate with the HELICS interfaces of the houses of this shard only
+fh = FEDERATE_HELPER(settings['agent_config'], settings['helics_config'], settings['metrics_root'], settings['hour_stop'])
+fh.set_shard(fh.house_name_list[start:stop], settings['topic_root'])
+fh.lookahead = settings.get('lookahead', 0) # same time delays as the substation federate
+fh.input_delay = settings.get('input_delay', 0)
+fh.create_federate()
+fh.register_pubssubs()
+helics.helicsFederateEnterExecutingMode(fh.hFed)
+tracer = grant_trace.GRANT_TRACER(fh.fedName) # writes the time grants when PET_GRANT_TRACE is set
+
+# the market parameters the houses start from, the market itself runs in the coordinator
+auction = AUCTION(fh.market_row, fh.market_key)
+auction.initAuction()
+
+houses = {}
+seed = 1 + start # same seeds as the houses get in a single substation process
+for key in fh.local_house_names:
+  info = fh.housesInfo_dict[key]
+  houses[key] = HOUSE(key, info, fh.agents_dict, auction, seed)
+  houses[key].get_helics_subspubs(fh.get_agent_pubssubs(key, 'house', info), fh.pub_cache)
+  houses[key].set_meter_mode()
+  houses[key].get_cleared_price(auction.clearing_price)
+  houses[key].hvac.turn_OFF()
+  seed += 1
+
+if settings.get('has_RL'):
+  from env import BIDING_ENV
+  from ddpg import DDPG
+  for key, house in houses.items():
+    house.rl_env = BIDING_ENV(settings['num_houses'], key, house.hvac.price_cap, settings['hour_stop']*3600, 'seller-buyer')
+    if house.rl_env.has_seller_agent:
+      house.rl_agent_seller = DDPG(house.rl_env)
+    if house.rl_env.has_buyer_agent:
+      house.rl_agent_buyer = DDPG(house.rl_env)
+
+# the population columns are the rows of this shard in the shared tables, the coordinator reads them
+tables = SHARD_TABLES(settings['num_houses'], settings['tables'])
+population = HousePopulation(houses, fh.input_snapshot, tables.columns(start, stop))
+bids = tables.bids[start:stop]
+print('shard ready:', fh.fedName, len(houses), 'houses', flush=True)
+
+
+def run_phase(phase, time_granted, hod, dow, payload):
+  """ the house part of the substation phases of launch_substation.py"""
+  if phase == 'update':
+    population.step(time_granted, hod, dow)
+  elif phase == 'control':
+    for house in houses.values():
+      if house.hasBatt:
+        house.battery.auto_control()
+  elif phase == 'lmp':
+    for house in houses.values():
+      house.get_lmp_from_market(payload)
+  elif phase == 'bid':
+    for i, house in enumerate(houses.values()):
+      bid = house.formulate_bid() # [bid_price, quantity, hvac.power_needed, role, unres_kw, name, base_covered]
+      bids[i] = [bid[0], bid[1], float(bid[2]), ROLE_CODES.get(bid[3], 0), bid[4], float(bid[6])]
+  elif phase == 'clear':
+    auction_info, market_condition, marginal_quantity = payload
+    for house in houses.values():
+      house.get_cleared_market_information(auction_info)
+      house.calculate_reward()
+      house.publish_meter_price()
+      house.post_market_control(market_condition, marginal_quantity)
+  elif phase == 'adjust':
+    for house in houses.values():
+      house.demand_response()
+  else:
+    raise ValueError('unknown phase ' + phase)
+
+
+time_granted = 0
+while True:
+  phase, time_next, hod, dow, payload = conn.recv()
+  if phase == 'stop':
+    break
+  try:
+    while time_granted < time_next: # the coordinator was granted time_next, so is this federate
+      time_granted = int(tracer.request_time(fh.hFed, time_next))
+    run_phase(phase, time_granted, hod, dow, payload)
+    conn.send(('done',))
+  except Exception:
+    conn.send(('error', traceback.format_exc()))
+    raise
+
+print('shard', fh.fedName, 'publications suppressed by the cache:', fh.pub_cache.num_suppressed, flush=True)
+population = bids = None # release the views on the shared tables
+tables.close()
+conn.close()
+fh.destroy_federate()
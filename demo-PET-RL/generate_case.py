@@ -8,6 +8,7 @@ modified by Yuanliang Li
 """
 
 import os
+import json
 import numpy as np
 from glmhelper import GLM_HELPER
 import my_tesp_support_api.api as tesp
@@ -40,6 +41,13 @@ class GLOBAL_Configuration:
     ratio_PV_generation_list = [100/100] # PV generation ratio for each VPP
     battery_mode = 'LOAD_FOLLOWING'  # CONSTANT_PQ
 
+# a scenario folder made by run_scenarios.py overrides some of the configurations
+if os.path.exists('case_config.json'):
+    with open('case_config.json', encoding='utf-8') as f:
+        for key, value in json.load(f).items():
+            setattr(GLOBAL_Configuration, key, value)
+    GLOBAL_Configuration.num_house_list = np.array(GLOBAL_Configuration.num_house_phase_list)
+
 glbal_config = GLOBAL_Configuration()
 glm = GLM_HELPER(glbal_config)
 glm.generate_glm()
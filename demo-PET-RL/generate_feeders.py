@@ -0,0 +1,125 @@
+# file: generate_feeders.py
+"""
+Function:
+        makes a multi-feeder case: K GridLAB-D feeder / substation federate pairs sharing one PyPower federate
+        the case made by generate_case.py is feeder 1 (gld1, sub1), feeders 2..K are copies of it in
+        feeders/feeder<k>/ with the federates gld<k> and sub<k>. Every feeder is a row of the DSO table of
+        PyPower (te30_pp.json): it publishes its load to its own dsoBus entry and gets the LMP and the
+        voltage of its bus. The feeders are put on the load buses 7, 5, 9, 7, 5, ... of the 9-bus system.
+usage:  python generate_case.py; python generate_feeders.py K [--amp 250]
+        then set "num_feeders": K in fed_substation/scenario.json (or the grid of run_scenarios.py), the
+        substation of feeder 1 launches the other feeders with the rest of the federates
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+
+DSO_BUSES = [7, 5, 9] # load buses of the 9-bus system, the DSO row of feeder 1 is on bus 7
+FEEDERS_PATH = 'feeders'
+GLD_MSG = 'fed_gridlabd/TE_Challenge_HELICS_gld_msg.json'
+SUBSTATION_FILES = ['fed_substation/TE_Challenge_HELICS_substation.json', 'fed_substation/TE_Challenge_agent_dict.json']
+PP_CASE = 'fed_pypower/te30_pp.json'
+PP_CONFIG = 'fed_pypower/pypowerConfig.json'
+# outputs of earlier runs that are not copied into a feeder folder
+IGNORED = shutil.ignore_patterns('*.log', '*_metrics.json', '*.xml')
+# PyPower inputs of a substation, named <DSO name>/<NAME> so PyPower knows the feeder of the input
+SUBSTATION_TOPICS = [('UNRESPONSIVE_MW', 'unresponsive_mw', 'double'), ('RESPONSIVE_MAX_MW', 'responsive_max_mw', 'double'),
+                     ('RESPONSIVE_C1', 'responsive_c1', 'double'), ('RESPONSIVE_C2', 'responsive_c2', 'double'),
+                     ('RESPONSIVE_DEG', 'responsive_deg', 'integer')]
+
+
+def load_json(path):
+  with open(path, encoding='utf-8') as f:
+    return json.load(f)
+
+
+def save_json(path, data):
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def rename_key(key, names):
+  """ replaces the federate name at the start of a HELICS key"""
+  fed, sep, rest = key.partition('/')
+  return names.get(fed, fed) + sep + rest if sep else key
+
+
+def make_feeder(case_root, k, bus):
+  """ copies the GridLAB-D and substation configs of feeder 1 into feeders/feeder<k>, returns the manifest entry"""
+  gld, sub = 'gld{}'.format(k), 'sub{}'.format(k)
+  folder = os.path.join(FEEDERS_PATH, 'feeder{}'.format(k))
+  root = os.path.join(case_root, folder)
+  if os.path.exists(root):
+    shutil.rmtree(root)
+  shutil.copytree(os.path.join(case_root, 'fed_gridlabd'), os.path.join(root, 'fed_gridlabd'), ignore=IGNORED)
+  os.makedirs(os.path.join(root, 'fed_substation'))
+  for file in SUBSTATION_FILES:
+    shutil.copy(os.path.join(case_root, file), os.path.join(root, file))
+  names = {'gld1': gld, 'sub1': sub}
+
+  # GridLAB-D: own name, the setpoints of its substation and the voltage of its bus, the school building stays on feeder 1
+  msg = load_json(os.path.join(root, GLD_MSG))
+  msg['name'] = gld
+  subs = []
+  for item in msg['subscriptions']:
+    if item['key'].startswith('eplus_agent/'):
+      continue
+    item['key'] = rename_key(item['key'], names).replace('three_phase_voltage_B7', 'three_phase_voltage_B{}'.format(bus))
+    subs.append(item)
+  msg['subscriptions'] = subs
+  save_json(os.path.join(root, GLD_MSG), msg)
+
+  # substation: own name, the measurements of its GridLAB-D and the LMP of its bus
+  msg = load_json(os.path.join(root, SUBSTATION_FILES[0]))
+  msg['name'] = sub
+  for item in msg['subscriptions']:
+    item['key'] = rename_key(item['key'], names).replace('LMP_B7', 'LMP_B{}'.format(bus))
+  save_json(os.path.join(root, SUBSTATION_FILES[0]), msg)
+  agents = load_json(os.path.join(root, SUBSTATION_FILES[1]))
+  agents['GridLABD'] = gld
+  save_json(os.path.join(root, SUBSTATION_FILES[1]), agents)
+  return {'name': 'feeder{}'.format(k), 'path': folder, 'gld': gld, 'substation': sub, 'bus': bus, 'dso': 'FEEDER{}'.format(k)}
+
+
+def configure_pypower(case_root, feeders, amp):
+  """ one DSO row per feeder in the PyPower case, the inputs of each substation and the publications of each bus"""
+  case = load_json(os.path.join(case_root, PP_CASE))
+  case['DSO'] = case['DSO'][:1] # feeder 1, made by generate_case.py
+  config = load_json(os.path.join(case_root, PP_CONFIG))
+  config['subscriptions'] = [item for item in config['subscriptions'] if not item.get('name', '').startswith('FEEDER')]
+  keys = set(item['key'] for item in config['publications'])
+  for feeder in feeders:
+    case['DSO'].append([feeder['bus'], feeder['dso'], amp if amp is not None else case['DSO'][0][2], '0.0'])
+    config['subscriptions'].append({'name': feeder['dso'], 'key': feeder['gld'] + '/distribution_load', 'type': 'complex'})
+    for name, topic, kind in SUBSTATION_TOPICS:
+      config['subscriptions'].append({'name': feeder['dso'] + '/' + name, 'key': feeder['substation'] + '/' + topic, 'type': kind})
+    for key, kind in [('three_phase_voltage_B{}', 'double'), ('LMP_B{}', 'double')]:
+      if key.format(feeder['bus']) not in keys:
+        keys.add(key.format(feeder['bus']))
+        config['publications'].append({'global': False, 'key': key.format(feeder['bus']), 'type': kind})
+  save_json(os.path.join(case_root, PP_CASE), case)
+  save_json(os.path.join(case_root, PP_CONFIG), config)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='make a case with K feeder/substation pairs sharing one PyPower federate')
+  parser.add_argument('num_feeders', type=int, help='number of feeders K, including the case itself')
+  parser.add_argument('--amp', type=float, default=None, help='load amplification of the new feeders in PyPower, as feeder 1 by default')
+  args = parser.parse_args()
+  if args.num_feeders < 1:
+    print('the case needs at least one feeder')
+    sys.exit(1)
+
+  case_root = os.path.dirname(os.path.abspath(__file__))
+  if os.path.exists(os.path.join(case_root, FEEDERS_PATH)):
+    shutil.rmtree(os.path.join(case_root, FEEDERS_PATH))
+  feeders = [make_feeder(case_root, k, DSO_BUSES[(k-1) % len(DSO_BUSES)]) for k in range(2, args.num_feeders + 1)]
+  configure_pypower(case_root, feeders, args.amp)
+  os.makedirs(os.path.join(case_root, FEEDERS_PATH), exist_ok=True)
+  save_json(os.path.join(case_root, FEEDERS_PATH, 'feeders.json'), {'feeders': feeders})
+  for feeder in feeders:
+    print('{} ({}, {}) on bus {}: {}'.format(feeder['name'], feeder['gld'], feeder['substation'], feeder['bus'], feeder['path']))
+  print('{} feeders, set "num_feeders": {} in the scenario to run them'.format(args.num_feeders, args.num_feeders))
@@ -24,6 +24,7 @@ import math
 import re
 from copy import deepcopy
 import my_tesp_support_api.helpers as helpers
+import my_tesp_support_api.grant_trace as grant_trace
 #import cProfile
 #import pstats
 if sys.platform != 'win32':
@@ -112,6 +113,9 @@ def make_dictionary(ppc, rootname):
   for i in range (dsoBus.shape[0]):
     busnum = int(dsoBus[i,0])
     busidx = busnum - 1
+    if str(busnum) in dsoBuses: # another feeder on the same bus
+      dsoBuses[str(busnum)]['GLDsubstations'].append(dsoBus[i,1])
+      continue
     dsoBuses[str(busnum)] = {'Pnom':float(bus[busidx,2]),'Qnom':float(bus[busidx,3]),'area':int(bus[busidx,6]),'zone':int(bus[busidx,10]),
       'ampFactor':float(dsoBus[i,2]),'GLDsubstations':[dsoBus[i,1]]}
 
@@ -173,6 +177,25 @@ def parse_mva(arg):
 
   return p, q
 
+def feeder_of(key, feeders):
+  """ Helper function to find the feeder (DSO row) of a HELICS input
+
+  The inputs of a feeder are named <DSO name> (the distribution load) or <DSO name>/<TOPIC>,
+  inputs without a DSO name (single feeder cases) belong to the first feeder.
+
+  Args:
+    key (str): name of the HELICS input
+    feeders (list): feeder dicts made from the DSO rows
+
+  Returns:
+    dict: the feeder of the input
+  """
+  tokens = key.split('/')
+  for feeder in feeders:
+    if feeder['name'] in tokens:
+      return feeder
+  return feeders[0]
+
 def pypower_loop (casefile, rootname, helicsConfig=None):
   """ Public function to start PYPOWER solutions under control of FNCS or HELICS
 
@@ -186,6 +209,9 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
   - *gen_rootname_metrics.json*; bulk system generator metrics, upon completion
   - *sys_rootname_metrics.json*; bulk system-level metrics, upon completion
 
+  Each row of the DSO table is one feeder (GridLAB-D and substation pair), several
+  feeders may connect to the same bus. The LMP and the voltage are published per DSO bus.
+
   Args:
     casefile (str): the configuring JSON file name, without extension
     rootname (str): the root filename for metrics output, without extension
@@ -237,9 +263,14 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
   n_accum = 0
   bus_accum = {}
   gen_accum = {}
-  for i in range (dsoBus.shape[0]):
-    busnum = int(dsoBus[i,0])
+  dso_buses = sorted(set(int(busnum) for busnum in dsoBus[:,0]))
+  for busnum in dso_buses:
     bus_accum[str(busnum)] = [0,0,0,0,0,0,0,99999.0]
+  feeders = []
+  for i in range (dsoBus.shape[0]):
+    feeders.append({'name':str(dsoBus[i,1]), 'busidx':int(dsoBus[i,0]) - 1, 'load_scale':float(dsoBus[i,2]),
+                    'sub_load':None, 'sub_unresp':None, 'sub_max':None, 'sub_c2':None, 'sub_c1':None, 'sub_deg':None,
+                    'unresp':0, 'resp_max':0, 'resp_c2':0, 'resp_c1':0, 'resp_deg':0, 'feeder_load':0})
   for i in range (gen.shape[0]):
     gen_accum[str(i+1)] = [0,0,0]
 
@@ -247,45 +278,42 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
   print ('t[s],Converged,Pload,P7 (csv),Unresp (opf),P7 (rpf),Resp (opf),GLD Pub,BID?,P7 Min,V7,LMP_P7,LMP_Q7,Pgen1,Pgen2,Pgen3,Pgen4,Pdisp,Deg,c2,c1', file=op, flush=True)
 
   hFed = None
-  pub_lmp = None
-  pub_volts = None
-  sub_load = None
-  sub_unresp = None
-  sub_max = None
-  sub_c2 = None
-  sub_c1 = None
-  sub_deg = None
+  pub_lmp = {}   # HELICS publications keyed by DSO bus number
+  pub_volts = {}
   if helicsConfig is not None:
     hFed = helics.helicsCreateValueFederateFromConfig(helicsConfig)
     fedName = helics.helicsFederateGetName(hFed)
+    tracer = grant_trace.GRANT_TRACER(fedName) # writes the time grants when PET_GRANT_TRACE is set
     pubCount = helics.helicsFederateGetPublicationCount(hFed)
     subCount = helics.helicsFederateGetInputCount(hFed)
     for i in range(pubCount):
       pub = helics.helicsFederateGetPublicationByIndex(hFed, i)
       key = helics.helicsPublicationGetKey (pub)
       print ('HELICS publication key', i, key)
-      if 'LMP_' in key:
-        pub_lmp = pub
-      elif 'three_phase_voltage_' in key:
-        pub_volts = pub
+      for busnum in dso_buses:
+        if key.endswith('LMP_B{:d}'.format(busnum)):
+          pub_lmp[busnum] = pub
+        elif key.endswith('three_phase_voltage_B{:d}'.format(busnum)):
+          pub_volts[busnum] = pub
     for i in range(subCount):
       sub = helics.helicsFederateGetInputByIndex(hFed, i)
       key = helics.helicsInputGetKey(sub)
       target = helics.helicsSubscriptionGetKey(sub)
       print ('HELICS subscription key', i, key, 'target', target)
       upper_target = target.upper() # FNCS-compatible matching
+      fdr = feeder_of(key, feeders)
       if 'RESPONSIVE_C2' in upper_target:
-        sub_c2 = sub
+        fdr['sub_c2'] = sub
       if 'RESPONSIVE_C1' in upper_target:
-        sub_c1 = sub
+        fdr['sub_c1'] = sub
       if 'RESPONSIVE_DEG' in upper_target:
-        sub_deg = sub
+        fdr['sub_deg'] = sub
       if 'RESPONSIVE_MAX_MW' in upper_target:
-        sub_max = sub
+        fdr['sub_max'] = sub
       if 'UNRESPONSIVE_MW' in upper_target:
-        sub_unresp = sub
+        fdr['sub_unresp'] = sub
       if 'distribution_load' in target:
-        sub_load = sub
+        fdr['sub_load'] = sub
     helics.helicsFederateEnterExecutingMode(hFed)
   else:
     fncs.initialize()
@@ -310,50 +338,54 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
     #  3) helicsInputIsUpdated resets to False immediately after you read the value, will become True if value changes later
     #  4) helicsInputLastUpdateTime is > 0 only after the other federate published its first value
     if hFed is not None: # HELICS inputs
-      if (sub_unresp is not None) and helics.helicsInputIsUpdated(sub_unresp):
-        unresp = helics.helicsInputGetDouble(sub_unresp) * load_scale
-        dsoBus[0][3] = unresp # to poke unresponsive estimate into the bus load slot
-      if (sub_c2 is not None) and helics.helicsInputIsUpdated(sub_c2):
-        resp_c2 = helics.helicsInputGetDouble(sub_c2) / load_scale
-      if (sub_c1 is not None) and helics.helicsInputIsUpdated(sub_c1):
-        resp_c1 = helics.helicsInputGetDouble(sub_c1)
-      if (sub_deg is not None) and helics.helicsInputIsUpdated(sub_deg):
-        resp_deg = helics.helicsInputGetInteger(sub_deg)
-      if (sub_max is not None) and helics.helicsInputIsUpdated(sub_max):
-#        print (ts,'resp_max updated before', helics.helicsInputIsUpdated(sub_max))
-        resp_max = helics.helicsInputGetComplex(sub_max)[0] * load_scale  # TODO: pyhelics needs to return complex instead of tuple
-#        print (ts,'resp_max updated after', helics.helicsInputIsUpdated(sub_max))
-        new_bid = True
-      if (sub_load is not None) and helics.helicsInputIsUpdated(sub_load):
-        cval = helics.helicsInputGetComplex(sub_load)  # TODO: pyhelics needs to return complex instead of tuple
-        gld_load = complex(cval[0], cval[1])
-        feeder_load = gld_load.real * load_scale / 1.0e6
-#      print ('HELICS inputs at', ts, feeder_load, load_scale, unresp, resp_max, resp_c2, resp_c1, resp_deg, new_bid)
-#      print ('HELICS resp_max', ts, resp_max, helics.helicsInputIsValid(sub_max), 
-#        helics.helicsInputIsUpdated(sub_max), helics.helicsInputLastUpdateTime(sub_max))
-    else:  # inputs coming from FNCS
+      for i, fdr in enumerate(feeders):
+        load_scale = fdr['load_scale']
+        if (fdr['sub_unresp'] is not None) and helics.helicsInputIsUpdated(fdr['sub_unresp']):
+          fdr['unresp'] = helics.helicsInputGetDouble(fdr['sub_unresp']) * load_scale
+          dsoBus[i][3] = fdr['unresp'] # to poke unresponsive estimate into the bus load slot
+        if (fdr['sub_c2'] is not None) and helics.helicsInputIsUpdated(fdr['sub_c2']):
+          fdr['resp_c2'] = helics.helicsInputGetDouble(fdr['sub_c2']) / load_scale
+        if (fdr['sub_c1'] is not None) and helics.helicsInputIsUpdated(fdr['sub_c1']):
+          fdr['resp_c1'] = helics.helicsInputGetDouble(fdr['sub_c1'])
+        if (fdr['sub_deg'] is not None) and helics.helicsInputIsUpdated(fdr['sub_deg']):
+          fdr['resp_deg'] = helics.helicsInputGetInteger(fdr['sub_deg'])
+        if (fdr['sub_max'] is not None) and helics.helicsInputIsUpdated(fdr['sub_max']):
+          fdr['resp_max'] = helics.helicsInputGetComplex(fdr['sub_max'])[0] * load_scale  # TODO: pyhelics needs to return complex instead of tuple
+          new_bid = True
+        if (fdr['sub_load'] is not None) and helics.helicsInputIsUpdated(fdr['sub_load']):
+          cval = helics.helicsInputGetComplex(fdr['sub_load'])  # TODO: pyhelics needs to return complex instead of tuple
+          gld_load = complex(cval[0], cval[1])
+          fdr['feeder_load'] = gld_load.real * load_scale / 1.0e6
+#      print ('HELICS inputs at', ts, feeders)
+    else:  # inputs coming from FNCS, a single feeder
+      fdr = feeders[0]
       events = fncs.get_events()
       for topic in events:
         value = fncs.get_value(topic)
         if topic == 'UNRESPONSIVE_MW':
-          unresp = load_scale * float(value)
-          dsoBus[0][3] = unresp # to poke unresponsive estimate into the bus load slot
+          fdr['unresp'] = load_scale * float(value)
+          dsoBus[0][3] = fdr['unresp'] # to poke unresponsive estimate into the bus load slot
           new_bid = True
         elif topic == 'RESPONSIVE_MAX_MW':
-          resp_max = load_scale * float(value)
+          fdr['resp_max'] = load_scale * float(value)
           new_bid = True
         elif topic == 'RESPONSIVE_C2':
-          resp_c2 = float(value) / load_scale
+          fdr['resp_c2'] = float(value) / load_scale
           new_bid = True
         elif topic == 'RESPONSIVE_C1':
-          resp_c1 = float(value)
+          fdr['resp_c1'] = float(value)
           new_bid = True
         elif topic == 'RESPONSIVE_DEG':
-          resp_deg = int(value)
+          fdr['resp_deg'] = int(value)
           new_bid = True
         else:
           gld_load = parse_mva (value) # actual value, may not match unresp + resp load
-          feeder_load = float(gld_load[0]) * load_scale
+          fdr['feeder_load'] = float(gld_load[0]) * load_scale
+    # the dispatchable load (gen 5) takes the responsive load of all feeders, priced by the bid of the first feeder
+    unresp = sum(fdr['unresp'] for fdr in feeders)
+    resp_max = sum(fdr['resp_max'] for fdr in feeders)
+    feeder_load = sum(fdr['feeder_load'] for fdr in feeders)
+    resp_c2, resp_c1, resp_deg = feeders[0]['resp_c2'], feeders[0]['resp_c1'], feeders[0]['resp_deg']
     if new_bid == True:
       dummy = 2
 #      print('**Bid', ts, unresp, resp_max, resp_deg, resp_c2, resp_c1)
@@ -367,6 +399,8 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
     csv_load = loads[idx,0]
     bus[4,2] = loads[idx,1]
     bus[8,2] = loads[idx,2]
+    bus[6,2] = csv_load
+    base_load = bus[:,2].copy() # the feeder loads are added on top of these
     # process the generator and branch outages
     for row in ppc['UnitsOut']:
       if ts > row[2]:
@@ -401,14 +435,13 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
       # for OPF, the DSO bus load is CSV + Unresponsive estimate, with Responsive separately dispatchable
       bus = ppc['bus']
       gen = ppc['gen']
-      bus[6,2] = csv_load
-      for row in ppc['DSO']:
-        unresp = float(row[3])
-        newidx = int(row[0]) - 1
-        if unresp >= feeder_load:
-          bus[newidx,2] += unresp
+      bus[:,2] = base_load
+      for i, fdr in enumerate(feeders):
+        row_unresp = float(dsoBus[i][3])
+        if row_unresp >= fdr['feeder_load']:
+          bus[fdr['busidx'],2] += row_unresp
         else:
-          bus[newidx,2] += feeder_load
+          bus[fdr['busidx'],2] += fdr['feeder_load']
       gen[4][9] = -resp_max
       res = pp.runopf(ppc, ppopt_market)
       if res['success'] == False:
@@ -417,8 +450,9 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
       opf_gen = deepcopy (res['gen'])
       lmp = opf_bus[6,13]
       resp = -1.0 * opf_gen[4,1]
-      if pub_lmp is not None:
-        helics.helicsPublicationPublishDouble(pub_lmp, 0.001 * lmp)
+      if hFed is not None:
+        for busnum, pub in pub_lmp.items():
+          helics.helicsPublicationPublishDouble(pub, 0.001 * opf_bus[busnum-1,13])
       else:
         fncs.publish('LMP_B7', 0.001 * lmp) # publishing $/kwh
 #     print ('  OPF', ts, csv_load, '{:.3f}'.format(unresp), '{:.3f}'.format(resp),
@@ -439,13 +473,16 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
     # always update the electrical quantities with a regular power flow
     bus = ppc['bus']
     gen = ppc['gen']
-    bus[6,13] = lmp
+    for busnum in dso_buses:
+      bus[busnum-1,13] = opf_bus[busnum-1,13] # lmp on bus 7
     gen[0,1] = opf_gen[0, 1]
     gen[1,1] = opf_gen[1, 1]
     gen[2,1] = opf_gen[2, 1]
     gen[3,1] = opf_gen[3, 1]
     # during regular power flow, we use the actual CSV + feeder load, ignore dispatchable load and use actual
-    bus[6,2] = csv_load + feeder_load
+    bus[:,2] = base_load
+    for fdr in feeders:
+      bus[fdr['busidx'],2] += fdr['feeder_load']
     gen[4,1] = 0 # opf_gen[4, 1]
     gen[4,9] = 0
     rpf = pp.runpf(ppc, ppopt_regular)
@@ -461,8 +498,7 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
     # update the metrics
     n_accum += 1
     loss_accum += Ploss
-    for i in range (dsoBus.shape[0]):
-      busnum = int(dsoBus[i,0])
+    for busnum in dso_buses:
       busidx = busnum - 1
       row = bus[busidx].tolist()
       # LMP_P, LMP_Q, PD, QD, Vang, Vmag, Vmax, Vmin: row[11] and row[12] are Vmax and Vmin constraints
@@ -491,8 +527,7 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
       sys_metrics[str(ts)] = {rootname:[loss_accum / n_accum,conv_accum]}
 
       bus_metrics[str(ts)] = {}
-      for i in range (dsoBus.shape[0]):
-        busnum = int(dsoBus[i,0])
+      for busnum in dso_buses:
         busidx = busnum - 1
         row = bus[busidx].tolist()
         met = bus_accum[str(busnum)]
@@ -512,8 +547,9 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
       conv_accum = True
 
     volts = 1000.0 * bus[6,7] * bus[6,9] / sqrt(3.0)  # VLN for GridLAB-D
-    if pub_volts is not None:
-      helics.helicsPublicationPublishDouble(pub_volts, volts)
+    if hFed is not None:
+      for busnum, pub in pub_volts.items():
+        helics.helicsPublicationPublishDouble(pub, 1000.0 * bus[busnum-1,7] * bus[busnum-1,9] / sqrt(3.0))
     else:
       fncs.publish('three_phase_voltage_B7', volts)
 
@@ -546,7 +582,7 @@ def pypower_loop (casefile, rootname, helicsConfig=None):
       break
     tRequest = min(ts + dt, tmax)
     if hFed is not None:
-      ts = int (helics.helicsFederateRequestTime(hFed, tRequest))
+      ts = int (tracer.request_time(hFed, tRequest))
     else:
       ts = fncs.time_request(tRequest)
 
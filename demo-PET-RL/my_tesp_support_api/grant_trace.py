@@ -0,0 +1,156 @@
+# file: grant_trace.py
+"""Opt-in trace of the HELICS time requests and grants of each federate.
+
+Set the environment variable PET_GRANT_TRACE to a directory before the
+co-simulation starts (the federates launched by the substation inherit it).
+Every federate that requests its time through GRANT_TRACER.request_time
+then writes <directory>/<federate>.grants.jsonl, one line per request:
+
+    {"requested": sim time requested, "granted": sim time granted,
+     "request_us": wall clock at the request, "grant_us": wall clock at the grant}
+
+The wall clock is time.time_ns() in microseconds, so the traces of all the
+processes on a host share one time axis. Without PET_GRANT_TRACE the tracer
+only calls helicsFederateRequestTime.
+
+Public Functions:
+    :merge_grant_traces: Combines the traces into one Chrome trace (chrome://tracing, ui.perfetto.dev).
+
+Example:
+    python -m my_tesp_support_api.grant_trace <trace directory> [market period] [output json]
+"""
+import os
+import sys
+import json
+import time
+import glob
+import atexit
+import bisect
+try:
+  import helics
+except:
+  pass
+
+TRACE_ENV = 'PET_GRANT_TRACE'
+TRACE_SUFFIX = '.grants.jsonl'
+
+
+class GRANT_TRACER:
+  """Wraps helicsFederateRequestTime and records every request and grant
+
+  Args:
+    federate_name (str): name of the trace file, usually the federate name
+    trace_dir (str): directory of the trace, by default the PET_GRANT_TRACE environment variable, None disables the trace
+    batch_size (int): number of records buffered before a write
+  """
+  def __init__(self, federate_name, trace_dir = None, batch_size = 1000):
+    if trace_dir is None:
+      trace_dir = os.environ.get(TRACE_ENV)
+    self.enabled = bool(trace_dir)
+    self.batch_size = batch_size
+    self.records = []
+    self.file = None
+    if self.enabled:
+      os.makedirs(trace_dir, exist_ok=True)
+      self.file = open(os.path.join(trace_dir, federate_name + TRACE_SUFFIX), 'w', encoding='utf-8')
+      atexit.register(self.close) # the federates exit without a common shutdown hook
+
+  def request_time(self, hFed, requested):
+    """Same as helics.helicsFederateRequestTime(hFed, requested)
+    """
+    if not self.enabled:
+      return helics.helicsFederateRequestTime(hFed, requested)
+    request_us = time.time_ns() // 1000
+    granted = helics.helicsFederateRequestTime(hFed, requested)
+    self.records.append('{{"requested": {}, "granted": {}, "request_us": {}, "grant_us": {}}}\n'.format(
+                        float(requested), float(granted), request_us, time.time_ns() // 1000))
+    if len(self.records) >= self.batch_size:
+      self.flush()
+    return granted
+
+  def flush(self):
+    if self.file is not None and len(self.records) > 0:
+      self.file.writelines(self.records)
+      self.file.flush()
+      self.records = []
+
+  def close(self):
+    if self.file is not None:
+      self.flush()
+      self.file.close()
+      self.file = None
+
+
+def read_grant_trace(path):
+  records = []
+  with open(path, encoding='utf-8') as f:
+    for line in f:
+      if line.strip():
+        records.append(json.loads(line))
+  return records
+
+
+def merge_grant_traces(trace_dir, market_period = 300, output = None):
+  """Combines the grant traces of all federates into one Chrome trace
+
+  Each federate is one row of the timeline. A "wait" slice covers the time a federate was blocked
+  in its time request, a "compute" slice the time from a grant to its next request. Every wait slice
+  names the market period of the granted time and the federate whose request came last before the
+  grant (released_by), which is the federate this one was waiting on.
+
+  Args:
+    trace_dir (str): directory with the <federate>.grants.jsonl files
+    market_period (int): market period in seconds, to label the slices
+    output (str): path of the Chrome trace json, trace_dir/grant_trace.json by default
+
+  Returns:
+    str: path of the written trace
+  """
+  traces = {}
+  for path in sorted(glob.glob(os.path.join(trace_dir, '*' + TRACE_SUFFIX))):
+    traces[os.path.basename(path)[:-len(TRACE_SUFFIX)]] = read_grant_trace(path)
+  if output is None:
+    output = os.path.join(trace_dir, 'grant_trace.json')
+  requests = {name: [record['request_us'] for record in records] for name, records in traces.items()}
+  start_us = min([r['request_us'] for records in traces.values() for r in records[:1]] or [0])
+
+  events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0, 'args': {'name': 'co-simulation'}}]
+  for tid, (name, records) in enumerate(traces.items(), start=1):
+    events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+    last_grant_us = None
+    last_granted = 0.0
+    for record in records:
+      if last_grant_us is not None:
+        events.append({'name': 'compute', 'cat': 'compute', 'ph': 'X', 'pid': 1, 'tid': tid,
+                       'ts': last_grant_us - start_us, 'dur': record['request_us'] - last_grant_us,
+                       'args': {'sim_time': last_granted}})
+      released_by = None
+      released_us = None
+      for other, times in requests.items():
+        if other == name:
+          continue
+        k = bisect.bisect_right(times, record['grant_us'])
+        if k > 0 and times[k-1] >= record['request_us'] and (released_us is None or times[k-1] > released_us):
+          released_by, released_us = other, times[k-1]
+      events.append({'name': 'wait', 'cat': 'wait', 'ph': 'X', 'pid': 1, 'tid': tid,
+                     'ts': record['request_us'] - start_us, 'dur': record['grant_us'] - record['request_us'],
+                     'args': {'requested': record['requested'], 'granted': record['granted'],
+                              'market_period': int(record['granted'] // market_period), 'released_by': released_by}})
+      events.append({'name': name + ' sim time', 'ph': 'C', 'pid': 1, 'tid': tid, 'ts': record['grant_us'] - start_us,
+                     'args': {'seconds': record['granted']}})
+      last_grant_us = record['grant_us']
+      last_granted = record['granted']
+
+  with open(output, 'w', encoding='utf-8') as f:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+               'otherData': {'market_period': market_period, 'start_unix_us': start_us}}, f)
+  return output
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print('usage: python -m my_tesp_support_api.grant_trace <trace directory> [market period] [output json]')
+    sys.exit(1)
+  path = merge_grant_traces(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 300,
+                            sys.argv[3] if len(sys.argv) > 3 else None)
+  print('Chrome trace written to', path)
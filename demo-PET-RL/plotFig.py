@@ -1,85 +1,43 @@
-import pickle
+import os
+import sys
 import numpy as np
-import json
 import matplotlib.pyplot as plt
+sys.path.append('./fed_substation')
+from experiment_store import EXPERIMENT, convert_legacy
 
 path_base = './fed_substation/data/'
 exp1 = 'exp(RL-test)'
 path = path_base + exp1 +'/'
-with open(path+'data.pkl', 'rb') as f:
-    data_dict = pickle.load(f)
-
-with open(path+'house_TE_ChallengeH_metrics.json', encoding='utf-8') as f:
-    prosumer_dict = json.loads(f.read()) # federate_config is the dict data structure
-    f.close()
-
-with open(path+'auction_TE_ChallengeH_metrics.json', encoding='utf-8') as f:
-    auction_dict = json.loads(f.read()) # federate_config is the dict data structure
-    f.close()
-
-
-time_hour_auction = data_dict['time_hour_auction']
-buyer_ratio = data_dict['buyer_ratio']
-seller_ratio = data_dict['seller_ratio']
-nontcp_ratio = data_dict['nontcp_ratio']
-cleared_price = data_dict['cleared_price']
-LMP = data_dict['LMP']
-
-time_hour_system = data_dict['time_hour_system']
-temp_mean = data_dict['temp_mean']
-temp_max = data_dict['temp_max']
-temp_min = data_dict['temp_min']
-basepoint_mean = data_dict['basepoint_mean']
-setpoint_mean = data_dict['setpoint_mean']
-
-system_hvac_load = data_dict['system_hvac_load']
-hvac_load_mean = data_dict['hvac_load_mean']
-hvac_load_max = data_dict['hvac_load_max']
-hvac_load_min = data_dict['hvac_load_min']
-system_house_load = data_dict['system_house_load']
-house_load_mean = data_dict['house_load_mean']
-house_load_max = data_dict['house_load_max']
-house_load_min = data_dict['house_load_min']
-system_house_unres = data_dict['system_house_unres']
-house_unres_mean = data_dict['house_unres_mean']
-house_unres_max = data_dict['house_unres_max']
-house_unres_min = data_dict['house_unres_min']
-
-system_PV = data_dict['system_PV']
-house_PV_mean = data_dict['house_PV_mean']
-house_PV_max = data_dict['house_PV_max']
-house_PV_min = data_dict['house_PV_min']
-
-hvac_on_ratio = data_dict['hvac_on_ratio']
-
-distri_load_p = data_dict['distri_load_p']
-# distri_load_q = data_dict['distri_load_q']
-
-vpp_load_p = data_dict['vpp_load_p']
-vpp_load_q = data_dict['vpp_load_q']
+if os.path.exists(path + 'store/manifest.json'):
+  exp = EXPERIMENT(path) # memory-mapped columnar store, only the series used below are read
+else:
+  exp = convert_legacy(path) # older experiment with data.pkl and the metrics json files, written into a store once
+has_system = 'temp_mean' in exp.series_names() # experiments without data.pkl only have the auction series
+
+time_hour_auction, buyer_ratio = exp.series('buyer_ratio')
+seller_ratio = exp.series('seller_ratio')[1]
+nontcp_ratio = exp.series('nontcp_ratio')[1]
+cleared_price = exp.series('cleared_price')[1]
+
+if has_system:
+  LMP = exp.series('LMP')[1]
+  time_hour_system, temp_mean = exp.series('temp_mean')
+  temp_max = exp.series('temp_max')[1]
+  temp_min = exp.series('temp_min')[1]
+  basepoint_mean = exp.series('basepoint_mean')[1]
+  setpoint_mean = exp.series('setpoint_mean')[1]
+
+  system_house_load = exp.series('system_house_load')[1]
+  system_PV = exp.series('system_PV')[1]
+  hvac_on_ratio = exp.series('hvac_on_ratio')[1]
+  vpp_load_p = exp.series('vpp_load_p')[1]
 
 
 house = 'F0_house_A6'
-bids = []
-prices = []
-roles = []
-quantitys = []
-for i in range(len(time_hour_auction)):
-    t = int((i+1)*300)
-    bid = prosumer_dict[str(t)][house] # bid_price, quantity, hvac.power_needed, role
-    price = bid[0]
-    quantity = bid[1]
-    role = bid[3]
-    if role == 'seller':
-        quantitys.append(int(-quantity/3))
-        roles.append(-1)
-    elif role == 'buyer':
-        quantitys.append(int(quantity/3))
-        roles.append(1)
-    else:
-        quantitys.append(0)
-        roles.append(0)
-    prices.append(price)
+bids = exp.bids(houses=[house])[0][:len(time_hour_auction)] # [interval, field], fields are price, quantity, hvac_needed, role
+prices = bids[:, 0]
+roles = bids[:, 3].astype(int) # 1 buyer, -1 seller, 0 none-participant
+quantitys = (roles * bids[:, 1] / 3).astype(int) # number of packets, negative for sellers
 
 
 fig2, (ax11, ax12, ax13) = plt.subplots(3)
@@ -120,43 +78,44 @@ ax13.legend(['bid price', 'cleared price'])
 
 
 
-fig, (ax1, ax2, ax3, ax4) = plt.subplots(4)
-ax1.set_ylabel('Power (kW)', size = 13)
-ax1.tick_params(axis='x', labelsize=13)
-ax1.tick_params(axis='y', labelsize=13)
-ax1.plot(time_hour_system, system_PV, color = 'g', linewidth = 1.5)
-ax1.plot(time_hour_system, system_house_load, color = 'b', linewidth = 1.5)
-ax1.plot(time_hour_system, vpp_load_p, color = 'k', linewidth = 2)
-# ax1.plot(time_hour_system, system_hvac_load)
-# ax1.plot(time_hour_system, system_house_unres)
-ax1.legend(['total PV generation', 'total house load', 'grid power flow'])#, 'total HVAC load', 'total base load'])
-
-ax2.set_ylabel('Temperature \n(degF)', size = 13)
-ax2.tick_params(axis='x', labelsize=13)
-ax2.tick_params(axis='y', labelsize=13)
-ax2.plot(time_hour_system, basepoint_mean,  '--', color = 'k', linewidth = 1.5)
-ax2.plot(time_hour_system, temp_max, color = 'g', linewidth = 1)
-ax2.plot(time_hour_system, temp_min, color = 'm', linewidth = 1)
-ax2.plot(time_hour_system, temp_mean, color = 'b', linewidth = 1.5)
-ax2.legend(['set-point', 'max', 'min', 'mean'])
-
-ax3.set_ylabel('Cleared Price \n($/kWh)', size = 13)
-ax3.tick_params(axis='x', labelsize=13)
-ax3.tick_params(axis='y', labelsize=13)
-ax3.plot(time_hour_auction, LMP, color = 'g', linewidth = 1.5)
-ax3.plot(time_hour_auction, cleared_price, color = 'b', linewidth = 1.5)
-ax3.legend(['local marginal price', 'cleared price'])
-
-ax4.set_ylabel('Ratio', size = 13)
-ax4.set_xlabel("Time (h)", size = 13)
-ax4.tick_params(axis='x', labelsize=13)
-ax4.tick_params(axis='y', labelsize=13)
-ax4.plot(time_hour_system, hvac_on_ratio, color = 'k', linewidth = 1.5)
-ax4.plot(time_hour_auction, buyer_ratio, color = 'b', linewidth = 1.5)
-ax4.plot(time_hour_auction, seller_ratio, color = 'g', linewidth = 1.5)
-ax4.plot(time_hour_auction, nontcp_ratio, color = 'm', linewidth = 1.5)
-
-ax4.legend(['HVAC ON', 'buyer', 'seller', 'none-ptcp'])
+if has_system:
+  fig, (ax1, ax2, ax3, ax4) = plt.subplots(4)
+  ax1.set_ylabel('Power (kW)', size = 13)
+  ax1.tick_params(axis='x', labelsize=13)
+  ax1.tick_params(axis='y', labelsize=13)
+  ax1.plot(time_hour_system, system_PV, color = 'g', linewidth = 1.5)
+  ax1.plot(time_hour_system, system_house_load, color = 'b', linewidth = 1.5)
+  ax1.plot(time_hour_system, vpp_load_p, color = 'k', linewidth = 2)
+  # ax1.plot(time_hour_system, system_hvac_load)
+  # ax1.plot(time_hour_system, system_house_unres)
+  ax1.legend(['total PV generation', 'total house load', 'grid power flow'])#, 'total HVAC load', 'total base load'])
+
+  ax2.set_ylabel('Temperature \n(degF)', size = 13)
+  ax2.tick_params(axis='x', labelsize=13)
+  ax2.tick_params(axis='y', labelsize=13)
+  ax2.plot(time_hour_system, basepoint_mean,  '--', color = 'k', linewidth = 1.5)
+  ax2.plot(time_hour_system, temp_max, color = 'g', linewidth = 1)
+  ax2.plot(time_hour_system, temp_min, color = 'm', linewidth = 1)
+  ax2.plot(time_hour_system, temp_mean, color = 'b', linewidth = 1.5)
+  ax2.legend(['set-point', 'max', 'min', 'mean'])
+
+  ax3.set_ylabel('Cleared Price \n($/kWh)', size = 13)
+  ax3.tick_params(axis='x', labelsize=13)
+  ax3.tick_params(axis='y', labelsize=13)
+  ax3.plot(time_hour_auction, LMP, color = 'g', linewidth = 1.5)
+  ax3.plot(time_hour_auction, cleared_price, color = 'b', linewidth = 1.5)
+  ax3.legend(['local marginal price', 'cleared price'])
+
+  ax4.set_ylabel('Ratio', size = 13)
+  ax4.set_xlabel("Time (h)", size = 13)
+  ax4.tick_params(axis='x', labelsize=13)
+  ax4.tick_params(axis='y', labelsize=13)
+  ax4.plot(time_hour_system, hvac_on_ratio, color = 'k', linewidth = 1.5)
+  ax4.plot(time_hour_auction, buyer_ratio, color = 'b', linewidth = 1.5)
+  ax4.plot(time_hour_auction, seller_ratio, color = 'g', linewidth = 1.5)
+  ax4.plot(time_hour_auction, nontcp_ratio, color = 'm', linewidth = 1.5)
+
+  ax4.legend(['HVAC ON', 'buyer', 'seller', 'none-ptcp'])
 
 
 
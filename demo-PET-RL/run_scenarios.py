@@ -0,0 +1,154 @@
+# file: run_scenarios.py
+"""
+Function:
+        run a grid of co-simulation scenarios in parallel
+        every scenario gets its own copy of this case folder, its own HELICS broker port/name and its own
+        working directories, so several co-simulations can run on one host at the same time
+usage:  python run_scenarios.py grid.json [--parallel N] [--dry-run]
+
+grid.json:
+        {
+          "name": "market-vs-rl",              # the scenarios go to ./scenarios/<name>/
+          "base": {"hour_stop": 48},           # settings shared by all scenarios
+          "grid": {"hasMarket": [true, false], # one scenario per combination of the listed values
+                   "has_RL": [true, false]},
+          "parallel": 4,                       # maximum number of co-simulations running at once
+          "base_port": 24000                   # broker port of the first scenario
+        }
+        keys in RUN_SETTINGS are passed to launch_substation.py (scenario.json), all other keys are
+        GLOBAL_Configuration attributes of generate_case.py (case_config.json) and make the case to be
+        generated again in the scenario folder (needs TESP_INSTALL)
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import glob
+import itertools
+import subprocess
+
+RUN_SETTINGS = ['hour_stop', 'hasMarket', 'vppEnable', 'has_RL', 'has_demand_response', 'clearing_engine',
+                'wakeOnInput', 'drawFigure', 'liveMonitor', 'checkpoint_hours', 'resume', 'lookahead', 'input_delay',
+                'federate_wall_timeout', 'federate_idle_timeout', 'num_shards', 'num_feeders',
+                'broker_layout', 'request_seed']
+# HELICS config files of the federates, each gets the broker port of its scenario
+HELICS_CONFIGS = ['fed_substation/TE_Challenge_HELICS_substation.json', 'fed_gridlabd/TE_Challenge_HELICS_gld_msg.json',
+                  'fed_pypower/pypowerConfig.json', 'fed_weather/TE_Challenge_HELICS_Weather_Config.json',
+                  'fed_energyplus/helics_eplus.json', 'fed_energyplus/helics_eplus_agent.json']
+PORT_STRIDE = 10 # smallest room between the broker ports of two scenarios
+# outputs of earlier runs that are not copied into a scenario folder
+IGNORED = shutil.ignore_patterns('scenarios', 'data', 'output', 'shards', '__pycache__', '*.log', '*_metrics.json')
+
+
+def expand_grid(base, grid):
+  """ one settings dict per combination of the grid values"""
+  keys = list(grid.keys())
+  scenarios = []
+  for values in itertools.product(*[grid[key] for key in keys]):
+    settings = dict(base)
+    settings.update(zip(keys, values))
+    label = '_'.join('{}={}'.format(key, value) for key, value in zip(keys, values)).replace(' ', '')
+    scenarios.append((label, settings))
+  return scenarios
+
+
+def port_block(settings):
+  """ number of ports the brokers of a scenario use, two per broker (zmq listens on port and port + 1)"""
+  if settings.get('broker_layout', 'flat') != 'hierarchical':
+    return PORT_STRIDE
+  groups = settings.get('num_feeders', 1) + 2 # a sub-broker per feeder, the bulk system and EnergyPlus
+  return max(PORT_STRIDE, 2 * (groups + 1))
+
+
+def prepare_scenario(case_root, folder, index, settings, port, sweep_name):
+  """ copies the case and writes the scenario settings, returns the run description
+
+  the brokers of the scenario use the ports [port, port + port_block(settings))"""
+  if os.path.exists(folder):
+    shutil.rmtree(folder)
+  shutil.copytree(case_root, folder, ignore=IGNORED)
+
+  broker_name = 'broker_{}_{}'.format(sweep_name, index)
+  run_settings = {key: value for key, value in settings.items() if key in RUN_SETTINGS}
+  case_settings = {key: value for key, value in settings.items() if key not in RUN_SETTINGS}
+  run_settings.update({'broker_port': port, 'broker_port_limit': port + port_block(settings), 'broker_name': broker_name, 'data_path': './data/',
+                       'monitor_name': 'pet_substation_monitor_{}_{}'.format(sweep_name, index)})
+  run_settings.setdefault('drawFigure', False)
+  run_settings.setdefault('liveMonitor', False)
+
+  if len(case_settings) > 0: # the glm and the configuration files depend on these, generate the case again
+    with open(os.path.join(folder, 'case_config.json'), 'w', encoding='utf-8') as f:
+      json.dump(case_settings, f, indent=1)
+    subprocess.run([sys.executable, 'generate_case.py'], cwd=folder, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+  feeder_configs = glob.glob(os.path.join(folder, 'feeders', '*', 'fed_*', '*HELICS*.json')) # see generate_feeders.py
+  for config in HELICS_CONFIGS + feeder_configs: # every federate connects to the broker of this scenario
+    path = os.path.join(folder, config)
+    if not os.path.exists(path):
+      continue
+    with open(path, encoding='utf-8') as f:
+      helics_config = json.load(f)
+    helics_config['coreinit'] = '--brokerport={}'.format(port)
+    with open(path, 'w', encoding='utf-8') as f:
+      json.dump(helics_config, f, indent=2)
+
+  with open(os.path.join(folder, 'fed_substation', 'scenario.json'), 'w', encoding='utf-8') as f:
+    json.dump(run_settings, f, indent=1)
+  return {'index': index, 'folder': folder, 'broker_port': port, 'broker_name': broker_name, 'settings': settings}
+
+
+def run_all(runs, parallel, poll_period = 1.0):
+  """ runs the substation launcher of every scenario, at most parallel at once"""
+  pending = list(runs)
+  running = []
+  while len(pending) > 0 or len(running) > 0:
+    while len(pending) > 0 and len(running) < parallel:
+      run = pending.pop(0)
+      log = open(os.path.join(run['folder'], 'fed_substation', 'substation.log'), 'w')
+      proc = subprocess.Popen([sys.executable, 'launch_substation.py'], cwd=os.path.join(run['folder'], 'fed_substation'),
+                              stdout=log, stderr=subprocess.STDOUT)
+      run['start'] = time.time()
+      running.append((run, proc, log))
+      print('started  scenario {} (port {}): {}'.format(run['index'], run['broker_port'], run['folder']), flush=True)
+    time.sleep(poll_period)
+    for item in list(running):
+      run, proc, log = item
+      if proc.poll() is not None:
+        log.close()
+        run['returncode'] = proc.returncode
+        run['wall_time'] = time.time() - run['start']
+        running.remove(item)
+        print('finished scenario {} in {:.0f} s, return code {}'.format(run['index'], run['wall_time'], proc.returncode), flush=True)
+  return runs
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='run a grid of PET co-simulation scenarios in parallel')
+  parser.add_argument('grid', help='json file with the scenario grid')
+  parser.add_argument('--parallel', type=int, default=None, help='maximum number of co-simulations running at once')
+  parser.add_argument('--dry-run', action='store_true', help='only prepare the scenario folders')
+  args = parser.parse_args()
+
+  with open(args.grid, encoding='utf-8') as f:
+    sweep = json.load(f)
+  case_root = os.path.dirname(os.path.abspath(__file__))
+  sweep_name = sweep.get('name', 'sweep')
+  sweep_root = os.path.join(case_root, 'scenarios', sweep_name)
+  parallel = args.parallel or sweep.get('parallel', max(1, (os.cpu_count() or 1) // 4))
+
+  runs = []
+  port = sweep.get('base_port', 24000)
+  for index, (label, settings) in enumerate(expand_grid(sweep.get('base', {}), sweep.get('grid', {}))):
+    folder = os.path.join(sweep_root, '{:03d}_{}'.format(index, label))
+    runs.append(prepare_scenario(case_root, folder, index, settings, port, sweep_name))
+    port += port_block(settings) # the next scenario starts after the port block of this one
+  print('{} scenarios prepared in {}'.format(len(runs), sweep_root), flush=True)
+
+  if not args.dry_run:
+    run_all(runs, parallel)
+  with open(os.path.join(sweep_root, 'summary.json'), 'w', encoding='utf-8') as f:
+    json.dump(runs, f, indent=1)
@@ -0,0 +1,73 @@
+# file: benchmark_startup.py
+"""
+Function:
+        measure the startup (import) time of every federate launcher
+        each launcher's imports, sys.path set-up and the my_tesp_support_api functions it uses
+        are run in a fresh interpreter from the launcher's folder, the co-simulation itself is not started
+usage:  python benchmark_startup.py [repeats]
+"""
+
+import os
+import ast
+import sys
+import json
+import statistics
+import subprocess
+
+LAUNCHERS = ['fed_weather/launch_weather.py', 'fed_pypower/launch_pypower.py', 'fed_substation/launch_substation.py']
+HEAVY_MODULES = ['pandas', 'scipy', 'networkx', 'matplotlib', 'tkinter', 'pypower', 'helics', 'torch']
+
+# run by the child interpreter after the prelude, reports what was imported
+REPORT = '''
+import sys, json, time
+print(json.dumps({'seconds': time.perf_counter() - _t0, 'num_modules': len(sys.modules),
+                  'heavy': [m for m in %r if m in sys.modules]}))
+'''
+
+
+def startup_prelude(launcher):
+  """ the top-level import and sys.path statements of a launcher, plus the tesp.<name> lookups it makes"""
+  with open(launcher, encoding='utf-8') as f:
+    tree = ast.parse(f.read())
+  lines = []
+  aliases = set()
+  for node in tree.body:
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+      lines.append(ast.unparse(node))
+      for alias in node.names:
+        if alias.asname and alias.name.endswith('my_tesp_support_api.api'):
+          aliases.add(alias.asname)
+    elif isinstance(node, ast.Expr) and 'sys.path' in ast.unparse(node):
+      lines.append(ast.unparse(node))
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in aliases:
+      lines.append('{}.{}'.format(node.value.id, node.attr))
+  return 'import time\n_t0 = time.perf_counter()\n' + '\n'.join(lines) + REPORT % HEAVY_MODULES
+
+
+def measure(launcher, repeats):
+  folder, file = os.path.split(launcher)
+  code = startup_prelude(launcher)
+  runs = []
+  for i in range(repeats):
+    proc = subprocess.run([sys.executable, '-c', code], cwd=folder, capture_output=True, text=True)
+    if proc.returncode != 0:
+      return {'launcher': launcher, 'error': proc.stderr.strip().splitlines()[-1]}
+    runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+  seconds = [run['seconds'] for run in runs]
+  return {'launcher': launcher, 'median_s': statistics.median(seconds), 'min_s': min(seconds),
+          'num_modules': runs[-1]['num_modules'], 'heavy': runs[-1]['heavy']}
+
+
+if __name__ == '__main__':
+  repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+  for launcher in LAUNCHERS:
+    if not os.path.exists(launcher):
+      continue
+    result = measure(launcher, repeats)
+    if 'error' in result:
+      print('{:<40} failed: {}'.format(launcher, result['error']))
+    else:
+      print('{:<40} median {:7.3f} s  min {:7.3f} s  modules {:5d}  heavy: {}'.format(
+            launcher, result['median_s'], result['min_s'], result['num_modules'], ', '.join(result['heavy'])))
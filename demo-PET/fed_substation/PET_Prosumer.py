@@ -11,6 +11,7 @@ import my_tesp_support_api.helpers as helpers
 import math
 import random
 import helics
+import numpy as np
 from collections import deque
 
 class HVAC:
@@ -708,10 +709,11 @@ class HOUSE:
 
 
 class VPP:
-    def __init__(self, name, enable = True):
+    def __init__(self, name, enable = True, seed = None):
 
         self.name = name
         self.enable = enable
+        self.rng = np.random.default_rng(seed) # random arrival order of the requests
 
         self.vpp_load_p = 0 # kVA
         self.balance_signal = 220 # kVA
@@ -740,22 +742,37 @@ class VPP:
                 for i in range(len(self.response_list)):
                     self.response_list[i]['response'] = 'YES'
             else:
-                arrive_idx_list = list(range(len(self.response_list)))
-                random.shuffle(arrive_idx_list) # randomize the arrive time
-                load_est = self.vpp_load_p
-
-                for idx in arrive_idx_list:
-                    response = self.response_list[idx]
-                    key = response['name']
-                    load = response['power']
-                    length = response['packet-length']
-                    load_est += load
-                    if (self.balance_signal - load_est) >= 0:
-                        self.response_list[idx]['response'] = 'YES'
-                    else:
-                        self.response_list[idx]['response'] = 'NO'
+                power = np.array([response['power'] for response in self.response_list], dtype=np.float64)
+                accepted, rejected = self.admit(np.arange(len(power)), power)
+                for idx in accepted:
+                    self.response_list[idx]['response'] = 'YES'
+                for idx in rejected:
+                    self.response_list[idx]['response'] = 'NO'
         self.request_list.clear()
 
+    def admit(self, house_idx, power, urgency = None):
+        """ Admits requests in random arrival order while the VPP load stays within the balance signal
+
+        Every request adds its power to the load estimate, so the accepted requests are the longest
+        prefix of the arrival order whose cumulative load fits the balance signal.
+
+        Args:
+            house_idx (np.ndarray): index of each requesting house
+            power (np.ndarray): packet power of each request in kW
+            urgency (np.ndarray): requests with a higher urgency arrive first, None for random order only
+
+        Returns:
+            (np.ndarray, np.ndarray): house indices of the accepted and of the rejected requests
+        """
+        num_requests = len(house_idx)
+        if urgency is None:
+            order = self.rng.permutation(num_requests) # randomize the arrive time
+        else:
+            order = np.lexsort((self.rng.random(num_requests), -np.asarray(urgency)))
+        load_est = self.vpp_load_p + np.cumsum(np.asarray(power, dtype=np.float64)[order])
+        num_accepted = np.searchsorted(load_est, self.balance_signal, side='right')
+        return house_idx[order[:num_accepted]], house_idx[order[num_accepted:]]
+
 
     def get_vpp_load(self):
 
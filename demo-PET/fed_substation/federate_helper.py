@@ -5,7 +5,9 @@ import sys
 import json
 import pickle
 import psutil
-import subprocess
+import signal
+from federate_supervisor import FEDERATE_SUPERVISOR, FEDERATE_SPEC
+from resource_sampler import RESOURCE_SAMPLER
 if sys.platform != 'win32':
   import resource
 
@@ -122,11 +124,16 @@ class FEDERATE_HELPER:
         self.auction_metrics = {'Metadata':self.auction_meta,'StartTime':StartTime}
         self.prosumer_metrics = {'Metadata':self.prosumer_meta,'StartTime':StartTime}
 
-        self.processes_list = []
+        self.supervisor = None # FEDERATE_SUPERVISOR of the broker and the other federates, created by create_broker
+        self.federate_wall_timeout = None # seconds, a federate running longer is stopped (None for no limit)
+        self.federate_idle_timeout = None # seconds, a federate writing nothing to its log for longer counts as hung
+        self.finishing = False
+        self.resource_sampler = None # RESOURCE_SAMPLER of all co-simulation processes, see start_resource_sampler
 
     def create_broker(self):
-        cmd0 = "helics_broker -f 6 --loglevel=1 --name=mainbroker >helics_broker.log 2>&1"
-        self.processes_list.append(subprocess.Popen(cmd0, stdout=subprocess.PIPE, shell=True))
+        self.supervisor = FEDERATE_SUPERVISOR(on_failure=self.on_federate_failure)
+        args = ['helics_broker', '-f', '6', '--loglevel=1', '--name={}'.format('mainbroker')]
+        self.supervisor.launch(FEDERATE_SPEC('helics_broker', args, os.getcwd(), 'helics_broker.log'))
         print("HELICS broker created!")
 
     def create_federate(self):
@@ -302,22 +309,20 @@ class FEDERATE_HELPER:
         SCHED_PATH = TESP_SUPPORT+'/schedules'
         EPW = TESP_SUPPORT+'/energyplus/USA_AZ_Tucson.Intl.AP.722740_TMY3.epw'
 
-        # command to launch gridlabd federate
-        cmd1 = "cd ../fed_gridlabd/ && gridlabd -D SCHED_PATH={} -D USE_HELICS -D METRICS_FILE=TE_ChallengeH_metrics.json TE_Challenge.glm >gridlabd.log 2>&1".format(SCHED_PATH)
-        # command to launch weather federate
-        cmd2 = "cd ../fed_weather/ && python3 launch_weather.py >weather.log 2>&1"
-        # command to launch pypower federate
-        cmd3 = "cd ../fed_pypower/ && python3 launch_pypower.py >pypower.log 2>&1"
-        # command to launch energyplus federate
-        cmd4 = "cd ../fed_energyplus/ && export HELICS_CONFIG_FILE=helics_eplus.json && exec energyplus -w {} -d output -r MergedH.idf >eplus.log 2>&1".format(EPW)
-        # command to launch energyplus agent (it is also a federate)
-        cmd5 = "cd ../fed_energyplus/ && eplus_agent_helics 172800s 300s SchoolDualController eplus_TE_ChallengeH_metrics.json  0.02 25 4 4 helics_eplus_agent.json >eplus_agent.log 2>&1"
-
-        self.processes_list.append(subprocess.Popen(cmd1, stdout=subprocess.PIPE, shell=True))
-        self.processes_list.append(subprocess.Popen(cmd2, stdout=subprocess.PIPE, shell=True))
-        self.processes_list.append(subprocess.Popen(cmd3, stdout=subprocess.PIPE, shell=True))
-        self.processes_list.append(subprocess.Popen(cmd4, stdout=subprocess.PIPE, shell=True))
-        self.processes_list.append(subprocess.Popen(cmd5, stdout=subprocess.PIPE, shell=True))
+        case_root = os.path.abspath('..')
+        timeouts = {'wall_timeout': self.federate_wall_timeout, 'idle_timeout': self.federate_idle_timeout}
+        specs = [
+            FEDERATE_SPEC('gridlabd', ['gridlabd', '-D', 'SCHED_PATH={}'.format(SCHED_PATH), '-D', 'USE_HELICS', '-D', 'METRICS_FILE=TE_ChallengeH_metrics.json', 'TE_Challenge.glm'],
+                          os.path.join(case_root, 'fed_gridlabd'), 'gridlabd.log', **timeouts),
+            FEDERATE_SPEC('weather', [sys.executable, 'launch_weather.py'], os.path.join(case_root, 'fed_weather'), 'weather.log',
+                          ready_pattern='HELICS initialized', **timeouts),
+            FEDERATE_SPEC('pypower', [sys.executable, 'launch_pypower.py'], os.path.join(case_root, 'fed_pypower'), 'pypower.log',
+                          ready_pattern='HELICS subscription key', **timeouts),
+            FEDERATE_SPEC('energyplus', ['energyplus', '-w', EPW, '-d', 'output', '-r', 'MergedH.idf'], os.path.join(case_root, 'fed_energyplus'), 'eplus.log',
+                          env={'HELICS_CONFIG_FILE': 'helics_eplus.json'}, **timeouts),
+            FEDERATE_SPEC('eplus_agent', ['eplus_agent_helics', '172800s', '300s', 'SchoolDualController', 'eplus_TE_ChallengeH_metrics.json', '0.02', '25', '4', '4', 'helics_eplus_agent.json'],
+                          os.path.join(case_root, 'fed_energyplus'), 'eplus_agent.log', **timeouts)]
+        self.supervisor.launch(*specs) # launched concurrently
         print("Gridlabd, Weather, Pypower, EnergyPlus, EnergyPlus Agent, launched!")
 
 
@@ -333,11 +338,11 @@ class FEDERATE_HELPER:
                 os.system("kill -9 {}".format(proc.pid))
                 killed_list.append("gridlabd")
                 continue
-            if proc.name() == "python3" and "launch_weather.py" in proc.cmdline():
+            if proc.name().startswith("python") and "launch_weather.py" in proc.cmdline():
                 os.system("kill -9 {}".format(proc.pid))
                 killed_list.append("launch_weather.py")
                 continue
-            if proc.name() == "python3" and "launch_pypower.py" in proc.cmdline():
+            if proc.name().startswith("python") and "launch_pypower.py" in proc.cmdline():
                 os.system("kill -9 {}".format(proc.pid))
                 killed_list.append("launch_pypower.py")
                 continue
@@ -350,19 +355,54 @@ class FEDERATE_HELPER:
                 killed_list.append("eplus_agent_helics")
                 continue
 
-        if kill_subprocess : # kill subprocesses
-            if len(self.processes_list)>0:
-                for process in self.processes_list:
-                    while(str(process.poll())=="None"):
-                        pass
-                for process in self.processes_list:
-                    process.kill()
-                num_processes = len(self.processes_list)
-                for i in range(num_processes): # maybe it can free the memory for all processes
-                    del self.processes_list[0]
+        if kill_subprocess and self.supervisor is not None: # stop the processes launched by this helper
+            self.supervisor.shutdown()
+            self.supervisor = None
         if len(killed_list) > 0:
             print("Processes: ", killed_list, " has been killed successfully!")
 
+    def on_federate_failure(self, federate):
+        # a federate crashed, hung or timed out and the others were stopped, the substation federate
+        # is blocked in helicsFederateRequestTime and can not finish, so end this process as well
+        self.supervisor.show_report()
+        if not self.finishing:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def wait_federates(self, timeout = None):
+        """Waits (without polling) until the other federates finished, stops them after timeout seconds
+        """
+        if self.supervisor is None:
+            return
+        self.finishing = True # the substation is done, a failing federate no longer ends this process
+        if not self.supervisor.wait(timeout):
+            print("Federates still running after {} s, stopping them".format(timeout), flush=True)
+        self.supervisor.shutdown()
+        self.supervisor.show_report() # start latency and wall time of every federate
+
+    def federate_pids(self):
+        # processes to sample: the federates of the supervisor, then this substation federate
+        pids = {}
+        if self.supervisor is not None:
+            for name, federate in list(self.supervisor.federates.items()): # called from the sampler thread
+                if federate.proc is not None and federate.proc.returncode is None:
+                    pids[name] = federate.proc.pid
+        pids[self.fedName] = os.getpid()
+        return pids
+
+    def start_resource_sampler(self, data_path, interval = 5.0):
+        """Samples CPU, RSS, open files and I/O of every co-simulation process every interval seconds
+
+        The time series is written to data_path/resources.bin (see resource_sampler.py).
+        """
+        self.resource_sampler = RESOURCE_SAMPLER(data_path, self.federate_pids, interval)
+        self.resource_sampler.start()
+
+    def stop_resource_sampler(self):
+        if self.resource_sampler is not None:
+            self.resource_sampler.stop()
+            print("{} resource samples written".format(self.resource_sampler.num_samples))
+            self.resource_sampler = None
+
     def show_resource_consumption (self):
       if sys.platform != 'win32':
         usage = resource.getrusage(resource.RUSAGE_SELF)
@@ -18,11 +18,14 @@ import random
 import psutil
 import subprocess
 from PET_Prosumer import HOUSE, VPP        # import user-defined my_hvac class for hvac controllers
+from scheduler import SubstationScheduler
+from phase_timer import PHASE_TIMER
 from datetime import datetime
 from datetime import timedelta
 from my_auction import AUCTION  # import user-defined my_auction class for market
 import matplotlib.pyplot as plt
 import my_tesp_support_api.helpers as helpers
+import my_tesp_support_api.grant_trace as grant_trace
 from federate_helper import FEDERATE_HELPER, CURVES_TO_PLOT
 
 
@@ -39,11 +42,13 @@ hasMarket = True # have market or not
 vppEnable = False # have Vpp coordinator or not
 drawFigure = True # draw figures during the simulation
 has_demand_response = False
+request_seed = 1 # seed of the arrival order of the requests at the VPP, None for a different run every time
 fh = FEDERATE_HELPER(configfile, helicsConfig, metrics_root, hour_stop) # initialize the federate helper
 
 
 """=============================Start The Co-simulation==================================="""
 fh.cosimulation_start() # launch the broker; launch other federates; the substation federate enters executing mode
+fh.start_resource_sampler(data_path) # CPU, memory, open files and I/O of every federate, sampled during the run
 
 
 """============================Substation Initialization=================================="""
@@ -51,7 +56,7 @@ print ('##,tnow,tclear,ClearType,ClearQ,ClearP,BuyCount,BuyUnresp,BuyResp,SellCo
 
 # initialize a user-defined Vpp coordinator object
 vpp_name = fh.vpp_name_list[0] # select the first VPP
-vpp = VPP(vpp_name,vppEnable)
+vpp = VPP(vpp_name,vppEnable,request_seed)
 vpp.get_helics_subspubs(fh.get_agent_pubssubs(vpp.name, 'VPP'))
 
 # initialize a user-defined auction object
@@ -92,156 +97,168 @@ request_period = houses[last_house_name].hvac.request_period   # local controlle
 market_period = auction.period # market period (300 seconds)
 adjust_period = market_period # market response period (300 seconds)
 fig_update_period = market_period # figure update time period
-tnext_update = dt             # the next time to update the state
-tnext_control = control_period
-tnext_request = dt            # the next time to request
-tnext_lmp = market_period - dt
-tnext_bid = market_period - 2 * dt  # the next time controllers calculate their final bids
-tnext_agg = market_period - 2 * dt  # the next time auction calculates and publishes aggregate bid
-tnext_clear = market_period         # the next time clear the market
-tnext_adjust = market_period       # the next time controllers adjust control parameters/setpoints based on their bid and clearing price
-tnext_fig_update = market_period + dt   # the next time to update figures
+
+# per-phase timing of the loop, histograms per market period are written to data_path/timing.json
+timer = PHASE_TIMER(market_period)
+tracer = grant_trace.GRANT_TRACER(fh.fedName) # writes the time grants when PET_GRANT_TRACE is set
 
 time_granted = 0
 time_last = 0
+hour_of_day = 0
+day_of_week = dt_now.weekday()
 
 
-"""============================Substation Loop=================================="""
+"""============================Substation Phases=================================="""
 
-while (time_granted < StopTime):
-
-  """ 1. step the co-simulation time """
-  nextHELICSTime = int(min ([tnext_update,tnext_request,tnext_lmp, tnext_bid, tnext_agg, tnext_clear, tnext_adjust, StopTime]))
-  time_granted = int (helics.helicsFederateRequestTime(fh.hFed, nextHELICSTime))
-  time_delta = time_granted - time_last
-  time_last = time_granted
-  hour_of_day = 24.0 * ((float(time_granted) / 86400.0) % 1.0)
-  dt_now = dt_now + timedelta(seconds=time_delta) # this is the actual time
-  day_of_week = dt_now.weekday() # get the day of week
-  hour_of_day = dt_now.hour # get the hour of the day
-
-
-  """ 2. houses update state/measurements for all devices, 
-         update schedule and determine the power needed for hvac,
-         make power predictions for solar,
-         make power predictions for house load"""
-  if time_granted >= tnext_update:
-    for key, house in houses.items():
-      house.update_measurements() # update measurements for all devices
-      house.hvac.change_basepoint(hour_of_day, day_of_week) # update schedule
-      house.hvac.determine_power_needed() # hvac determines if power is needed based on current state
-      house.predict_solar_power() # predict the solar power generation
-      house.predict_house_load()  # predict the house load
-    vpp.get_vpp_load() # get the VPP load
-    curves.record_state_statistics(time_granted, houses, auction, vpp) # record something
-    tnext_update += update_period
+def update_phase(time_granted):
+  """ houses update state/measurements for all devices,
+      update schedule and determine the power needed for hvac,
+      make power predictions for solar,
+      make power predictions for house load"""
+  for key, house in houses.items():
+    house.update_measurements() # update measurements for all devices
+    house.hvac.change_basepoint(hour_of_day, day_of_week) # update schedule
+    house.hvac.determine_power_needed() # hvac determines if power is needed based on current state
+    house.predict_solar_power() # predict the solar power generation
+    house.predict_house_load()  # predict the house load
+  vpp.get_vpp_load() # get the VPP load
+  curves.record_state_statistics(time_granted, houses, auction, vpp) # record something
 
 
-  """ 3. houses launch basic real-time control actions (not post-market control)
+def control_phase(time_granted):
+  """ houses launch basic real-time control actions (not post-market control)
       including the control for battery"""
-  if time_granted >= tnext_control:
-    for key, house in houses.items():
-      if house.hasBatt:
-        house.battery.auto_control() # real-time basic control of battery to track the HVAC load
-      # house.hvac.auto_control()
-    tnext_control += control_period
+  for key, house in houses.items():
+    if house.hasBatt:
+      house.battery.auto_control() # real-time basic control of battery to track the HVAC load
+    # house.hvac.auto_control()
+
+
+def lmp_phase(time_granted):
+  """ market gets the local marginal price (LMP) from the bulk power grid,"""
+  auction.get_lmp () # get local marginal price (LMP) from the bulk power grid
+  auction.get_refload() # get distribution load from gridlabd
+  for key, house in houses.items():
+    house.get_lmp_from_market(auction.lmp) # houses get LMP from the market
+
+
+def bid_phase(time_granted):
+  """ houses formulate and send their bids"""
+  auction.clear_bids() # auction remove all previous records, re-initialize
+  time_key = str(int(scheduler.next_due('clear')))
+  fh.prosumer_metrics[time_key] = {}
+  for key, house in houses.items():
+    bid = house.formulate_bid() # bid is [bid_price, quantity, hvac.power_needed, role, unres_kw, name]
+    fh.prosumer_metrics[time_key][house.name] = [bid[0], bid[1], bid[2], bid[3]]
+    if hasMarket:
+      auction.collect_bid(bid)
 
 
-  """ 4. market gets the local marginal price (LMP) from the bulk power grid,"""
-  if time_granted >= tnext_lmp:
-    auction.get_lmp () # get local marginal price (LMP) from the bulk power grid
-    auction.get_refload() # get distribution load from gridlabd
-    for key, house in houses.items():
-      house.get_lmp_from_market(auction.lmp) # houses get LMP from the market
-    tnext_lmp += market_period
+def agg_phase(time_granted):
+  """ market aggreates bids from prosumers"""
+  auction.aggregate_bids()
+  auction.publish_agg_bids_for_buyer()
 
 
-  """ 5. houses formulate and send their bids"""
-  if time_granted >= tnext_bid:
-    auction.clear_bids() # auction remove all previous records, re-initialize
-    time_key = str(int(tnext_clear))
-    fh.prosumer_metrics[time_key] = {}
+def clear_phase(time_granted):
+  """ market clears the market """
+  tclear = scheduler.next_due('clear')
+  if hasMarket:
+    auction.clear_market(tclear, time_granted)
+    auction.surplusCalculation(tclear, time_granted)
+    auction.publish_clearing_price()
+    print("!!The cleared price is: ",auction.clearing_price)
+    timer.begin('post_market') # houses receive the cleared price and run the post-market control
     for key, house in houses.items():
-      bid = house.formulate_bid() # bid is [bid_price, quantity, hvac.power_needed, role, unres_kw, name]
-      fh.prosumer_metrics[time_key][house.name] = [bid[0], bid[1], bid[2], bid[3]]
-      if hasMarket:
-        auction.collect_bid(bid)
-    tnext_bid += market_period
+      house.get_cleared_price (auction.clearing_price)
+      house.publish_meter_price()
+      house.post_market_control(auction.market_condition, auction.marginal_quantity) # post-market control is needed
+    timer.end()
+  time_key = str(int(tclear))
+  fh.auction_metrics [time_key] = {auction.name:[auction.clearing_price, auction.clearing_type, auction.consumerSurplus, auction.averageConsumerSurplus, auction.supplierSurplus]}
+  curves.record_auction_statistics(time_granted, houses, auction)
+
+
+def adjust_phase(time_granted):
+  """ prosumer demand response (adjust control parameters/setpoints) """
+  if has_demand_response:
+    for key, house in houses.items():
+      house.demand_response()
+
+
+def fig_phase(time_granted):
+  """ visualize some results during the simulation"""
+  curves.update_curves(time_granted)
+  ax1.cla()
+  ax1.set_ylabel("VPP Load (kW)")
+  # ax1.plot(curves.time_hour_curve, curves.curve_distri_load_p)
+  ax1.plot(curves.time_hour_curve, curves.curve_vpp_load_p)
+  ax1.legend(['VPP Load'])
+
+  ax2.cla()
+  ax2.set_ylabel("House Load (kW)")
+  ax2.plot(curves.time_hour_curve, curves.curve_house_load_max)
+  ax2.plot(curves.time_hour_curve, curves.curve_house_load_mean)
+  ax2.plot(curves.time_hour_curve, curves.curve_house_load_min)
+  ax2.legend(['max', 'mean', 'min'])
+
+  ax3.cla()
+  ax3.set_ylabel("Temperature (degF)")
+  ax3.plot(curves.time_hour_curve, curves.curve_temp_max)
+  ax3.plot(curves.time_hour_curve, curves.curve_temp_mean)
+  ax3.plot(curves.time_hour_curve, curves.curve_temp_min)
+  ax3.plot(curves.time_hour_curve, curves.curve_basepoint_mean)
+  ax3.plot(curves.time_hour_curve, curves.curve_setpoint_mean)
+  ax3.legend(['max', 'mean', 'min', 'base-point', 'set-point'])
+
+  ax4.cla()
+  ax4.set_ylabel("Cleared Price ($)")
+  ax4.plot(curves.time_hour_curve, curves.curve_cleared_price)
+
+  ax5.cla()
+  ax5.set_xlabel("Time (h)")
+  ax5.set_ylabel("Percentage")
+  ax5.plot(curves.time_hour_curve, curves.curve_hvac_on_ratio)
+  ax5.plot(curves.time_hour_curve, curves.curve_buyer_ratio)
+  ax5.plot(curves.time_hour_curve, curves.curve_seller_ratio)
+  ax5.plot(curves.time_hour_curve, curves.curve_nontcp_ratio)
+  ax5.legend(['HVAC-ON ratio', 'Buyer ratio', 'Seller ratio', 'None-participant ratio'])
+
+
+  plt.pause(0.01)
+
+
+# register the phases, tasks due at the same time run in ascending priority
+scheduler = SubstationScheduler(StopTime, timer)
+scheduler.add_periodic('update', update_phase, update_period, dt, priority=1)
+scheduler.add_periodic('control', control_phase, control_period, control_period, priority=2)
+scheduler.add_periodic('lmp', lmp_phase, market_period, market_period - dt, priority=3)
+scheduler.add_periodic('bid', bid_phase, market_period, market_period - 2 * dt, priority=4)  # controllers calculate their final bids
+scheduler.add_periodic('agg', agg_phase, market_period, market_period - 2 * dt, priority=5)  # auction calculates and publishes aggregate bid
+scheduler.add_periodic('clear', clear_phase, market_period, market_period, priority=6)
+scheduler.add_periodic('adjust', adjust_phase, adjust_period, market_period, priority=7)  # controllers adjust setpoints based on their bid and clearing price
+if drawFigure:
+  scheduler.add_periodic('fig', fig_phase, fig_update_period, market_period + dt, priority=8)
 
 
-  """ 6. market aggreates bids from prosumers"""
-  if time_granted >= tnext_agg:
-    auction.aggregate_bids()
-    auction.publish_agg_bids_for_buyer()
-    tnext_agg += market_period
+"""============================Substation Loop=================================="""
 
+while (time_granted < StopTime):
 
-  """ 7. market clears the market """
-  if time_granted >= tnext_clear:
-    if hasMarket:
-      auction.clear_market(tnext_clear, time_granted)
-      auction.surplusCalculation(tnext_clear, time_granted)
-      auction.publish_clearing_price()
-      print("!!The cleared price is: ",auction.clearing_price)
-      for key, house in houses.items():
-        house.get_cleared_price (auction.clearing_price)
-        house.publish_meter_price()
-        house.post_market_control(auction.market_condition, auction.marginal_quantity) # post-market control is needed
-    time_key = str(int(tnext_clear))
-    fh.auction_metrics [time_key] = {auction.name:[auction.clearing_price, auction.clearing_type, auction.consumerSurplus, auction.averageConsumerSurplus, auction.supplierSurplus]}
-    curves.record_auction_statistics(time_granted, houses, auction)
-    tnext_clear += market_period
-
-
-  """ 8. prosumer demand response (adjust control parameters/setpoints) """
-  if time_granted >= tnext_adjust:
-    if has_demand_response:
-      for key, house in houses.items():
-        house.demand_response()
-    tnext_adjust += market_period
-
-
-  """ 9. visualize some results during the simulation"""
-  if drawFigure and time_granted >= tnext_fig_update:
-    curves.update_curves(time_granted)
-    ax1.cla()
-    ax1.set_ylabel("VPP Load (kW)")
-    # ax1.plot(curves.time_hour_curve, curves.curve_distri_load_p)
-    ax1.plot(curves.time_hour_curve, curves.curve_vpp_load_p)
-    ax1.legend(['VPP Load'])
-
-    ax2.cla()
-    ax2.set_ylabel("House Load (kW)")
-    ax2.plot(curves.time_hour_curve, curves.curve_house_load_max)
-    ax2.plot(curves.time_hour_curve, curves.curve_house_load_mean)
-    ax2.plot(curves.time_hour_curve, curves.curve_house_load_min)
-    ax2.legend(['max', 'mean', 'min'])
-
-    ax3.cla()
-    ax3.set_ylabel("Temperature (degF)")
-    ax3.plot(curves.time_hour_curve, curves.curve_temp_max)
-    ax3.plot(curves.time_hour_curve, curves.curve_temp_mean)
-    ax3.plot(curves.time_hour_curve, curves.curve_temp_min)
-    ax3.plot(curves.time_hour_curve, curves.curve_basepoint_mean)
-    ax3.plot(curves.time_hour_curve, curves.curve_setpoint_mean)
-    ax3.legend(['max', 'mean', 'min', 'base-point', 'set-point'])
-
-    ax4.cla()
-    ax4.set_ylabel("Cleared Price ($)")
-    ax4.plot(curves.time_hour_curve, curves.curve_cleared_price)
-
-    ax5.cla()
-    ax5.set_xlabel("Time (h)")
-    ax5.set_ylabel("Percentage")
-    ax5.plot(curves.time_hour_curve, curves.curve_hvac_on_ratio)
-    ax5.plot(curves.time_hour_curve, curves.curve_buyer_ratio)
-    ax5.plot(curves.time_hour_curve, curves.curve_seller_ratio)
-    ax5.plot(curves.time_hour_curve, curves.curve_nontcp_ratio)
-    ax5.legend(['HVAC-ON ratio', 'Buyer ratio', 'Seller ratio', 'None-participant ratio'])
-
-
-    plt.pause(0.01)
-    tnext_fig_update += fig_update_period
+  """ 1. step the co-simulation time to the next due task """
+  nextHELICSTime = int(scheduler.next_time())
+  wait_start = time.perf_counter_ns()
+  time_granted = int (tracer.request_time(fh.hFed, nextHELICSTime))
+  timer.set_time(time_granted)
+  timer.add('helics_wait', time.perf_counter_ns() - wait_start) # time blocked until HELICS grants, not computing
+  time_delta = time_granted - time_last
+  time_last = time_granted
+  dt_now = dt_now + timedelta(seconds=time_delta) # this is the actual time
+  day_of_week = dt_now.weekday() # get the day of week
+  hour_of_day = dt_now.hour # get the hour of the day
+
+  """ 2. run all phases due at the granted time """
+  scheduler.run_due(time_granted)
 
 
 """============================ Finalize the metrics output ============================"""
@@ -254,7 +271,11 @@ print (json.dumps(fh.prosumer_metrics), file=house_op)
 auction_op.close()
 house_op.close()
 fh.destroy_federate()  # destroy the federate
+fh.wait_federates(600) # let the other federates write their metrics, stop them if they do not end
+fh.stop_resource_sampler()
 fh.show_resource_consumption() # after simulation, print the resource consumption
+timer.save(data_path)
+timer.show_statistics() # where the wall time of the loop went
 plt.show()
 # fh.kill_processes(True) # it is not suggested here because some other federates may not end their simulations, it will affect their output metrics
 
@@ -38,8 +38,8 @@ class AUCTION:
         stat_interval (str): always 86400 seconds, for one day, not used, from dict
         stat_type (str): always mean and standard deviation, not used, from dict
         stat_value (str): always zero, not used, from dict
-        curve_buyer (curve): data structure to accumulate buyer bids
-        curve_seller (curve): data structure to accumulate seller bids
+        curve_buyer (array_curve): data structure to accumulate buyer bids
+        curve_seller (array_curve): data structure to accumulate seller bids
         refload (float): the latest substation load from GridLAB-D
         lmp (float): the latest locational marginal price from the bulk system market
         unresp (float): unresponsive load, i.e., total substation load less the bidding, running HVACs
@@ -72,6 +72,8 @@ class AUCTION:
 
         # updated in collect_agent_bids, used in clear_market
         self.bids = []
+        self.buyer_points = []
+        self.seller_points = []
         self.curve_buyer = None
         self.curve_seller = None
 
@@ -157,9 +159,11 @@ class AUCTION:
     def clear_bids (self):
         """Re-initializes curve_buyer and curve_seller, sets the unresponsive load estimate to the total substation load.
         """
-        self.curve_buyer = helpers.curve ()
-        self.curve_seller = helpers.curve ()
+        self.curve_buyer = helpers.array_curve ()
+        self.curve_seller = helpers.array_curve ()
         self.bids.clear()
+        self.buyer_points = [] # (price, quantity, is_on) of the collected bids, added to the curves by aggregate_bids
+        self.seller_points = []
         # self.unresp = self.refload
         self.unresp = 0 # modified by Yuanliang
         # added
@@ -176,7 +180,7 @@ class AUCTION:
         """
         price = bid[0]
         quantity = bid[1]
-        self.curve_seller.add_to_curve (price, quantity, False)
+        self.seller_points.append((price, quantity, False))
 
     def collect_bid (self, bid):
         """Gather HVAC bids into curve_buyer
@@ -199,12 +203,12 @@ class AUCTION:
         if role == "seller":
             self.unresp_seller -= quantity
             if price > 0 and quantity > 0.0:
-                self.curve_seller.add_to_curve (price, quantity, True)
+                self.seller_points.append((price, quantity, True))
         elif role == "buyer" and not base_covered:
             self.unresp += unresp_load # the calculation of unresponsive load may need be updated
             # it should collect the unresponsive load from houses, but also from other devices and loss
             if price > 0 and quantity > 0.0:
-                self.curve_buyer.add_to_curve (price, quantity, hvac_needed)
+                self.buyer_points.append((price, quantity, hvac_needed))
 
         # if is_on:
         #     self.unresp -= quantity
@@ -217,8 +221,18 @@ class AUCTION:
     def add_unresponsive_load(self, quantity):
         self.unresp += quantity
 
+    def add_collected_bids(self):
+        # the collected bids go into the curves in one bulk append per curve, in the order they were collected
+        for curve, points in ((self.curve_buyer, self.buyer_points), (self.curve_seller, self.seller_points)):
+            if len(points) > 0:
+                prices, quantities, is_on = zip(*points)
+                curve.add_bids(prices, quantities, is_on)
+            points.clear()
+
     def aggregate_bids(self):
 
+        self.add_collected_bids()
+
         # for buyers
         #Aggregates the unresponsive load and responsive load bids for submission to the bulk system market
         if self.unresp > 0:
@@ -0,0 +1,108 @@
+# file: phase_timer.py
+"""Per-phase timing of the substation loop.
+
+Every phase run by the scheduler, the time blocked in helicsFederateRequestTime
+and a few sections inside the phases are timed with perf_counter_ns. Nested
+sections are exclusive: the time of an inner section is not counted again in
+the outer one. For every market period and phase the timer keeps the number
+of runs, the total time and a log2 histogram of the durations; bucket b holds
+the durations d (ns) with d.bit_length() == b, that is 2**(b-1) <= d < 2**b.
+"""
+import os
+import json
+from time import perf_counter_ns
+from contextlib import contextmanager
+
+NUM_BUCKETS = 48 # 2**47 ns is about 39 hours
+
+
+class PHASE_TIMER:
+    """Collects per-market-period duration histograms of the loop phases
+
+    Args:
+        market_period (int): market period in seconds, the histograms are kept per period
+
+    Attributes:
+        periods (dict): {period index: {phase: [count, total_ns, histogram]}}
+        period (int): index of the current period, period k covers the times (k*market_period, (k+1)*market_period]
+    """
+    def __init__(self, market_period):
+        self.market_period = market_period
+        self.periods = {}
+        self.period = None
+        self.current = None
+        self.stack = [] # [phase, start_ns, child_ns] of the open sections
+        self.set_time(0)
+
+    def set_time(self, time_granted):
+        # switch to the histograms of the market period containing time_granted
+        period = max(0, (int(time_granted) - 1) // self.market_period)
+        if period != self.period:
+            self.period = period
+            self.current = self.periods.setdefault(period, {})
+
+    def add(self, phase, duration_ns):
+        stats = self.current.get(phase)
+        if stats is None:
+            stats = self.current[phase] = [0, 0, [0]*NUM_BUCKETS]
+        stats[0] += 1
+        stats[1] += duration_ns
+        stats[2][min(duration_ns.bit_length(), NUM_BUCKETS - 1)] += 1
+
+    def begin(self, phase):
+        self.stack.append([phase, perf_counter_ns(), 0])
+
+    def end(self):
+        now = perf_counter_ns()
+        phase, start, child = self.stack.pop()
+        elapsed = now - start
+        self.add(phase, elapsed - child)
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    @contextmanager
+    def section(self, phase):
+        self.begin(phase)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def totals(self):
+        """Returns {phase: [count, total_ns]} over the whole run
+        """
+        totals = {}
+        for phases in self.periods.values():
+            for phase, stats in phases.items():
+                total = totals.setdefault(phase, [0, 0])
+                total[0] += stats[0]
+                total[1] += stats[1]
+        return totals
+
+    def save(self, data_path, file_name = 'timing.json'):
+        """Writes the histograms of all market periods to data_path
+
+        Only the non-empty buckets are written, as {bucket: count}.
+        """
+        periods = []
+        for period in sorted(self.periods.keys()):
+            phases = {}
+            for phase, (count, total_ns, histogram) in self.periods[period].items():
+                phases[phase] = {'count': count, 'total_ns': total_ns,
+                                 'histogram': {str(b): n for b, n in enumerate(histogram) if n > 0}}
+            periods.append({'period': period, 'start': period*self.market_period,
+                            'end': (period + 1)*self.market_period, 'phases': phases})
+        output = {'market_period': self.market_period, 'clock': 'perf_counter_ns',
+                  'histogram_buckets': 'log2, bucket b holds durations in [2**(b-1), 2**b) ns',
+                  'totals_ns': {phase: total[1] for phase, total in self.totals().items()},
+                  'periods': periods}
+        with open(os.path.join(data_path, file_name), 'w', encoding='utf-8') as f:
+            json.dump(output, f)
+
+    def show_statistics(self):
+        totals = self.totals()
+        all_ns = sum(total[1] for total in totals.values())
+        print('Phase timing:')
+        for phase, (count, total_ns) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            print('  {:<15} runs = {:<8} total = {:10.3f} s ({:5.1f} %)  mean = {:10.3f} ms'.format(
+                  phase, count, total_ns*1e-9, 100*total_ns/max(all_ns, 1), total_ns*1e-6/max(count, 1)))
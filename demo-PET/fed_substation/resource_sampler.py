@@ -0,0 +1,149 @@
+# file: resource_sampler.py
+"""Periodic resource sampling of the co-simulation processes.
+
+A background thread samples every process of the co-simulation (the
+substation federate itself and the processes of the FEDERATE_SUPERVISOR,
+including their child processes) with psutil at a fixed interval. Each
+sample of one process is one record of float64 columns appended to
+resources.bin; resources.json holds the column and federate names. A run
+that crashes keeps every sample written so far.
+
+Columns of a record:
+    time          seconds since the sampler started
+    federate      index into the federate names of resources.json
+    pid
+    cpu_percent   since the previous sample of the process (100 = one core)
+    rss           resident set size in bytes
+    open_files    number of open file descriptors (handles on Windows)
+    read_bytes    cumulative I/O read bytes, NaN if not available
+    write_bytes   cumulative I/O write bytes, NaN if not available
+"""
+import os
+import json
+import time
+import array
+import threading
+import psutil
+import numpy as np
+
+COLUMNS = ['time', 'federate', 'pid', 'cpu_percent', 'rss', 'open_files', 'read_bytes', 'write_bytes']
+
+
+class RESOURCE_SAMPLER:
+    """Samples CPU, memory, open files and I/O of the co-simulation processes
+
+    Args:
+        data_path (str): experiment directory, resources.bin and resources.json are written there
+        sources (function): returns {federate name: pid} of the processes to sample, called at every sample
+        interval (float): seconds between two samples
+
+    Attributes:
+        federates ([str]): federate names in the order of their index
+        num_samples (int): number of records written
+    """
+    def __init__(self, data_path, sources, interval = 5.0):
+        self.bin_path = os.path.join(data_path, 'resources.bin')
+        self.json_path = os.path.join(data_path, 'resources.json')
+        self.sources = sources
+        self.interval = interval
+        self.federates = []
+        self.num_samples = 0
+        self.processes = {} # psutil.Process objects by pid, cpu_percent needs the previous call
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.file = open(self.bin_path, 'wb')
+        self._write_header()
+        self.thread = threading.Thread(target=self._run, name='resource-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.sample() # last sample at the end of the run
+        self.file.close()
+        self._write_header()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval): # sleeps, wakes up early on stop
+            self.sample()
+
+    def _write_header(self):
+        with open(self.json_path, 'w', encoding='utf-8') as f:
+            json.dump({'columns': COLUMNS, 'dtype': '<f8', 'federates': self.federates, 'interval': self.interval,
+                       'num_samples': self.num_samples}, f, indent=1)
+
+    def _federate_index(self, name):
+        if name not in self.federates:
+            self.federates.append(name)
+            self._write_header()
+        return self.federates.index(name)
+
+    def _process(self, pid):
+        proc = self.processes.get(pid)
+        if proc is None:
+            proc = self.processes[pid] = psutil.Process(pid)
+            proc.cpu_percent() # the first call only starts the measurement
+        return proc
+
+    def sample(self):
+        """Appends one record per live process, returns the number of records
+        """
+        now = time.monotonic() - self.start_time
+        records = array.array('d')
+        alive = set()
+        for name, pid in self.sources().items():
+            try:
+                root = psutil.Process(pid)
+                pids = [pid] + [child.pid for child in root.children(recursive=True)]
+            except psutil.Error:
+                continue
+            index = self._federate_index(name)
+            for p in pids:
+                if p in alive: # already sampled as a federate of its own
+                    continue
+                try:
+                    proc = self._process(p)
+                    with proc.oneshot():
+                        cpu = proc.cpu_percent()
+                        rss = proc.memory_info().rss
+                        files = proc.num_fds() if hasattr(proc, 'num_fds') else proc.num_handles()
+                        try:
+                            io = proc.io_counters()
+                            read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                        except (psutil.AccessDenied, AttributeError):
+                            read_bytes, write_bytes = np.nan, np.nan
+                except psutil.Error: # the process ended between two calls
+                    continue
+                alive.add(p)
+                records.extend([now, index, p, cpu, rss, files, read_bytes, write_bytes])
+        for pid in list(self.processes.keys()):
+            if pid not in alive:
+                del self.processes[pid]
+        if self.file.closed:
+            return 0
+        records.tofile(self.file)
+        self.file.flush()
+        num_records = len(records) // len(COLUMNS)
+        self.num_samples += num_records
+        return num_records
+
+
+def load_resources(data_path):
+    """Reads the samples of a run
+
+    Returns:
+        (dict, [str]): one np.ndarray per column, and the federate names indexed by the 'federate' column
+    """
+    with open(os.path.join(data_path, 'resources.json'), encoding='utf-8') as f:
+        header = json.load(f)
+    values = np.fromfile(os.path.join(data_path, 'resources.bin'), dtype=header['dtype'])
+    values = values[:len(values) // len(header['columns']) * len(header['columns'])] # drop a record cut by a crash
+    values = values.reshape(-1, len(header['columns']))
+    return {column: values[:, i] for i, column in enumerate(header['columns'])}, header['federates']
@@ -0,0 +1,158 @@
+# file: scheduler.py
+"""Event scheduler for the substation federate.
+
+Replaces the tnext_* counters of the substation loop. Periodic and one-shot
+tasks are kept in a heap of due times, the federate requests exactly the
+next due time from HELICS, and all tasks due at a granted time run in a
+fixed order (priority first, then registration order).
+"""
+import heapq
+
+
+class TASK:
+    """One scheduled phase of the substation loop
+
+    Args:
+        name (str): unique name of the task
+        callback (function): called as callback(time_granted) when the task is due
+        due (int): first due time in seconds
+        period (int): period in seconds, None for a one-shot task
+        priority (int): tasks due at the same grant run in ascending priority
+        order (int): registration order, breaks ties between equal priorities
+    """
+    def __init__(self, name, callback, due, period, priority, order):
+        self.name = name
+        self.callback = callback
+        self.due = due
+        self.period = period
+        self.priority = priority
+        self.order = order
+        self.num_runs = 0
+
+
+class SubstationScheduler:
+    """Heap based scheduler of the substation loop phases
+
+    Args:
+        stop_time (int): co-simulation stop time in seconds, the scheduler never asks for a later time
+        timer (PHASE_TIMER): if given, every task is timed as a phase named after the task
+
+    Attributes:
+        tasks (dict): registered TASK objects keyed by name
+        heap (list): (due, priority, order, name) entries of the pending tasks
+    """
+    def __init__(self, stop_time, timer = None):
+        self.stop_time = stop_time
+        self.timer = timer
+        self.tasks = {}
+        self.heap = []
+        self.num_registered = 0
+
+    def add_periodic(self, name, callback, period, offset, priority = 0):
+        """Registers a task that runs at offset, offset + period, offset + 2*period, ...
+
+        Args:
+            name (str): unique name of the task
+            callback (function): called as callback(time_granted)
+            period (int): period in seconds
+            offset (int): first due time in seconds
+            priority (int): lower values run first when several tasks are due
+        """
+        self._add(TASK(name, callback, offset, period, priority, self.num_registered))
+
+    def add_once(self, name, callback, time, priority = 0):
+        """Registers a task that runs once at the given time
+        """
+        self._add(TASK(name, callback, time, None, priority, self.num_registered))
+
+    def _add(self, task):
+        if task.name in self.tasks:
+            raise ValueError("task {} is already scheduled".format(task.name))
+        self.tasks[task.name] = task
+        self.num_registered += 1
+        heapq.heappush(self.heap, (task.due, task.priority, task.order, task.name))
+
+    def wake(self, name, time):
+        """Makes a periodic task due earlier, at time, its period then restarts from time
+
+        Used by the wake-on-input mode: HELICS granted the federate early because an input
+        changed, so the state update runs now instead of at its next heartbeat.
+        """
+        task = self.tasks[name]
+        if task.due <= time:
+            return
+        task.due = time # the old heap entry is now stale and skipped
+        heapq.heappush(self.heap, (task.due, task.priority, task.order, task.name))
+
+    def _is_stale(self, entry):
+        task = self.tasks.get(entry[3])
+        return task is None or task.due != entry[0]
+
+    def next_due(self, name):
+        # due time of a task, a running task still reports the time it was due for
+        return self.tasks[name].due
+
+    def next_time(self):
+        """Returns the next time the federate has to be granted
+        """
+        while len(self.heap) > 0 and self._is_stale(self.heap[0]):
+            heapq.heappop(self.heap)
+        if len(self.heap) == 0:
+            return self.stop_time
+        return min(self.heap[0][0], self.stop_time)
+
+    def run_due(self, time_granted):
+        """Runs every task due at or before time_granted, each one at most once
+
+        Periodic tasks are re-armed by one period after they run. If the grant was late by
+        more than a period, the task runs again at the next grant, as the tnext_* counters did.
+
+        Args:
+            time_granted (int): time granted by HELICS
+
+        Returns:
+            int: number of tasks executed
+        """
+        due_tasks = []
+        names = set()
+        while len(self.heap) > 0 and self.heap[0][0] <= time_granted:
+            entry = heapq.heappop(self.heap)
+            if not self._is_stale(entry) and entry[3] not in names: # a woken task can have two entries with the same due time
+                due_tasks.append(entry)
+                names.add(entry[3])
+        due_tasks.sort(key=lambda entry: (entry[1], entry[2]))
+
+        for entry in due_tasks:
+            task = self.tasks[entry[3]]
+            if self.timer is None:
+                task.callback(time_granted)
+            else:
+                self.timer.begin(task.name)
+                task.callback(time_granted)
+                self.timer.end()
+            task.num_runs += 1
+            if task.period is None:
+                del self.tasks[task.name]
+            else:
+                task.due += task.period
+                heapq.heappush(self.heap, (task.due, task.priority, task.order, task.name))
+        return len(due_tasks)
+
+    def checkpoint_state(self):
+        # due time and number of runs of every pending task, the callbacks come from the new run
+        return {name: (task.due, task.num_runs) for name, task in self.tasks.items()}
+
+    def restore_checkpoint(self, state):
+        """Sets the due times of the registered tasks to the saved ones
+
+        One-shot tasks that already ran are removed, tasks registered only in the new run are kept.
+        """
+        for name in list(self.tasks.keys()):
+            if name not in state and self.tasks[name].period is None:
+                del self.tasks[name]
+        for name, (due, num_runs) in state.items():
+            if name in self.tasks:
+                self.tasks[name].due = due
+                self.tasks[name].num_runs = num_runs
+        self.heap = [(task.due, task.priority, task.order, task.name) for task in self.tasks.values()]
+        heapq.heapify(self.heap)
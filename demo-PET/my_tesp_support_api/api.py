@@ -8,6 +8,9 @@ Example:
         import tesp_support.api as tesp
         tesp.pypower_loop('te30_pp.json','TE_Challenge')
 
+    The functions are imported on first access (PEP 562), importing this module
+    does not import the modules behind them.
+
 Public Functions:
     :convert_tmy2_to_epw: Command line utility that converts TMY2 weather files to the EPW format for EnergyPlus.
     :glm_dict: Writes the JSON metadata from a GridLAB-D file.
@@ -29,44 +32,65 @@ Public Functions:
 
 from __future__ import absolute_import
 
-from .feederGenerator import populate_feeder
-from .feederGenerator import write_node_houses
-from .feederGenerator import write_node_house_configs
-from .fncsPYPOWER import pypower_loop 
-from .fncsPYPOWER import summarize_opf 
-from .glm_dict import glm_dict
-from .precool import precool_loop
-from .prep_precool import prep_precool
-from .prep_substation import prep_substation
-from .tesp_case import make_tesp_case
-from .tesp_case import make_monte_carlo_cases
-from .tesp_case import add_tesp_feeder
-from .TMY2EPW import convert_tmy2_to_epw
-from .TMY3toCSV import weathercsv 
-from .substation import substation_loop
-from .weatherAgent import startWeatherAgent
-
-from .case_merge import merge_glm
-from .case_merge import merge_glm_dict
-from .case_merge import merge_agent_dict
-from .case_merge import merge_substation_yaml
-from .case_merge import merge_fncs_config
-from .case_merge import merge_gld_msg
-from .case_merge import merge_substation_msg
- 
-from .fncsPYPOWER import load_json_case
-from .fncsPYPOWER import summarize_opf
-
-from .make_ems import make_ems
-from .make_ems import merge_idf
-
-from .run_test_case import RunTestCase
-from .run_test_case import GetTestCaseReports
-from .run_test_case import InitializeTestCaseReports
-
-from .prep_eplus import make_gld_eplus_case
-
-from .parse_msout import read_most_solution
+import importlib
+
+# public name -> (module, attribute), the module is imported when the name is first used,
+# so a federate only pays for the modules (and their pandas/scipy/networkx/PYPOWER imports) it needs
+_LAZY_ATTRIBUTES = {
+    'populate_feeder': ('.feederGenerator', 'populate_feeder'),
+    'write_node_houses': ('.feederGenerator', 'write_node_houses'),
+    'write_node_house_configs': ('.feederGenerator', 'write_node_house_configs'),
+    'pypower_loop': ('.fncsPYPOWER', 'pypower_loop'),
+    'summarize_opf': ('.fncsPYPOWER', 'summarize_opf'),
+    'load_json_case': ('.fncsPYPOWER', 'load_json_case'),
+    'glm_dict': ('.glm_dict', 'glm_dict'),
+    'precool_loop': ('.precool', 'precool_loop'),
+    'prep_precool': ('.prep_precool', 'prep_precool'),
+    'prep_substation': ('.prep_substation', 'prep_substation'),
+    'make_tesp_case': ('.tesp_case', 'make_tesp_case'),
+    'make_monte_carlo_cases': ('.tesp_case', 'make_monte_carlo_cases'),
+    'add_tesp_feeder': ('.tesp_case', 'add_tesp_feeder'),
+    'convert_tmy2_to_epw': ('.TMY2EPW', 'convert_tmy2_to_epw'),
+    'weathercsv': ('.TMY3toCSV', 'weathercsv'),
+    'substation_loop': ('.substation', 'substation_loop'),
+    'startWeatherAgent': ('.weatherAgent', 'startWeatherAgent'),
+
+    'merge_glm': ('.case_merge', 'merge_glm'),
+    'merge_glm_dict': ('.case_merge', 'merge_glm_dict'),
+    'merge_agent_dict': ('.case_merge', 'merge_agent_dict'),
+    'merge_substation_yaml': ('.case_merge', 'merge_substation_yaml'),
+    'merge_fncs_config': ('.case_merge', 'merge_fncs_config'),
+    'merge_gld_msg': ('.case_merge', 'merge_gld_msg'),
+    'merge_substation_msg': ('.case_merge', 'merge_substation_msg'),
+
+    'make_ems': ('.make_ems', 'make_ems'),
+    'merge_idf': ('.make_ems', 'merge_idf'),
+
+    'RunTestCase': ('.run_test_case', 'RunTestCase'),
+    'GetTestCaseReports': ('.run_test_case', 'GetTestCaseReports'),
+    'InitializeTestCaseReports': ('.run_test_case', 'InitializeTestCaseReports'),
+
+    'make_gld_eplus_case': ('.prep_eplus', 'make_gld_eplus_case'),
+
+    'read_most_solution': ('.parse_msout', 'read_most_solution'),
+}
+
+__all__ = list(_LAZY_ATTRIBUTES.keys())
+
+
+def __getattr__(name):
+    # PEP 562, called only for names not yet in the module namespace
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    value = getattr(importlib.import_module(module_name, __package__), attribute)
+    globals()[name] = value # later accesses are plain global lookups
+    return value
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__))
+
 
 #from .process_agents import process_agents
 #from .process_eplus import process_eplus
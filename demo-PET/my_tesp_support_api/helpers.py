@@ -153,6 +153,123 @@ class curve:
                 self.quantity.append(quantity)
                 self.count += 1
 
+class array_curve:
+    """ Accumulates a set of price, quantity bids in growable NumPy arrays
+
+    Drop-in replacement of curve. Bids are appended in O(1) and sorted once,
+    when the price or quantity is first read after new bids were added. The
+    sorted order is the same as the one built by curve.add_to_curve:
+    descending by price, and among equal prices the latest bid first.
+
+    Attributes:
+        price (np.ndarray): sorted array of prices, in $/kWh
+        quantity (np.ndarray): sorted array of quantities, in kW
+        cumulative_quantity (np.ndarray): running sum of quantity in the sorted order, in kW
+        count (int): the number of collected bids
+        total (float): the total kW bidding
+        total_on (float): the total kW bidding that are currently on
+        total_off (float): the total kW bidding that are currently off
+    """
+    def __init__(self, capacity = 64):
+        self._price = np.empty(capacity)
+        self._quantity = np.empty(capacity)
+        self.count = 0
+        self.total = 0.0
+        self.total_on = 0.0
+        self.total_off = 0.0
+        self.order = 'descending'
+        self._sorted = None # (price, quantity, cumulative quantity) in the current order, None if not sorted yet
+
+    def set_curve_order(self, flag):
+        """ Set the curve order (by price) to ascending or descending
+
+        Args:
+            flag (str): 'ascending' or 'descending'
+        """
+        self.order = flag
+        self._sorted = None
+
+    def _reserve(self, n):
+        if n > len(self._price):
+            size = max(n, 2*len(self._price))
+            self._price = np.resize(self._price, size)
+            self._quantity = np.resize(self._quantity, size)
+
+    def add_to_curve(self, price, quantity, is_on):
+        """ Add one point to the curve
+
+        Args:
+            price (float): the bid price, should be $/kWhr
+            quantity (float): the bid quantity, should be kW
+            is_on (Boolean): True if the load is currently on, False if not
+        """
+        if quantity == 0:
+            return
+        self.total += quantity
+        if is_on:
+            self.total_on += quantity
+        else:
+            self.total_off += quantity
+        self._reserve(self.count + 1)
+        self._price[self.count] = price
+        self._quantity[self.count] = quantity
+        self.count += 1
+        self._sorted = None
+
+    def add_bids(self, prices, quantities, is_on):
+        """ Add many points to the curve at once, same curve as calling add_to_curve for each of them in order
+
+        The totals are summed with np.sum, so they can differ from add_to_curve in the last bits.
+
+        Args:
+            prices (array_like): the bid prices, should be $/kWhr
+            quantities (array_like): the bid quantities, should be kW
+            is_on (array_like): True if the load is currently on, False if not
+        """
+        prices = np.asarray(prices, dtype=float)
+        quantities = np.asarray(quantities, dtype=float)
+        is_on = np.broadcast_to(np.asarray(is_on, dtype=bool), quantities.shape)
+        keep = quantities != 0
+        prices, quantities, is_on = prices[keep], quantities[keep], is_on[keep]
+        n = len(quantities)
+        if n == 0:
+            return
+        self.total += float(np.sum(quantities))
+        self.total_on += float(np.sum(quantities[is_on]))
+        self.total_off += float(np.sum(quantities[~is_on]))
+        self._reserve(self.count + n)
+        self._price[self.count:self.count+n] = prices
+        self._quantity[self.count:self.count+n] = quantities
+        self.count += n
+        self._sorted = None
+
+    def _sort(self):
+        # newest first, then a stable sort by descending price keeps the newest bid first among equal prices
+        newest_first = np.arange(self.count)[::-1]
+        idx = newest_first[np.argsort(-self._price[newest_first], kind='stable')]
+        if self.order == 'ascending':
+            idx = idx[::-1]
+        quantity = self._quantity[idx]
+        self._sorted = (self._price[idx], quantity, np.cumsum(quantity))
+
+    @property
+    def price(self):
+        if self._sorted is None:
+            self._sort()
+        return self._sorted[0]
+
+    @property
+    def quantity(self):
+        if self._sorted is None:
+            self._sort()
+        return self._sorted[1]
+
+    @property
+    def cumulative_quantity(self):
+        if self._sorted is None:
+            self._sort()
+        return self._sorted[2]
+
 def parse_fncs_number (arg):
     """ Parse floating-point number from a FNCS message; must not have leading sign or exponential notation
 
@@ -269,9 +386,12 @@ def aggregate_bid (crv):
     """
     unresp = 0
     idx = 0
-    pInd = np.flip(np.argsort(np.array(crv.price)), 0)
-    p = 1000.0 * np.array (crv.price)[pInd]  # $/MW
-    q = 0.001 * np.array (crv.quantity)[pInd] # MWhr
+    # the curves keep their points sorted by price, an ascending (seller) curve is read from the end
+    p = 1000.0 * np.array (crv.price)  # $/MW
+    q = 0.001 * np.array (crv.quantity) # MWhr
+    if p.size > 1 and p[0] < p[-1]:
+        p = p[::-1]
+        q = q[::-1]
     if p.size > 0:
         idx = np.argwhere (p == p[0])[-1][0]
         unresp = np.cumsum(q[:idx+1])[-1]
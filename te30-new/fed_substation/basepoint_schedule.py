@@ -0,0 +1,110 @@
+# file: basepoint_schedule.py
+"""Thermostat basepoint schedules compiled into lookup tables.
+
+The schedule of an HVAC (wakeup, daylight, evening and night on weekdays,
+day and night on weekends) never changes during a run. It is compiled
+once into a [day_of_week, minute_of_day] table of schedule periods, so the
+basepoint at a given time is a table lookup instead of a chain of hour
+comparisons. HVACs with the same start hours share one table (a schedule
+class); the setpoint of each period stays per HVAC.
+
+The table holds the period at the start of every minute, which is exact for
+the whole hours the substation passes (hour_of_day = dt_now.hour) and
+rounds a fractional hour down to its minute.
+"""
+import functools
+import numpy as np
+
+MINUTES_PER_DAY = 1440
+# start hours of the periods, the key of a schedule class
+START_FIELDS = ['wakeup_start', 'daylight_start', 'evening_start', 'night_start',
+                'weekend_day_start', 'weekend_night_start']
+# setpoints of the periods, in the order of the period codes of the table
+SET_FIELDS = ['night_set', 'wakeup_set', 'daylight_set', 'evening_set', 'weekend_night_set', 'weekend_day_set']
+NIGHT, WAKEUP, DAYLIGHT, EVENING, WEEKEND_NIGHT, WEEKEND_DAY = range(len(SET_FIELDS))
+
+
+def minute_of_day(hod):
+    """Row of the hour of the day (0..24) in a schedule table"""
+    return min(int(hod * 60), MINUTES_PER_DAY - 1)
+
+
+@functools.lru_cache(maxsize=None)
+def schedule_periods(starts):
+    """Compiles the start hours of a schedule into its period table
+
+    Args:
+        starts (tuple): the START_FIELDS values of the schedule
+
+    Returns:
+        np.ndarray: [7, 1440] uint8 period codes, row 0 is Monday; shared by all schedules with these starts
+    """
+    wakeup_start, daylight_start, evening_start, night_start, weekend_day_start, weekend_night_start = starts
+    hod = np.arange(MINUTES_PER_DAY) / 60
+    weekday = np.select([(hod >= wakeup_start) & (hod < daylight_start),
+                         (hod >= daylight_start) & (hod < evening_start),
+                         (hod >= evening_start) & (hod < night_start)],
+                        [WAKEUP, DAYLIGHT, EVENING], NIGHT)
+    weekend = np.where((hod >= weekend_day_start) & (hod < weekend_night_start), WEEKEND_DAY, WEEKEND_NIGHT)
+    table = np.empty((7, MINUTES_PER_DAY), dtype=np.uint8)
+    table[:5] = weekday
+    table[5:] = weekend
+    table.flags.writeable = False
+    return table
+
+
+def schedule_of(hvac):
+    """The period table and the setpoints of one HVAC"""
+    starts = tuple(float(getattr(hvac, field)) for field in START_FIELDS)
+    return schedule_periods(starts), np.array([getattr(hvac, field) for field in SET_FIELDS], dtype=np.float64)
+
+
+class BASEPOINT_SCHEDULE:
+    """The compiled schedules of a population of HVACs
+
+    Args:
+        hvacs (list): HVAC objects with the START_FIELDS and SET_FIELDS attributes, in row order
+
+    Attributes:
+        periods (np.ndarray): [classes, 7, 1440] period codes of the schedule classes
+        house_class (np.ndarray): schedule class of each row
+        setpoints (np.ndarray): [rows, periods] setpoint of each period in deg F
+    """
+    def __init__(self, hvacs):
+        classes = {}
+        house_class = []
+        for hvac in hvacs:
+            starts = tuple(float(getattr(hvac, field)) for field in START_FIELDS)
+            house_class.append(classes.setdefault(starts, len(classes)))
+        self.periods = np.stack([schedule_periods(starts) for starts in classes]) if classes else np.zeros((0, 7, MINUTES_PER_DAY), dtype=np.uint8)
+        self.house_class = np.array(house_class, dtype=np.intp)
+        self.setpoints = np.array([[getattr(hvac, field) for field in SET_FIELDS] for hvac in hvacs], dtype=np.float64).reshape(-1, len(SET_FIELDS))
+        self.rows = np.arange(len(house_class))
+
+    def lookup(self, hod, dow):
+        """Scheduled basepoint of every row
+
+        Args:
+            hod (float): the hour of the day, from 0 to 24
+            dow (int): the day of the week, zero being Monday
+
+        Returns:
+            np.ndarray: basepoint of each row in deg F
+        """
+        return self.setpoints[self.rows, self.periods[self.house_class, dow, minute_of_day(hod)]]
+
+    def changed(self, basepoint, hod, dow, fixed = None, tolerance = 0.1):
+        """Rows whose basepoint moves by more than tolerance, and the new basepoints
+
+        Args:
+            basepoint (np.ndarray): current basepoint of each row
+            fixed (np.ndarray): True for rows whose basepoint never changes, None for none
+
+        Returns:
+            (np.ndarray, np.ndarray): row indices of the changed rows, scheduled basepoint of every row
+        """
+        val = self.lookup(hod, dow)
+        changed = np.abs(basepoint - val) > tolerance
+        if fixed is not None:
+            changed &= ~fixed
+        return np.flatnonzero(changed), val
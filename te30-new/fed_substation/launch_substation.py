@@ -18,9 +18,12 @@ except:
 from datetime import datetime
 from datetime import timedelta
 import json
+import numpy as np
 from my_auction import my_auction  # import user-defined my_auction class for market
 from my_hvac import my_hvac        # import user-defined my_hvac class for hvac controllers
+from basepoint_schedule import BASEPOINT_SCHEDULE
 import my_tesp_support_api.helpers as helpers
+import my_tesp_support_api.grant_trace as grant_trace
 if sys.platform != 'win32':
   import resource
 
@@ -65,6 +68,7 @@ def my_substation_loop(configfile, metrics_root, helicsConfig, hour_stop=48, fla
   subCount = helics.helicsFederateGetInputCount(hFed)
   gldName = dict['GridLABD']
   fedName = helics.helicsFederateGetName(hFed)
+  tracer = grant_trace.GRANT_TRACER(fedName) # writes the time grants when PET_GRANT_TRACE is set
   bulkName = 'pypower'
 
   # initialize objects for subscriptions and the publications, and save these objects in dictionary
@@ -110,6 +114,11 @@ def my_substation_loop(configfile, metrics_root, helicsConfig, hour_stop=48, fla
     pubCooling[ctl] = helics.helicsFederateGetPublication (hFed, ctlPubTopic + '/cooling_setpoint')
     pubDeadband[ctl] = helics.helicsFederateGetPublication (hFed, ctlPubTopic + '/thermostat_deadband')
 
+  # the thermostat schedules of all controllers as one table, a schedule update is one lookup for all of them
+  hvacList = list(hvacObjs.values())
+  schedule = BASEPOINT_SCHEDULE(hvacList)
+  basepoints = np.array([obj.basepoint for obj in hvacList])
+
   # execute the substation federate
   helics.helicsFederateEnterExecutingMode(hFed)
 
@@ -134,7 +143,7 @@ def my_substation_loop(configfile, metrics_root, helicsConfig, hour_stop=48, fla
     """ 1. step the simulation time """
     nextHELICSTime = int(min ([tnext_bid, tnext_agg, tnext_clear, tnext_adjust, time_stop]))
 #    fncs.update_time_delta (nextFNCSTime-time_granted)
-    time_granted = int (helics.helicsFederateRequestTime(hFed, nextHELICSTime))
+    time_granted = int (tracer.request_time(hFed, nextHELICSTime))
     time_delta = time_granted - time_last
     time_last = time_granted
     hour_of_day = 24.0 * ((float(time_granted) / 86400.0) % 1.0)
@@ -159,9 +168,12 @@ def my_substation_loop(configfile, metrics_root, helicsConfig, hour_stop=48, fla
     """3. update the time-of-day schedule (setpoints) for HVAC controllers,
     the thermostat setting will follow the  schedule
     """
-    for key, obj in hvacObjs.items():
-      if obj.change_basepoint (hour_of_day, day_of_week):
-        helics.helicsPublicationPublishDouble (pubCooling[obj], obj.basepoint)
+    changed, scheduled = schedule.changed (basepoints, hour_of_day, day_of_week)
+    basepoints[changed] = scheduled[changed]
+    for i in changed: # same as obj.change_basepoint for every controller
+      obj = hvacList[i]
+      obj.basepoint = float(scheduled[i])
+      helics.helicsPublicationPublishDouble (pubCooling[obj], obj.basepoint)
     if bSetDefaults:
       for key, obj in hvacObjs.items():
         helics.helicsPublicationPublishString (pubMtrMode[obj], 'HOURLY')
@@ -8,6 +8,7 @@ mechanism.
 """
 import math
 import my_tesp_support_api.helpers as helpers
+from basepoint_schedule import schedule_of, minute_of_day
 
 class my_hvac:
     """This agent manages thermostat setpoint and bidding for a house
@@ -73,6 +74,8 @@ class my_hvac:
         self.weekend_day_set = float(dict['weekend_day_set'])
         self.weekend_night_start = float(dict['weekend_night_start'])
         self.weekend_night_set = float(dict['weekend_night_set'])
+        # the schedule above compiled into a [day_of_week, minute_of_day] period table, shared by the HVACs with the same start hours
+        self.schedule_periods, self.schedule_sets = schedule_of(self)
         self.deadband = float(dict['deadband'])
         self.offset_limit = float(dict['offset_limit'])
         self.ramp = float(dict['ramp'])
@@ -154,18 +157,7 @@ class my_hvac:
         Returns:
             Boolean: True if the setting changed, Falso if not
         """
-        if dow > 4: # a weekend
-            val = self.weekend_night_set
-            if hod >= self.weekend_day_start and hod < self.weekend_night_start:
-                val = self.weekend_day_set
-        else: # a weekday
-            val = self.night_set
-            if hod >= self.wakeup_start and hod < self.daylight_start:
-                val = self.wakeup_set
-            elif hod >= self.daylight_start and hod < self.evening_start:
-                val = self.daylight_set
-            elif hod >= self.evening_start and hod < self.night_start:
-                val = self.evening_set
+        val = self.schedule_sets[self.schedule_periods[dow, minute_of_day(hod)]]
         if abs(self.basepoint - val) > 0.1:
             self.basepoint = val
             return True
@@ -18,6 +18,7 @@ try:
     import helics  # set the broker = HELICS in WEATHER_CONFIG
 except:
     pass
+import my_tesp_support_api.grant_trace as grant_trace
 
 def stop_helics_federate (fed):
     helics.helicsFederateDestroy(fed)
@@ -66,6 +67,7 @@ def startWeatherAgent(datafile, configfile):
                 publishTimeAhead = conf['PublishTimeAhead']
                 forecastPeriod = conf['forecastPeriod']
                 forecastParameters = conf['parameters']
+                coreInit = conf.get('coreinit', '') # e.g. '--brokerport=24000' to reach a broker on another port
             except ValueError as ex:
                 print(ex)
     else:
@@ -142,9 +144,10 @@ def startWeatherAgent(datafile, configfile):
       fedInfo = helics.helicsCreateFederateInfo()
       helics.helicsFederateInfoSetCoreName(fedInfo, fedName)
       helics.helicsFederateInfoSetCoreTypeFromString(fedInfo, 'zmq')
-      helics.helicsFederateInfoSetCoreInitString(fedInfo, '--federates=1')
+      helics.helicsFederateInfoSetCoreInitString(fedInfo, ('--federates=1 ' + coreInit).strip())
       helics.helicsFederateInfoSetTimeProperty(fedInfo, helics.helics_property_time_delta, timeDeltaInSeconds)
       hFed = helics.helicsCreateValueFederate(fedName, fedInfo)
+      tracer = grant_trace.GRANT_TRACER(fedName) # writes the time grants when PET_GRANT_TRACE is set
       for col in weatherData.columns:
         pubName = fedName + '/' + col
         hPubs[col] = helics.helicsFederateRegisterGlobalPublication(hFed, pubName, helics.helics_data_type_string, "")
@@ -166,7 +169,7 @@ def startWeatherAgent(datafile, configfile):
         if i > 0:
             timeToRequest = timeNeedToPublish[i]
             if hFed is not None:
-              time_granted = int (helics.helicsFederateRequestTime(hFed, timeToRequest))
+              time_granted = int (tracer.request_time(hFed, timeToRequest))
             else:
               time_granted = fncs.time_request(timeToRequest)
         if timeNeedToBePublished[i] in timeNeedToPublishRealtime:
@@ -216,7 +219,7 @@ def startWeatherAgent(datafile, configfile):
     # if the last time step/stop time is not requested
     if timeStopInSeconds not in timeNeedToPublish:
         if hFed is not None:
-          time_granted = int (helics.helicsFederateRequestTime(hFed, timeStopInSeconds))
+          time_granted = int (tracer.request_time(hFed, timeStopInSeconds))
         else:
           time_granted = fncs.time_request(timeStopInSeconds)
 
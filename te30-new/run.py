@@ -7,9 +7,10 @@ modified by Yuanliang Li
 
 """
 
-import time
 import os
-import subprocess
+import sys
+from federate_supervisor import FEDERATE_SUPERVISOR, FEDERATE_SPEC
+from broker_topology import BROKER_TOPOLOGY
 
 """declare something"""
 TESP_INSTALL = os.environ['TESP_INSTALL']
@@ -18,28 +19,43 @@ SCHED_PATH = TESP_SUPPORT+'/schedules'
 EPW = TESP_SUPPORT+'/energyplus/USA_AZ_Tucson.Intl.AP.722740_TMY3.epw'
 
 
-"""run commands by using python subprocess"""
-processes_list = [] # list to save all subprocesses for process management
-# command to launch helics broker
-cmd0 = "helics_broker -f 6 --loglevel=1 --name=mainbroker >helics_broker.log 2>&1"
-# command to launch gridlabd federate
-cmd1 = "cd ./fed_gridlabd/ && gridlabd -D SCHED_PATH={} -D USE_HELICS -D METRICS_FILE=TE_ChallengeH_metrics.json TE_Challenge.glm >gridlabd.log 2>&1".format(SCHED_PATH)
-# command to launch weather federate
-cmd2 = "cd ./fed_weather/ && python3 launch_weather.py >weather.log 2>&1"
-# command to launch pypower federate
-cmd3 = "cd ./fed_pypower/ && python3 launch_pypower.py >pypower.log 2>&1"
-# command to launch substation federate
-cmd4 = "cd ./fed_substation/ && python3 launch_substation.py >substation.log 2>&1"
-# command to launch energyplus federate
-cmd5 = "cd ./fed_energyplus/ && export HELICS_CONFIG_FILE=helics_eplus.json && exec energyplus -w {} -d output -r MergedH.idf >eplus.log 2>&1".format(EPW)
-# command to launch energyplus agent (it is also a federate)
-cmd6 = "cd ./fed_energyplus/ && eplus_agent_helics 172800s 300s SchoolDualController eplus_TE_ChallengeH_metrics.json  0.02 25 4 4 helics_eplus_agent.json >eplus_agent.log 2>&1"
-
-processes_list.append(subprocess.Popen(cmd0, stdout=subprocess.PIPE, shell=True))
-processes_list.append(subprocess.Popen(cmd1, stdout=subprocess.PIPE, shell=True))
-processes_list.append(subprocess.Popen(cmd2, stdout=subprocess.PIPE, shell=True))
-processes_list.append(subprocess.Popen(cmd3, stdout=subprocess.PIPE, shell=True))
-processes_list.append(subprocess.Popen(cmd4, stdout=subprocess.PIPE, shell=True))
-processes_list.append(subprocess.Popen(cmd5, stdout=subprocess.PIPE, shell=True))
-processes_list.append(subprocess.Popen(cmd6, stdout=subprocess.PIPE, shell=True))
+"""run the broker and the federates under the supervisor"""
+# the federates are launched concurrently, a crashed, timed out or hung federate stops the whole co-simulation
+wall_timeout = None # seconds, a federate running longer is stopped (None for no limit)
+idle_timeout = None # seconds, a federate writing nothing to its log for longer counts as hung (None for no limit)
+timeouts = {'wall_timeout': wall_timeout, 'idle_timeout': idle_timeout}
+# 'flat': every federate connects to one broker, 'hierarchical': a sub-broker for the feeder (GridLAB-D and the
+# substation), the bulk system (PyPower) and the school building (EnergyPlus) under a root broker
+broker_layout = 'flat'
+case_root = os.path.abspath('.')
+eplus_root = os.path.join(case_root, 'fed_energyplus')
+federates = [
+  FEDERATE_SPEC('gridlabd', ['gridlabd', '-D', 'SCHED_PATH={}'.format(SCHED_PATH), '-D', 'USE_HELICS', '-D', 'METRICS_FILE=TE_ChallengeH_metrics.json', 'TE_Challenge.glm'],
+                os.path.join(case_root, 'fed_gridlabd'), 'gridlabd.log', helics_config=os.path.join(case_root, 'fed_gridlabd', 'TE_Challenge_HELICS_gld_msg.json'),
+                broker_group='feeder', **timeouts),
+  FEDERATE_SPEC('weather', [sys.executable, 'launch_weather.py'], os.path.join(case_root, 'fed_weather'), 'weather.log',
+                ready_pattern='HELICS initialized', **timeouts),
+  FEDERATE_SPEC('pypower', [sys.executable, 'launch_pypower.py'], os.path.join(case_root, 'fed_pypower'), 'pypower.log',
+                ready_pattern='HELICS subscription key', helics_config=os.path.join(case_root, 'fed_pypower', 'pypowerConfig.json'),
+                broker_group='bulk', **timeouts),
+  FEDERATE_SPEC('substation', [sys.executable, 'launch_substation.py'], os.path.join(case_root, 'fed_substation'), 'substation.log',
+                helics_config=os.path.join(case_root, 'fed_substation', 'TE_Challenge_HELICS_substation.json'), broker_group='feeder', **timeouts),
+  FEDERATE_SPEC('energyplus', ['energyplus', '-w', EPW, '-d', 'output', '-r', 'MergedH.idf'], eplus_root, 'eplus.log',
+                env={'HELICS_CONFIG_FILE': 'helics_eplus.json'}, helics_config=os.path.join(eplus_root, 'helics_eplus.json'),
+                broker_group='eplus', **timeouts),
+  FEDERATE_SPEC('eplus_agent', ['eplus_agent_helics', '172800s', '300s', 'SchoolDualController', 'eplus_TE_ChallengeH_metrics.json', '0.02', '25', '4', '4', 'helics_eplus_agent.json'],
+                eplus_root, 'eplus_agent.log', helics_config=os.path.join(eplus_root, 'helics_eplus_agent.json'),
+                broker_group='eplus', **timeouts)]
+topology = BROKER_TOPOLOGY(broker_layout, 'mainbroker', None, case_root)
+specs = topology.broker_specs([(spec.name, spec.broker_group, spec.helics_config) for spec in federates]) + federates
 
+supervisor = FEDERATE_SUPERVISOR()
+try:
+  topology.show()
+  supervisor.launch(*specs)
+  supervisor.wait() # returns when every federate ended or the co-simulation was stopped after a failure
+except KeyboardInterrupt:
+  print('interrupted, stopping the co-simulation', flush=True)
+finally:
+  supervisor.shutdown()
+  supervisor.show_report() # start latency and wall time of every federate